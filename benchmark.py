@@ -1,42 +1,126 @@
 from __future__ import division
 
-import time
+import argparse
+import json
 import sys, os
-import pygame
 
 from common import ObjImporter
-from common.objects import Camera
-from rasterized import Rasterizer
-from raytraced import Raytracer
+from common import backends
+from common import offscreen as headless
+from common import timing
+from common.objects import Camera, Scene
 
 CAMERA = Camera()
 CAMERA.position[2] = -6
 
-def main(renderer, test, duration = 20, width = 500, height = 500):
-    object = ObjImporter.load(os.path.join("tests", test))[0]
+#Frames rendered before timing starts (shader compilation, caches, ...)
+WARMUP_FRAMES = 10
 
+def main(renderer, test, duration = 20, width = 500, height = 500,
+         warmup = WARMUP_FRAMES, offscreen = False, lod = False, processes = None,
+         profile = False):
+    """
+    main(renderer:str, test:str, duration:float, width:int, height:int,
+         warmup:int, offscreen:bool, lod:bool, processes:int, profile:bool) -> dict
+
+    Renders "test" with "renderer" for "duration" seconds after
+    "warmup" untimed frames and returns the statistics of
+    the recorded frame times (see timing.summarize).
+    With "offscreen" set no window is opened.
+    With "lod" set meshes are drawn at their level of detail.
+    "processes" is the number of worker processes of CPU
+    renderers that have them, every available core if None.
+    With "profile" set, renderers that can record where the time
+    of every frame goes do so (see timing.Profiler). The records of
+    the timed frames are added as "phases", their means per frame
+    as "host_ms" and "device_ms".
+    """
+    scene = Scene.from_meshes(ObjImporter.load(os.path.join("tests", test), lod = lod))
+
+    name = renderer
     resolution = int(width), int(height)
-    renderer = {
-        "rasterized" : Rasterizer,
-        "raytraced" : Raytracer,
-    }[renderer](resolution, object)
-
-    results = []
-    start_time = time.time()
-    while time.time() - start_time < int(duration):
-        start = time.clock()
+    renderer = create_renderer(renderer, resolution, scene, offscreen, processes, profile)
+    profiler = getattr(renderer, "profiler", timing.NullProfiler())
+
+    for frame in range(int(warmup)):
         renderer.render(CAMERA)
-        fps = 1 / (time.clock() - start)
-        results.append(fps)
+        pump_events()
+    profiler.reset()
 
-        #Help pygame stay alive
-        pygame.event.get()
+    frame_times = []
+    end_time = timing.clock_ns() + int(float(duration) * 1e9)
+    while True:
+        start = timing.clock_ns()
+        renderer.render(CAMERA)
+        stop = timing.clock_ns()
+        frame_times.append(stop - start)
+
+        #Not part of the frame
+        pump_events()
+        if stop >= end_time:
+            break
 
+    processes = getattr(renderer, "processes", 1)
+    #Device times have to be read before the context is gone
+    phases = profiler.records()
     renderer.close()
 
-    #Return average
-    return sum(results) / len(results)
+    result = {
+        "renderer" : name,
+        "mesh" : test,
+        "width" : resolution[0],
+        "height" : resolution[1],
+        "warmup" : int(warmup),
+        "offscreen" : bool(offscreen),
+        "lod" : bool(lod),
+        "processes" : processes,
+        "profile" : profiler.enabled,
+    }
+    result.update(timing.summarize(frame_times))
+    result["frame_times_ns"] = frame_times
+    if profiler.enabled:
+        result.update(timing.summarize_phases(phases))
+        result["phases"] = phases
+    return result
+
+def create_renderer(name, resolution, scene, offscreen = False, processes = None,
+                    profile = False):
+    #Renderers are imported when needed (see common.backends),
+    #as offscreen rendering has to be set up before OpenGL is imported
+    backend = backends.get(name)
+    if offscreen and not backend.cpu:
+        headless.enable()
+
+    return backend.create(resolution, scene, offscreen = offscreen,
+                          processes = processes, profile = profile)
+
+def pump_events():
+    #Help pygame stay alive, if a renderer opened a window
+    pygame = sys.modules.get("pygame")
+    if pygame is not None and pygame.display.get_init():
+        pygame.event.get()
 
 if __name__ == "__main__":
-    result = main(*sys.argv[1:])
-    print(result)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("renderer", choices = backends.names())
+    parser.add_argument("test")
+    parser.add_argument("duration", nargs = "?", type = float, default = 20)
+    parser.add_argument("width", nargs = "?", type = int, default = 500)
+    parser.add_argument("height", nargs = "?", type = int, default = 500)
+    parser.add_argument("--warmup", type = int, default = WARMUP_FRAMES)
+    parser.add_argument("--offscreen", action = "store_true",
+                        help = "render without a window")
+    parser.add_argument("--lod", action = "store_true",
+                        help = "simplify meshes into levels of detail")
+    parser.add_argument("--processes", type = int,
+                        help = "worker processes of CPU renderers (default: every core)")
+    parser.add_argument("--profile", action = "store_true",
+                        help = "record the host and device time of every phase of a frame")
+    options = parser.parse_args()
+
+    result = main(options.renderer, options.test, options.duration,
+                  options.width, options.height, options.warmup, options.offscreen,
+                  options.lod, options.processes, options.profile)
+    del result["frame_times_ns"]
+    result.pop("phases", None)
+    print(json.dumps(result, indent=2, sort_keys=True))
@@ -1,31 +1,241 @@
 #!/usr/bin/env python
+"""
+Benchmarks every renderer x resolution x test.
+
+Every configuration runs in its own process, so no window,
+context or cache survives from one run into the next.
+Results of finished runs are kept in RESULTS_DIR/runs and
+reused, so an interrupted sweep continues where it stopped.
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
 import sys, os
-import benchmark
+import time
 
-RENDERERS = "raytraced", "rasterized"
+from common import backends
+
+RENDERERS = ("raytraced", "raytraced_pipelined", "rasterized", "rasterized_vbo",
+             "raytraced_cpu", "rasterized_cpu")
 RESOLUTIONS = [
     (500, 500),
 ]
 TEST_LENGTH = 20
+RESULTS_DIR = "results"
+
+#Renderers doing their work on the CPU, these get cores of their own.
+#Runs at the same time still share memory bandwidth, see --exclusive
+CPU_RENDERERS = tuple(backends.cpu_names())
+#Renderers sharing the GPU, only this many of them run at once
+GPU_SLOTS = 1
+
+#Columns of the CSV summary, in order
+COLUMNS = ("renderer", "mesh", "width", "height", "warmup", "frames",
+           "mean_ms", "median_ms", "p95_ms", "p99_ms", "min_ms", "max_ms",
+           "stdev_ms", "mean_ci95_ms", "median_ci95_ms", "fps",
+           "concurrent_runs")
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("-j", "--jobs", type = int, default = len(available_cores()),
+                        help = "configurations run at once")
+    parser.add_argument("-d", "--duration", type = float, default = TEST_LENGTH,
+                        help = "seconds every configuration is timed for")
+    parser.add_argument("-o", "--output", default = RESULTS_DIR,
+                        help = "directory results are written to")
+    parser.add_argument("--fresh", action = "store_true",
+                        help = "rerun configurations that already have results")
+    parser.add_argument("--offscreen", action = "store_true",
+                        help = "render without windows, for machines without a display")
+    parser.add_argument("--exclusive", action = "store_true",
+                        help = "run CPU renderers alone on every core, for timings "
+                               "free of other runs (slower)")
+    options = parser.parse_args(args)
+
+    runs = os.path.join(options.output, "runs")
+    if not os.path.isdir(runs):
+        os.makedirs(runs)
+
+    configurations = list(sweep())
+    pending = [configuration for configuration in configurations
+               if options.fresh or not os.path.exists(run_path(runs, configuration))]
+    sys.stdout.write("%d configurations, %d to run\n" % (
+        len(configurations), len(pending)))
+
+    schedule(pending, runs, options.duration, max(1, options.jobs), options.offscreen,
+             options.exclusive)
+
+    results = []
+    for configuration in configurations:
+        path = run_path(runs, configuration)
+        if os.path.exists(path):
+            with open(path) as file:
+                results.append(json.load(file))
+    save_results(results, options.output)
+
+def sweep():
+    #Every configuration as (renderer, test, width, height)
+    tests = sorted(test for test in os.listdir("tests") if test.endswith(".obj"))
+    for renderer in RENDERERS:
+        for width, height in RESOLUTIONS:
+            for test in tests:
+                yield renderer, test, width, height
+
+def run_path(runs, configuration):
+    return os.path.join(runs, "%s_%dx%d_%s.json" % (
+        configuration[0], configuration[2], configuration[3], configuration[1]))
+
+"""
+   SCHEDULING
+"""
+
+def available_cores():
+    #Cores this process may run on
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def schedule(pending, runs, duration, jobs, offscreen = False, exclusive = False):
+    """
+    schedule(pending:[tuple,], runs:str, duration:float, jobs:int,
+             offscreen:bool, exclusive:bool)
 
-def main():
-    #Redirect stdout and stderr to nothing
+    Runs every configuration in "pending" in a worker process,
+    at most "jobs" at a time and at most GPU_SLOTS of them on the GPU.
+    Every slot owns a share of the cores, CPU renderers are pinned to it.
+    With "exclusive" set, CPU renderers instead only run while nothing
+    else does, on every core.
+    The most runs there were at once while a configuration ran is
+    added to its result as "concurrent_runs".
+    """
+    cores = available_cores()
+    jobs = min(jobs, len(cores))
+    slots = [cores[index::jobs] for index in range(jobs)]
+
+    pending = list(pending)
+    #slot -> [process, configuration, most runs at once]
+    running = {}
+    while pending or running:
+        #Reap finished workers
+        for slot, (process, configuration, concurrent) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[slot]
+                status = "done" if process.exitcode == 0 else "failed (%s)" % process.exitcode
+                if process.exitcode == 0:
+                    __record_concurrency(run_path(runs, configuration), concurrent)
+                sys.stdout.write("%s %s %dx%d: %s\n" % (
+                    configuration[0], configuration[1],
+                    configuration[2], configuration[3], status))
+
+        #Fill free slots
+        gpu_runs = sum(1 for process, configuration, concurrent in running.values()
+                       if configuration[0] not in CPU_RENDERERS)
+        for slot in range(jobs):
+            if slot in running:
+                continue
+            #Nothing runs alongside an exclusive CPU renderer
+            if exclusive and any(configuration[0] in CPU_RENDERERS
+                                 for process, configuration, concurrent in running.values()):
+                break
+            configuration = __next_configuration(pending, gpu_runs < GPU_SLOTS,
+                                                 not exclusive or not running)
+            if configuration is None:
+                break
+            cpu = configuration[0] in CPU_RENDERERS
+            if not cpu:
+                gpu_runs += 1
+
+            process = multiprocessing.Process(
+                target = run, args = (configuration,
+                                      cores if exclusive and cpu else slots[slot],
+                                      run_path(runs, configuration), duration,
+                                      offscreen))
+            process.start()
+            running[slot] = [process, configuration, 0]
+
+        for entry in running.values():
+            entry[2] = max(entry[2], len(running))
+        time.sleep(0.1)
+
+def __next_configuration(pending, gpu_free, cpu_free):
+    for index, configuration in enumerate(pending):
+        if configuration[0] in CPU_RENDERERS:
+            if cpu_free:
+                return pending.pop(index)
+        elif gpu_free:
+            return pending.pop(index)
+    return None
+
+def __record_concurrency(path, concurrent):
+    #Added by the scheduler, which alone knows what ran alongside
+    with open(path) as file:
+        result = json.load(file)
+    result["concurrent_runs"] = concurrent
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(result, file)
+    os.rename(temporary, path)
+
+def run(configuration, cores, path, duration, offscreen = False):
+    """Entry point of worker processes, benchmarks a single configuration"""
+    renderer, test, width, height = configuration
+    if renderer in CPU_RENDERERS and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    #Renderers are only imported here, by the worker
+    import benchmark
+
+    #Silence the renderers
     devnull = open(os.devnull, 'w')
-    stdout = sys.stdout
     sys.stdout = devnull
+    try:
+        result = benchmark.main(renderer, test, duration, width, height,
+                                offscreen = offscreen)
+    finally:
+        sys.stdout = sys.__stdout__
+        devnull.close()
 
-    for renderer in RENDERERS:
-        print(renderer)
-        for resolution in RESOLUTIONS:
-            print(" %sx%s" % resolution)
-            for test in os.listdir("tests"):
-                result = benchmark.main(renderer, test, TEST_LENGTH, *resolution)
-                print("  %s: %s" % (test, result))
+    result["cores"] = len(cores) if renderer in CPU_RENDERERS else None
+
+    #Write atomically so an interrupted run is never mistaken for a result
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(result, file)
+    os.rename(temporary, path)
+
+"""
+   OUTPUT
+"""
+
+def save_results(results, output):
+    """
+    save_results(results:[dict,], output:str)
+
+    Writes every result with its frame times to "results.json"
+    and a summary row per result to "results.csv" in "output"
+    """
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    with open(os.path.join(output, "results.json"), "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
 
+    with open(os.path.join(output, "results.csv"), "w") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for result in results:
+            writer.writerow([__csv_value(result.get(column)) for column in COLUMNS])
 
-    #Direct stdout back to stdout
-    sys.stdout = stdout
-    devnull.close()
+def __csv_value(value):
+    #Confidence intervals are written as "low:high"
+    if isinstance(value, (list, tuple)):
+        return ":".join("%.6f" % item for item in value)
+    if isinstance(value, float):
+        return "%.6f" % value
+    return value
 
 if __name__ == "__main__":
     main()
@@ -1,103 +1,281 @@
 """
 Contains functions for loading optimised Wavefront .obj
 files into nicely formatted objects with optimised data.
+
+Files are streamed in chunks and tokenized in bulk,
+so they never have to fit into memory as text.
+Parsed meshes are cached in a binary .npz file
+next to the .obj file, which is used instead of
+the .obj file for as long as it doesn't change,
+along with the meshes' levels of detail once made.
 """
 
-import string
-from math3d import Vector
+import os
+import re
+import zipfile
+import numpy
 from objects import Mesh
 
-def load(path):
+#Amount of text parsed at once
+CHUNK_SIZE = 1 << 22
+#Change whenever the parsed output changes to invalidate caches
+CACHE_VERSION = 5
+
+#Statements we care about, matched on whole chunks at once
+_OBJECT = re.compile(r"^o\b", re.M)
+_POSITION = re.compile(r"^v[ \t]+(.*)$", re.M)
+_UV = re.compile(r"^vt[ \t]+(.*)$", re.M)
+_NORMAL = re.compile(r"^vn[ \t]+(.*)$", re.M)
+_FACE = re.compile(r"^f[ \t]+(.*)$", re.M)
+
+def load(path, cache=True, lod=False):
     """
-    load(path:str) -> [Mesh,]
+    load(path:str, cache:bool, lod:bool) -> [Mesh,]
 
     Loads a .obj file from "path"
-    and returns it in a Mesh object
+    and returns it in a Mesh object.
+    Uses (and refreshes) the binary cache if "cache" is set.
+    Generates the levels of detail of every Mesh if "lod" is set.
     """
 
-    objects = []
+    objects = None
+    if cache:
+        objects = __load_cache(path)
+        if objects is not None and not (lod and __missing_lods(objects)):
+            return objects
 
-    with open(path, "r") as file:
-        lines = file.readlines()
-        objs = __split_objects(lines)
-        for obj in objs:
-            obj = __parse_lines(obj)
-            if obj:
+    #Cached meshes only miss their levels of detail
+    if objects is None:
+        objects = []
+        with open(path, "r") as file:
+            for obj in __parse_file(file):
                 obj.file = path
                 objects.append(obj)
 
-    return objects
+    if lod:
+        for obj in objects:
+            if obj.lods is None:
+                obj.generate_lods()
 
-def __split_objects(lines):
-    objects = []
+    if cache:
+        __save_cache(path, objects)
 
-    index = 0
-    last_index = 0
-    while index < len(lines):
-        values = lines[index].split(" ")
-        index += 1
+    return objects
 
-        if values[0] == "o":
-            objects.append(lines[last_index:index])
-            last_index = index
-    objects.append(lines[last_index:])
+"""
+   PARSING
+"""
 
-    return objects
+def __parse_file(file):
+    #Attribute arrays are shared by all objects in a file
+    attributes = {"v" : [], "vt" : [], "vn" : []}
+    #Face corners of every object
+    objects = [[]]
+
+    remainder = ""
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
 
-def __parse_lines(lines):
-    verts = []
-    norms = []
-    tris = []
+        #Only parse complete lines, keep the rest for the next chunk
+        chunk = remainder + chunk
+        end = chunk.rfind("\n") + 1
+        remainder = chunk[end:]
+        if end:
+            __parse_chunk(chunk[:end], attributes, objects)
+    __parse_chunk(remainder, attributes, objects)
 
-    for line in lines:
-        attributes = line.split(" ")
+    positions = __concatenate(attributes["v"], 3)
+    uvs = __concatenate(attributes["vt"], 2)
+    normals = __concatenate(attributes["vn"], 3)
 
-        if attributes[0] == "#" or len(attributes) < 2:
+    meshes = []
+    for corners in objects:
+        if len(corners) == 0:
             continue
 
-        if attributes[0] == "v":
-            verts.append(Vector(
-                float(attributes[1]),
-                float(attributes[2]),
-                float(attributes[3])));
-        elif attributes[0] == "vn":
-            norms.append(Vector(
-                float(attributes[1]),
-                float(attributes[2]),
-                float(attributes[3])));
-        elif attributes[0] == "f":
-            i = 3
-            while i < len(attributes):
-                for j in xrange(3):
-                    values = attributes[i - 2 + j].split("/")
-                    value = Vector(-1, -1, -1)
-                    value[0] = int(values[0]) - 1
-                    if len(values) == 3:
-                        if values[1] != "":
-                            value[1] = int(values[1]) - 1
-                        if values[2] != "":
-                            value[2] = int(values[2]) - 1
-                    tris.append(value)
-                i += 1
-
-    if len(tris) == 0:
-        return
-
-    vertices = []
-    normals = []
-
-    triangles = []
-
-    index = 0
-    for triangle in tris:
-        vertices.append(verts[int(triangle[0])])
-        normals.append(norms[int(triangle[2])])
-        triangles.append(index)
-        index += 1
+        #(position, uv, normal) indices of every corner
+        corners = numpy.concatenate(corners)
+        vertices, indices = __deduplicate(corners)
 
-    mesh = Mesh()
-    mesh.vertices = tuple(vertices)
-    mesh.normals = tuple(normals)
-    mesh.triangles = tuple(triangles)
+        mesh = Mesh()
+        mesh.positions = __gather(positions, vertices[:, 0])
+        mesh.uv = __gather(uvs, vertices[:, 1])
+        mesh.normals = __gather(normals, vertices[:, 2])
+        mesh.indices = indices
+        meshes.append(mesh)
+
+    return meshes
+
+def __parse_chunk(text, attributes, objects):
+    #Every "o" statement starts a new object
+    start = 0
+    for match in _OBJECT.finditer(text):
+        __parse_text(text[start:match.start()], attributes, objects[-1])
+        objects.append([])
+        start = match.start()
+    __parse_text(text[start:], attributes, objects[-1])
+
+def __parse_text(text, attributes, corners):
+    attributes["v"].append(__parse_floats(_POSITION.findall(text), 3))
+    attributes["vt"].append(__parse_floats(_UV.findall(text), 2))
+    attributes["vn"].append(__parse_floats(_NORMAL.findall(text), 3))
+
+    faces = _FACE.findall(text)
+    if faces:
+        corners.append(__parse_faces(faces))
+
+def __parse_floats(lines, width):
+    #Convert all lines in one go
+    values = numpy.fromstring(" ".join(lines), dtype=numpy.float32, sep=" ")
+    if len(values) == len(lines) * width:
+        return values.reshape(-1, width)
+
+    #Some lines have optional extra components (like w)
+    values = [line.split()[:width] for line in lines]
+    return numpy.array(values, dtype=numpy.float32).reshape(-1, width)
+
+def __parse_faces(faces):
+    tokens = [face.split() for face in faces]
+    counts = numpy.array([len(face) for face in tokens], dtype=numpy.int64)
+    tokens = [token for face in tokens for token in face]
+
+    corners = __parse_corners(tokens)
+
+    #Triangulate polygons as fans around their first corner
+    triangles = counts - 2
+    total = triangles.sum()
+    first = numpy.repeat(numpy.cumsum(counts) - counts, triangles)
+    fan = (numpy.arange(total) -
+           numpy.repeat(numpy.cumsum(triangles) - triangles, triangles))
+    indices = numpy.stack([first, first + fan + 1, first + fan + 2], axis=1)
+
+    return corners[indices.reshape(-1)]
+
+def __parse_corners(tokens):
+    #Fast path: every corner has the same "v/vt/vn" layout. The
+    #number of values alone can't tell, as "1/1 4 3/3/1" has 6 too
+    layouts = set((token.count("/"), "//" in token) for token in tokens)
+    if len(layouts) == 1:
+        width = tokens[0].count("/") + 1
+        text = " ".join(tokens).replace("//", "/0/").replace("/", " ")
+        values = numpy.fromstring(text, dtype=numpy.int64, sep=" ")
+
+        if len(values) == len(tokens) * width:
+            corners = numpy.zeros((len(tokens), 3), dtype=numpy.int32)
+            corners[:, :width] = values.reshape(-1, width)
+            #Convert to 0 based indices with -1 for missing attributes
+            return corners - 1
 
+    #Mixed layouts, parse corner by corner
+    return numpy.array([__parse_corner(token) for token in tokens],
+                       dtype=numpy.int32)
+
+def __parse_corner(value):
+    #Turn "v", "v/vt", "v//vn" or "v/vt/vn" into 0 based indices
+    #with -1 for missing attributes
+    values = value.split("/")
+    corner = [int(values[0]) - 1, -1, -1]
+    if len(values) > 1 and values[1] != "":
+        corner[1] = int(values[1]) - 1
+    if len(values) > 2 and values[2] != "":
+        corner[2] = int(values[2]) - 1
+    return corner
+
+def __deduplicate(corners):
+    #Corners sharing position, uv and normal become one vertex
+    unique, first, inverse = numpy.unique(corners, axis=0,
+                                          return_index=True,
+                                          return_inverse=True)
+
+    #Number vertices in order of first use, which keeps
+    #neighbouring triangles close in the vertex cache
+    order = numpy.argsort(first)
+    rank = numpy.empty(len(order), dtype=numpy.int32)
+    rank[order] = numpy.arange(len(order), dtype=numpy.int32)
+
+    return unique[order], rank[inverse.reshape(-1)]
+
+def __concatenate(arrays, width):
+    arrays = [array for array in arrays if len(array)]
+    if not arrays:
+        return numpy.zeros((0, width), dtype=numpy.float32)
+    return numpy.concatenate(arrays)
+
+def __gather(values, indices):
+    #Look up attribute values for every corner,
+    #corners without one (index -1) get zeros
+    if len(values) == 0:
+        return numpy.zeros((len(indices), values.shape[1]), dtype=numpy.float32)
+    out = values[numpy.maximum(indices, 0)]
+    out[indices < 0] = 0
+    return out
+
+def __missing_lods(objects):
+    return any(obj.lods is None for obj in objects)
+
+"""
+   CACHING
+"""
+
+#Mesh arrays stored in the cache
+_ARRAYS = "positions", "normals", "uv", "indices"
+
+def __cache_path(path):
+    return path + ".npz"
+
+def __cache_key(path):
+    #Any change to the file (or the importer) invalidates the cache
+    stat = os.stat(path)
+    return "%d:%s:%r:%d" % (CACHE_VERSION, os.path.abspath(path),
+                            stat.st_mtime, stat.st_size)
+
+def __load_cache(path):
+    try:
+        with numpy.load(__cache_path(path)) as data:
+            if str(data["key"]) != __cache_key(path):
+                return None
+
+            objects = []
+            for index in range(int(data["count"])):
+                mesh = __load_mesh(data, "%d" % index)
+                mesh.file = path
+
+                #-1 if the levels of detail were never made
+                levels = int(data["lods_%d" % index])
+                if levels >= 0:
+                    mesh.lods = [__load_mesh(data, "%d_%d" % (index, level))
+                                 for level in range(levels)]
+                objects.append(mesh)
+            return objects
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+
+def __load_mesh(data, suffix):
+    mesh = Mesh()
+    for name in _ARRAYS:
+        setattr(mesh, name, data["%s_%s" % (name, suffix)])
     return mesh
+
+def __save_cache(path, objects):
+    arrays = {"key" : numpy.array(__cache_key(path)),
+              "count" : numpy.array(len(objects))}
+    for index, mesh in enumerate(objects):
+        __save_mesh(arrays, mesh, "%d" % index)
+
+        #-1 if the levels of detail were never made
+        arrays["lods_%d" % index] = numpy.array(-1 if mesh.lods is None else len(mesh.lods))
+        for level, lod in enumerate(mesh.lods or []):
+            __save_mesh(arrays, lod, "%d_%d" % (index, level))
+
+    #A missing cache is not an error, just slower
+    try:
+        with open(__cache_path(path), "wb") as file:
+            numpy.savez(file, **arrays)
+    except (IOError, OSError):
+        pass
+
+def __save_mesh(arrays, mesh, suffix):
+    for name in _ARRAYS:
+        arrays["%s_%s" % (name, suffix)] = getattr(mesh, name)
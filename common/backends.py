@@ -0,0 +1,99 @@
+"""
+Registry of every renderer by the name benchmarks know it by.
+
+A renderer's module is only imported when the renderer is
+created, so running one never pays for importing the others
+(pygame, PyOpenGL, pyopencl, ...). Renderers bind their
+extension methods to the objects they render themselves
+(see objects.extend), importing one changes nothing else.
+"""
+
+import importlib
+
+class Backend(object):
+    """Renderer class "cls" of "module", created with
+    the keyword arguments "options" and those of the
+    caller it takes ("arguments").
+    "cpu" renderers do all their work on the CPU and never
+    open a window.
+    """
+    def __init__(self, name, module, cls, cpu=False, arguments=(), options=None):
+        self.name = name
+        self.module = module
+        self.cls = cls
+        self.cpu = cpu
+        self.arguments = tuple(arguments)
+        self.options = dict(options or {})
+
+    def load(self):
+        """Imports the module and returns the renderer class"""
+        return getattr(importlib.import_module(self.module), self.cls)
+
+    def create(self, resolution, scene, **arguments):
+        """Returns a new renderer, arguments it doesn't take are ignored"""
+        options = dict(self.options)
+        for name in self.arguments:
+            if name in arguments:
+                options[name] = arguments[name]
+        return self.load()(resolution, scene, **options)
+
+#Registered backends, in order
+_backends = []
+
+def register(name, module, cls, cpu=False, arguments=(), **options):
+    """
+    register(name:str, module:str, cls:str, cpu:bool, arguments:tuple, **options)
+
+    Makes "name" create module.cls(resolution, scene, **options)
+    """
+    if name in names():
+        raise Exception("Renderer already registered: %s" % name)
+    _backends.append(Backend(name, module, cls, cpu, arguments, options))
+
+def get(name):
+    """
+    get(name:str) -> Backend
+
+    Returns the Backend registered as "name"
+    """
+    for backend in _backends:
+        if backend.name == name:
+            return backend
+    raise Exception("Unknown renderer: %s" % name)
+
+def names():
+    """Returns the names of every renderer, in order"""
+    return [backend.name for backend in _backends]
+
+def cpu_names():
+    """Returns the names of every renderer working on the CPU"""
+    return [backend.name for backend in _backends if backend.cpu]
+
+def create(name, resolution, scene, **arguments):
+    """
+    create(name:str, resolution:tuple, scene:Scene, **arguments) -> renderer
+
+    Imports the backend of "name" and returns a new renderer of it
+    """
+    return get(name).create(resolution, scene, **arguments)
+
+"""
+   RENDERERS
+"""
+
+register("rasterized", "rasterized", "Rasterizer",
+         arguments=("offscreen", "profile"), draw_mode="list")
+register("rasterized_vbo", "rasterized", "Rasterizer",
+         arguments=("offscreen", "profile"), draw_mode="buffers")
+register("raytraced", "raytraced", "Raytracer",
+         arguments=("offscreen", "profile"))
+register("raytraced_pipelined", "raytraced", "Raytracer",
+         arguments=("offscreen", "profile"), pipelined=True)
+register("raytraced_progressive", "raytraced", "Raytracer",
+         arguments=("offscreen", "profile"), progressive=True)
+register("raytraced_shadows", "raytraced", "Raytracer",
+         arguments=("offscreen", "profile"), shadows=True)
+register("raytraced_cpu", "raytraced_cpu", "CpuRaytracer",
+         cpu=True, arguments=("processes",))
+register("rasterized_cpu", "rasterized_cpu", "CpuRasterizer",
+         cpu=True)
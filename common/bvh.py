@@ -0,0 +1,220 @@
+"""
+Builds bounding volume hierarchies over triangle soups
+using the surface area heuristic (SAH).
+
+The hierarchy is flattened into a compact node array
+designed for stackless traversal: siblings are stored
+next to each other and every node knows where to "skip"
+to once it (or its subtree) has been rejected.
+"""
+
+import numpy
+
+#Number of buckets centroids are binned into along each axis
+BINS = 12
+#Nodes with this many triangles or less are always leaves
+LEAF_SIZE = 4
+#Nodes are never left with more triangles than this
+MAX_LEAF_SIZE = 16
+#Relative costs used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+#Memory layout of a single node. Matches BVHNode in Raytracer.cl
+#first: index of the left child (inner nodes)
+#       or of the first triangle (leaves)
+#count: number of triangles, 0 for inner nodes
+#skip:  node to continue with once this subtree is done, -1 to stop
+NODE = numpy.dtype([("min", numpy.float32, 4),
+                    ("max", numpy.float32, 4),
+                    ("first", numpy.int32),
+                    ("count", numpy.int32),
+                    ("skip", numpy.int32),
+                    ("pad", numpy.int32)])
+
+def build(triangles):
+    """
+    build(triangles:numpy.ndarray) -> (numpy.ndarray, numpy.ndarray)
+
+    Builds a BVH over "triangles", an array of shape (n, 3, 3)
+    holding the three corner positions of every triangle.
+
+    Returns the flattened nodes (dtype NODE) and the order
+    triangles have to be stored in for the leaves to
+    reference contiguous ranges of them.
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.float32)[:, :, :3]
+    return build_bounds(triangles.min(axis=1), triangles.max(axis=1))
+
+def build_bounds(lower, upper):
+    """
+    build_bounds(lower:numpy.ndarray, upper:numpy.ndarray)
+        -> (numpy.ndarray, numpy.ndarray)
+
+    Builds a BVH over arbitrary primitives given
+    their axis aligned bounding boxes as (n, 3) arrays.
+    Returns the same as build.
+    """
+    lower = numpy.asarray(lower, dtype=numpy.float32)
+    upper = numpy.asarray(upper, dtype=numpy.float32)
+    centroids = (lower + upper) * 0.5
+
+    #Nodes are kept as python lists while building
+    mins, maxs, firsts, counts, skips = [], [], [], [], []
+    order = []
+    def add_node(skip):
+        mins.append(None)
+        maxs.append(None)
+        firsts.append(0)
+        counts.append(0)
+        skips.append(skip)
+        return len(skips) - 1
+
+    #Build breadth first so the top levels of the tree
+    #end up at the start of the node array
+    queue = [(add_node(-1), numpy.arange(len(lower)))]
+    head = 0
+    while head < len(queue):
+        node, indices = queue[head]
+        head += 1
+
+        mins[node] = lower[indices].min(axis=0)
+        maxs[node] = upper[indices].max(axis=0)
+
+        split = __split(indices, lower, upper, centroids,
+                        mins[node], maxs[node])
+        if split is None:
+            #Make a leaf referencing a range of the triangle order
+            firsts[node] = len(order)
+            counts[node] = len(indices)
+            order.extend(indices)
+            continue
+
+        #Siblings are always stored next to each other
+        left = add_node(-1)
+        right = add_node(skips[node])
+        skips[left] = right
+        firsts[node] = left
+        queue.append((left, split[0]))
+        queue.append((right, split[1]))
+
+    nodes = numpy.zeros(len(skips), dtype=NODE)
+    nodes["min"][:, :3] = mins
+    nodes["max"][:, :3] = maxs
+    nodes["first"] = firsts
+    nodes["count"] = counts
+    nodes["skip"] = skips
+
+    return nodes, numpy.array(order, dtype=numpy.int32)
+
+def __area(lower, upper):
+    #Surface area of (arrays of) boxes
+    extent = numpy.maximum(upper - lower, 0)
+    return 2 * (extent[..., 0] * extent[..., 1] +
+                extent[..., 1] * extent[..., 2] +
+                extent[..., 2] * extent[..., 0])
+
+def __split(indices, lower, upper, centroids, node_min, node_max):
+    count = len(indices)
+    if count <= LEAF_SIZE:
+        return None
+
+    node_centroids = centroids[indices]
+    node_lower = lower[indices]
+    node_upper = upper[indices]
+    centroid_min = node_centroids.min(axis=0)
+    centroid_max = node_centroids.max(axis=0)
+    extent = centroid_max - centroid_min
+
+    best_cost = INTERSECTION_COST * count
+    best = None
+    parent_area = __area(node_min, node_max)
+
+    for axis in range(3):
+        if extent[axis] <= 0:
+            continue
+
+        #Bin primitives by centroid along this axis
+        bins = ((node_centroids[:, axis] - centroid_min[axis]) *
+                (BINS / extent[axis])).astype(numpy.int32)
+        bins = numpy.clip(bins, 0, BINS - 1)
+
+        sort = numpy.argsort(bins, kind="mergesort")
+        sorted_bins = bins[sort]
+        bin_counts = numpy.bincount(bins, minlength=BINS)
+        used = numpy.nonzero(bin_counts)[0]
+        starts = numpy.searchsorted(sorted_bins, used)
+
+        bin_min = numpy.full((BINS, 3), numpy.inf, dtype=numpy.float32)
+        bin_max = numpy.full((BINS, 3), -numpy.inf, dtype=numpy.float32)
+        bin_min[used] = numpy.minimum.reduceat(node_lower[sort], starts)
+        bin_max[used] = numpy.maximum.reduceat(node_upper[sort], starts)
+
+        #Sweep from both sides to get the bounds of every split
+        left_min = numpy.minimum.accumulate(bin_min)[:-1]
+        left_max = numpy.maximum.accumulate(bin_max)[:-1]
+        right_min = numpy.minimum.accumulate(bin_min[::-1])[::-1][1:]
+        right_max = numpy.maximum.accumulate(bin_max[::-1])[::-1][1:]
+        left_count = numpy.cumsum(bin_counts)[:-1]
+        right_count = count - left_count
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            cost = TRAVERSAL_COST + INTERSECTION_COST * (
+                __area(left_min, left_max) * left_count +
+                __area(right_min, right_max) * right_count) / parent_area
+        cost[(left_count == 0) | (right_count == 0) |
+             numpy.isnan(cost)] = numpy.inf
+
+        split = int(numpy.argmin(cost))
+        if cost[split] < best_cost:
+            best_cost = cost[split]
+            best = bins <= split
+
+    if best is None:
+        if count <= MAX_LEAF_SIZE:
+            return None
+        #No useful split, fall back to halving along the longest axis
+        axis = int(numpy.argmax(node_max - node_min))
+        half = numpy.argsort(node_centroids[:, axis], kind="mergesort")
+        best = numpy.zeros(count, dtype=bool)
+        best[half[:count // 2]] = True
+
+    return indices[best], indices[~best]
+
+def offset(nodes, node_offset, primitive_offset):
+    """
+    offset(nodes:numpy.ndarray, node_offset:int, primitive_offset:int)
+        -> numpy.ndarray
+
+    Returns a copy of "nodes" for storing it at "node_offset"
+    in a bigger node array, with its primitives starting
+    at "primitive_offset". Used to pack several BVHs together.
+    """
+    nodes = nodes.copy()
+    leaves = nodes["count"] > 0
+    nodes["first"][leaves] += primitive_offset
+    nodes["first"][~leaves] += node_offset
+    nodes["skip"][nodes["skip"] != -1] += node_offset
+    return nodes
+
+def transform_bounds(lower, upper, matrices):
+    """
+    transform_bounds(lower:numpy.ndarray, upper:numpy.ndarray,
+                     matrices:numpy.ndarray) -> (numpy.ndarray, numpy.ndarray)
+
+    Returns the (n, 3) world bounds of boxes "lower", "upper"
+    (one shared box or one per matrix) transformed by
+    each of the (n, 4, 4) "matrices"
+    """
+    matrices = numpy.asarray(matrices)
+    shape = (len(matrices), 3)
+    lower = numpy.broadcast_to(numpy.asarray(lower, dtype=numpy.float64), shape)
+    upper = numpy.broadcast_to(numpy.asarray(upper, dtype=numpy.float64), shape)
+    center = (lower + upper) * 0.5
+    extent = (upper - lower) * 0.5
+
+    #Transform the center and grow by the rotated extent
+    rotation = matrices[:, :3, :3]
+    centers = numpy.einsum("nij,nj->ni", rotation, center) + matrices[:, :3, 3]
+    extents = numpy.einsum("nij,nj->ni", numpy.abs(rotation), extent)
+    return centers - extents, centers + extents
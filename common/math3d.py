@@ -4,10 +4,14 @@ such as vector maths, quaternion and matrices
 as well as some useful shortcut solutions
 to some common problems
 
-Works best with pypy (Not CPython)
+Single values are plain python objects with __slots__.
+Operations on many values at once (transforming arrays
+of points, building matrices for arrays of rotations)
+have NumPy based batch functions at the end of the module.
 """
 
 import math
+import numpy
 
 class _classproperty(property):
     def __get__(self, cls, owner):
@@ -15,12 +19,12 @@ class _classproperty(property):
 
 class DimentionMissmatchException(Exception): pass
 
-class Vector():
+class Vector(object):
     """A Generalised Vector class deigned with minimal overhead.
     The Vectors dimension number is determined when it is created
     and stays constant for it's lifetime.
     """
-    __slows__ = ["_value"]
+    __slots__ = ["_value"]
     def __init__(self, *args):
         """Makes a new Vector with either
         each vector component separately
@@ -28,7 +32,14 @@ class Vector():
         """
         if len(args) == 1:
             args = args[0]
-        self._value = tuple(float(arg) for arg in args)
+        self._value = [float(arg) for arg in args]
+
+    @classmethod
+    def _from_list(cls, values):
+        """Makes a new Vector from a list of floats without copying"""
+        vector = cls.__new__(cls)
+        vector._value = values
+        return vector
 
     def __len__(self):
         """Returns the dimension number"""
@@ -36,17 +47,17 @@ class Vector():
 
     def __str__(self):
         """Returns a nicely formatted string representation of the Vector"""
-        return str(self._value)
+        return str(tuple(self._value))
     def __repr__(self):
         """Returns a nicely formatted string representation of the Vector"""
-        return repr(self._value)
+        return repr(tuple(self._value))
 
     def __add__(vec1, vec2):
         """Adds two Vectors with the same dimension number.
         Raises a DimentionMissmatchException if they don't match
         """
         if len(vec1) == len(vec2):
-            return Vector(vec1[i] + vec2[i] for i in range(len(vec1)))
+            return Vector._from_list([a + b for a, b in zip(vec1, vec2)])
         raise DimentionMissmatchException()
     __radd__ = __add__
 
@@ -56,7 +67,7 @@ class Vector():
         if the dimension numbers don't match
         """
         if len(self) == len(other):
-            self._value = tuple(self[i] + other[i] for i in range(len(self)))
+            self._value = [a + b for a, b in zip(self._value, other)]
             return self
         raise DimentionMissmatchException()
 
@@ -65,9 +76,16 @@ class Vector():
         Raises a DimentionMissmatchException if they don't match
         """
         if len(vec1) == len(vec2):
-            return Vector(vec1[i] - vec2[i] for i in range(len(vec1)))
+            return Vector._from_list([a - b for a, b in zip(vec1, vec2)])
+        raise DimentionMissmatchException()
+
+    def __rsub__(vec1, vec2):
+        """Subtracts a Vector from another sequence of the same dimension.
+        Raises a DimentionMissmatchException if they don't match
+        """
+        if len(vec1) == len(vec2):
+            return Vector._from_list([b - a for a, b in zip(vec1, vec2)])
         raise DimentionMissmatchException()
-    __rsub__ = __sub__
 
     def __isub__(self, other):
         """Subtracts another Vector to itself.
@@ -75,46 +93,53 @@ class Vector():
         if the dimension numbers don't match
         """
         if len(self) == len(other):
-            self._value = tuple(self[i] - other[i] for i in range(len(self)))
+            self._value = [a - b for a, b in zip(self._value, other)]
             return self
         raise DimentionMissmatchException()
 
     def __neg__(self):
         """Returns the negative value of the Vector"""
-        return Vector(-value for value in self)
+        return Vector._from_list([-value for value in self._value])
 
     def __mul__(vec, scalar):
         """Multiplies a Vector by a Scalar"""
         scalar = float(scalar)
-        return Vector(value*scalar for value in vec)
+        return Vector._from_list([value*scalar for value in vec._value])
     __rmul__ = __mul__
 
     def __imul__(self, other):
         """Multiplies another Scalar by itself"""
         other = float(other)
-        self._value = tuple(self[i]*other for i in range(len(self)))
+        self._value = [value*other for value in self._value]
+        return self
 
     def __div__(vec, scalar):
         """Divides a Vector by a Scalar"""
         scalar = float(scalar)
-        return Vector(value/scalar for value in vec)
+        return Vector._from_list([value/scalar for value in vec._value])
     __truediv__ = __div__
 
     def __floordiv__(vec, scalar):
         """Divides a Vector by an integer Scalar"""
         scalar = int(scalar)
-        return Vector(value/scalar for value in vec)
+        return Vector._from_list([value/scalar for value in vec._value])
 
     def __idiv__(self, other):
         """Divides another Scalar by itself"""
         other = float(other)
-        self._value = tuple(self[i]/other for i in range(len(self)))
+        self._value = [value/other for value in self._value]
+        return self
+    __itruediv__ = __idiv__
 
     def __eq__(vec1, vec2):
         """Checks equality between Vectors"""
         if len(vec1) != len(vec2): return False
 
-        return False not in [vec1[i] == vec2[i] for i in range(len(vec1))]
+        return all(a == b for a, b in zip(vec1, vec2))
+
+    def __ne__(vec1, vec2):
+        """Checks inequality between Vectors"""
+        return not vec1 == vec2
 
     def __getitem__(self, key):
         """Get a value from a Vector given a dimension"""
@@ -122,11 +147,10 @@ class Vector():
 
     def __setitem__(self, key, value):
         """Set a value from a Vector given a dimension"""
-        self._value = tuple(float(value) if i == key else self[i]
-                            for i in range(len(self)))
+        self._value[key] = float(value)
 
     def __iter__(self):
-        """Returns the iterator of the internal Tuple object"""
+        """Returns the iterator of the internal List object"""
         return iter(self._value)
 
     def __list__(self):
@@ -141,6 +165,11 @@ class Vector():
     def __int__(self):
         return len(self)
 
+    @property
+    def array(self):
+        """Returns the Vector as a NumPy array"""
+        return numpy.array(self._value)
+
     @property
     def x(self):
         """Shorthand for getting Vector[0]"""
@@ -159,7 +188,7 @@ class Vector():
     @y.setter
     def y(self, value):
         """Shorthand for setting Vector[1]"""
-        self[0]= value
+        self[1] = value
 
     @property
     def z(self):
@@ -184,7 +213,7 @@ class Vector():
     @property
     def magnitude(self):
         """Returns the magnitude of the Vector"""
-        return sum(value**2 for value in self)**0.5
+        return sum([value*value for value in self._value])**0.5
 
     @magnitude.setter
     def magnitude(self, value):
@@ -192,14 +221,14 @@ class Vector():
         Direction is maintained
         """
         multi = float(value)/self.magnitude
-        self._value = tuple(val*multi for val in self)
+        self._value = [val*multi for val in self._value]
 
     @property
     def magnitude2(self):
         """Returns the magnitude squared of the Vector
         Useful for comparing lengths
         """
-        return sum(value**2 for value in self)
+        return sum([value*value for value in self._value])
 
     @property
     def normalized(self):
@@ -213,27 +242,27 @@ class Vector():
         """
         if len(self) == len(value):
             mag = self.magnitude
-            self._value = tuple(val*mag for val in value)
+            self._value = [val*mag for val in value]
         else:
             raise DimentionMissmatchException()
 
     def normalize(self):
         """Normalizes the Vector"""
         magnitude = self.magnitude
-        self._value = tuple(value/magnitude for value in self)
+        self._value = [value/magnitude for value in self._value]
 
     @classmethod
     def dot(cls, vect1, vect2):
         """Returns the dot product between two Vectors"""
         if len(vect1) == len(vect2):
-            return sum(vect1[i]*vect2[i] for i in range((len(vect1))))
+            return sum([a*b for a, b in zip(vect1, vect2)])
         raise DimentionMissmatchException()
 
     @classmethod
     def angle(cls, vect1, vect2):
         """Returns the angle between two Vectors in radians"""
         return math.acos(cls.dot(vect1, vect2)/
-                         vect1.magnitude*vect2.magnitude)
+                         (vect1.magnitude*vect2.magnitude))
 
     @classmethod
     def angleD(cls, vect1, vect2):
@@ -249,7 +278,7 @@ class Vector():
     def scale(cls, vect1, vect2):
         """Multiplies two Vectors component wise"""
         if len(vect1) == len(vect2):
-            return Vector(vect1[i] * vect2[i] for i in range(len(vect1)))
+            return Vector._from_list([a*b for a, b in zip(vect1, vect2)])
         raise DimentionMissmatchException()
 
     @classmethod
@@ -267,9 +296,9 @@ class Vector():
         Ignores other dimensions
         """
         if len(v1) == len(v2) >= 3:
-            return Vector(v1[1]*v2[2] - v1[2]*v2[1],
-                          v1[2]*v2[0] - v1[0]*v2[2],
-                          v1[0]*v2[1] - v1[1]*v2[0])
+            return Vector._from_list([v1[1]*v2[2] - v1[2]*v2[1],
+                                      v1[2]*v2[0] - v1[0]*v2[2],
+                                      v1[0]*v2[1] - v1[1]*v2[0]])
         raise DimentionMissmatchException()
 
 class Quaternion(object):
@@ -343,10 +372,11 @@ class Quaternion(object):
 
     @property
     def matrix(self):
+        x, y, z, w = self._value
         return Matrix3x3(
-            (1 - 2*self.y**2 - 2*self.z**2), 2*(self.x*self.y + self.w*self.z), 2*(self.x*self.z - self.w*self.y),
-            2*(self.x*self.y - self.w*self.z), (1 - 2*self.x**2 - 2*self.z**2), 2*(self.y*self.z + self.w*self.x),
-            2*(self.x*self.z + self.w*self.y), 2*(self.y*self.z - self.w*self.x), (1 - 2*self.x**2 - 2*self.y**2)
+            (1 - 2*y*y - 2*z*z), 2*(x*y + w*z), 2*(x*z - w*y),
+            2*(x*y - w*z), (1 - 2*x*x - 2*z*z), 2*(y*z + w*x),
+            2*(x*z + w*y), 2*(y*z - w*x), (1 - 2*x*x - 2*y*y)
         )
 
     @classmethod
@@ -375,14 +405,22 @@ class Quaternion(object):
         return Quaternion(0, 0, 0, 1)
 
 class Matrix3x3(object):
+    """A row major 3x3 matrix"""
+    __slots__ = ["_value"]
     def __init__(self, *args):
         if len(args) == 9:
             self._value = tuple(args)
+        elif len(args) == 1 and len(args[0]) == 9:
+            self._value = tuple(args[0])
         else:
             raise AttributeError()
 
     def __len__(self):
-        return (3, 3)
+        return 9
+
+    def __str__(self):
+        return str(self._value)
+    __repr__ = __str__
 
     def __getitem__(self, key):
         return self._value[key]
@@ -394,9 +432,196 @@ class Matrix3x3(object):
 
     def __mul__(self, other):
         if len(other) == 3:
-            return Vector(
-                other[0]*self[0] + other[1]*self[1] + other[2]*self[2],
-                other[0]*self[3] + other[1]*self[4] + other[2]*self[5],
-                other[0]*self[6] + other[1]*self[7] + other[2]*self[8])
-        if len(other) == (3, 3):
-            raise NotImplementedError()
+            m = self._value
+            return Vector._from_list([
+                other[0]*m[0] + other[1]*m[1] + other[2]*m[2],
+                other[0]*m[3] + other[1]*m[4] + other[2]*m[5],
+                other[0]*m[6] + other[1]*m[7] + other[2]*m[8]])
+        if isinstance(other, Matrix3x3):
+            a, b = self._value, other._value
+            return Matrix3x3(
+                a[0]*b[0] + a[1]*b[3] + a[2]*b[6],
+                a[0]*b[1] + a[1]*b[4] + a[2]*b[7],
+                a[0]*b[2] + a[1]*b[5] + a[2]*b[8],
+                a[3]*b[0] + a[4]*b[3] + a[5]*b[6],
+                a[3]*b[1] + a[4]*b[4] + a[5]*b[7],
+                a[3]*b[2] + a[4]*b[5] + a[5]*b[8],
+                a[6]*b[0] + a[7]*b[3] + a[8]*b[6],
+                a[6]*b[1] + a[7]*b[4] + a[8]*b[7],
+                a[6]*b[2] + a[7]*b[5] + a[8]*b[8])
+        raise DimentionMissmatchException()
+
+    @property
+    def transposed(self):
+        m = self._value
+        return Matrix3x3(m[0], m[3], m[6],
+                         m[1], m[4], m[7],
+                         m[2], m[5], m[8])
+
+    @property
+    def array(self):
+        """Returns the matrix as a (3, 3) NumPy array"""
+        return numpy.array(self._value).reshape(3, 3)
+
+    @_classproperty
+    def identity(cls):
+        return Matrix3x3(1, 0, 0, 0, 1, 0, 0, 0, 1)
+
+"""
+   CHANGE TRACKING
+"""
+
+class TrackedVector(Vector):
+    """A Vector calling "callback" whenever it is changed in place.
+    Results of operations on it are plain Vectors.
+    """
+    __slots__ = ["_values", "_callback"]
+    def __init__(self, callback, *args):
+        self._callback = callback
+        Vector.__init__(self, *args)
+
+    def _get_value(self):
+        return self._values
+
+    def _set_value(self, value):
+        self._values = value
+        self._callback()
+
+    #Every in place operation of Vector either replaces _value
+    #or goes through __setitem__
+    _value = property(_get_value, _set_value)
+
+    def __setitem__(self, key, value):
+        self._values[key] = float(value)
+        self._callback()
+
+class TrackedQuaternion(Quaternion):
+    """A Quaternion calling "callback" whenever it is changed in place"""
+    __slots__ = ["_values", "_callback"]
+    def __init__(self, callback, *args):
+        self._callback = callback
+        Quaternion.__init__(self, *args)
+
+    def _get_value(self):
+        return self._values
+
+    def _set_value(self, value):
+        self._values = value
+        self._callback()
+
+    #Every in place operation of Quaternion replaces _value
+    _value = property(_get_value, _set_value)
+
+"""
+   BATCH OPERATIONS
+"""
+
+def quaternion_matrices(quaternions):
+    """
+    quaternion_matrices(quaternions:numpy.ndarray) -> numpy.ndarray
+
+    Converts an (n, 4) array of (x, y, z, w) rotations
+    into an (n, 3, 3) array laid out like Quaternion.matrix
+    """
+    q = numpy.asarray(quaternions, dtype=numpy.float64).reshape(-1, 4)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    out = numpy.empty((len(q), 3, 3))
+    out[:, 0, 0] = 1 - 2*y*y - 2*z*z
+    out[:, 0, 1] = 2*(x*y + w*z)
+    out[:, 0, 2] = 2*(x*z - w*y)
+    out[:, 1, 0] = 2*(x*y - w*z)
+    out[:, 1, 1] = 1 - 2*x*x - 2*z*z
+    out[:, 1, 2] = 2*(y*z + w*x)
+    out[:, 2, 0] = 2*(x*z + w*y)
+    out[:, 2, 1] = 2*(y*z - w*x)
+    out[:, 2, 2] = 1 - 2*x*x - 2*y*y
+    return out
+
+def compose(positions, rotations, scales=None):
+    """
+    compose(positions:numpy.ndarray, rotations:numpy.ndarray,
+            scales:numpy.ndarray) -> numpy.ndarray
+
+    Builds (n, 4, 4) row major transformation matrices
+    that scale, then rotate, then translate, from (n, 3)
+    positions, (n, 4) quaternions and optional (n, 3) scales
+    """
+    rotation = quaternion_matrices(rotations)
+
+    out = numpy.zeros((len(rotation), 4, 4))
+    out[:, :3, :3] = rotation
+    if scales is not None:
+        out[:, :3, :3] *= numpy.asarray(scales, dtype=numpy.float64).reshape(-1, 1, 3)
+    out[:, :3, 3] = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    out[:, 3, 3] = 1
+    return out
+
+def matrix4x4(position, rotation, scale=None):
+    """
+    matrix4x4(position:Vector, rotation:Quaternion,
+              scale:Vector) -> numpy.ndarray
+
+    Builds a single (4, 4) transformation matrix. See compose
+    """
+    if scale is not None:
+        scale = [list(scale)]
+    return compose([list(position)], [list(rotation)], scale)[0]
+
+def transform_points(matrix, points):
+    """
+    transform_points(matrix, points:numpy.ndarray) -> numpy.ndarray
+
+    Transforms an (n, 3) array of points by a 3x3 or 4x4 matrix
+    (Matrix3x3 or NumPy array), or by an (n, 4, 4) / (n, 3, 3)
+    array with one matrix per point
+    """
+    if isinstance(matrix, Matrix3x3):
+        matrix = matrix.array
+    matrix = numpy.asarray(matrix)
+    points = numpy.asarray(points)
+
+    if matrix.ndim == 3:
+        out = numpy.einsum("nij,nj->ni", matrix[:, :3, :3], points)
+    else:
+        out = numpy.dot(points, matrix[:3, :3].T)
+    if matrix.shape[-1] == 4:
+        out += matrix[..., :3, 3]
+    return out
+
+def transform_directions(matrix, directions):
+    """
+    transform_directions(matrix, directions:numpy.ndarray) -> numpy.ndarray
+
+    Like transform_points but ignores any translation
+    """
+    if isinstance(matrix, Matrix3x3):
+        matrix = matrix.array
+    matrix = numpy.asarray(matrix)[..., :3, :3]
+    return transform_points(matrix, directions)
+
+def frustum_planes(matrix):
+    """
+    frustum_planes(matrix:numpy.ndarray) -> numpy.ndarray
+
+    Extracts the (6, 4) normalised planes (a, b, c, d) of the
+    view frustum of a row major (4, 4) projection * view matrix.
+    Points with a*x + b*y + c*z + d >= 0 are on the inside.
+    Order: left, right, bottom, top, near, far
+    """
+    m = numpy.asarray(matrix, dtype=numpy.float64)
+    planes = numpy.array([m[3] + m[0], m[3] - m[0],
+                          m[3] + m[1], m[3] - m[1],
+                          m[3] + m[2], m[3] - m[2]])
+    return planes / numpy.sqrt((planes[:, :3] ** 2).sum(axis=1))[:, None]
+
+def spheres_in_frustum(planes, centers, radii):
+    """
+    spheres_in_frustum(planes:numpy.ndarray, centers:numpy.ndarray,
+                       radii:numpy.ndarray) -> numpy.ndarray
+
+    Returns which of the (n, 3) spheres are at least
+    partially inside the frustum given by "planes"
+    """
+    distances = numpy.dot(centers, planes[:, :3].T) + planes[:, 3]
+    return (distances >= -numpy.asarray(radii)[:, None]).all(axis=1)
@@ -4,15 +4,88 @@ useful for rendering
 
 #standard
 import abc
+import itertools
+import math
 import traceback
+import types
+import numpy
 from math3d import *
+import simplify
 
 """
 ---OBJECTS---
 """
 
-class Camera():
+#Simplified levels of detail made by Mesh.generate_lods
+LOD_LEVELS = 4
+#Share of the triangles of the level before that every level keeps
+LOD_RATIO = 0.5
+#Meshes aren't simplified below this many triangles
+LOD_MIN_TRIANGLES = 64
+#Triangles a level may have per pixel it covers on screen
+LOD_TRIANGLES_PER_PIXEL = 0.5
+
+#Every change to any Camera or Object gets a new version number,
+#so a version identifies the state it was taken in
+_versions = itertools.count(1)
+
+def extend(instance, methods):
+    """
+    extend(instance:object, methods:dict)
+
+    Binds the renderer specific "methods" (name -> function)
+    to "instance" alone, other instances of its class and
+    other renderers never see them. Names "instance" already
+    has are left alone, so extending it again costs nothing.
+    """
+    attributes = instance.__dict__
+    for name, method in methods.items():
+        if name not in attributes:
+            attributes[name] = types.MethodType(method, instance)
+
+class _Tracked(object):
+    """Base of objects whose derived values are cached until they change.
+    "version" changes whenever any of the tracked attributes does,
+    including changes made in place (like position[2] = 1).
+    """
+    _tracked = ()
+
+    def __setattr__(self, name, value):
+        if name in self._tracked:
+            value = self._track(value)
+        object.__setattr__(self, name, value)
+        if name in self._tracked:
+            self.changed()
+
+    def _track(self, value):
+        #Wrap Vectors and Quaternions so in place changes are noticed
+        if isinstance(value, Quaternion):
+            return TrackedQuaternion(self.changed, value)
+        if isinstance(value, Vector):
+            return TrackedVector(self.changed, value)
+        return value
+
+    def changed(self):
+        """Marks the derived values as out of date"""
+        object.__setattr__(self, "version", next(_versions))
+        object.__setattr__(self, "_cache", {})
+
+    def cached(self, key, function):
+        """Returns function(self), only calling it again after a change"""
+        try:
+            return self._cache[key]
+        except (AttributeError, KeyError):
+            value = function(self)
+            #Cached arrays are shared, they must not be changed
+            if isinstance(value, numpy.ndarray):
+                value.setflags(write=False)
+            self._cache[key] = value
+            return value
+
+class Camera(_Tracked):
     """Holds standard camera info for rendering"""
+    _tracked = "position", "rotation", "fov", "near", "far"
+
     def __init__(self):
         self.position = Vector(0, 0, 0)
         self.rotation = Quaternion.identity
@@ -26,57 +99,371 @@ class Camera():
     def up(self):
         return self.rotation*Vector(0, 1, 0)
 
-class Object():
+    def right(self):
+        return self.rotation*Vector(1, 0, 0)
+
+    def rotation_matrix(self):
+        """Returns the (3, 3) rotation matrix as a NumPy array,
+        whose columns are the right, up and forward axes
+        """
+        return self.cached("rotation_matrix", lambda self: self.rotation.matrix.array)
+
+    def view_projection(self, aspect):
+        """Returns the (4, 4) row major projection * view matrix
+        for an image "aspect" times as wide as it is high.
+        The projection is the same as gluPerspective.
+        """
+        return self.cached(("view_projection", aspect),
+                           lambda self: self._build_view_projection(aspect))
+
+    def _build_view_projection(self, aspect):
+        f = 1.0 / math.tan(math.radians(self.fov) / 2)
+        near, far = self.near, self.far
+        projection = numpy.array([[f / aspect, 0, 0, 0],
+                                  [0, f, 0, 0],
+                                  [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                                  [0, 0, -1, 0]])
+
+        #Rotation (transposed), mirrored z and translation
+        view = numpy.identity(4)
+        view[:3, :3] = self.rotation_matrix().T
+        view[:3, 2] *= -1
+        view[:3, 3] = numpy.dot(view[:3, :3], -numpy.array(list(self.position)))
+
+        return numpy.dot(projection, view)
+
+    def frustum_planes(self, aspect):
+        """Returns the (6, 4) planes of the view frustum
+        (see math3d.frustum_planes)
+        """
+        return self.cached(("frustum_planes", aspect), lambda self:
+                           frustum_planes(self.view_projection(aspect)))
+
+    def projected_areas(self, centers, radii, height):
+        """Returns the number of pixels the (n, 3) "centers" and
+        (n,) "radii" of spheres cover in an image "height" pixels high
+        """
+        offsets = numpy.asarray(centers) - numpy.array(list(self.position))
+        distances = numpy.maximum(numpy.sqrt((offsets ** 2).sum(axis=1)), self.near)
+        scale = height * 0.5 / math.tan(math.radians(self.fov) / 2)
+        return math.pi * (numpy.asarray(radii) / distances * scale) ** 2
+
+class Object(_Tracked):
     """Holds standard object info for rendering"""
-    def __init__(self):
-        self.mesh = None
+    _tracked = "mesh", "scale", "position", "rotation"
+
+    def __init__(self, mesh=None):
+        self.mesh = mesh
         self.material = None
         self.scale = Vector(1, 1, 1)
         self.position = Vector(0, 0, 0)
         self.rotation = Quaternion.identity
 
-class Mesh():
-    """Holds sandard mesh info"""
+    def matrix(self):
+        """Returns the (4, 4) object to world matrix"""
+        return self.cached("matrix", lambda self:
+                           matrix4x4(self.position, self.rotation, self.scale))
+
+class Scene(object):
+    """Holds the Objects to render.
+    Any number of Objects may share the same Mesh.
+    """
+    def __init__(self, objects=()):
+        self.objects = list(objects)
+
+    @classmethod
+    def from_meshes(cls, meshes):
+        """Makes a Scene with one Object at the origin per Mesh"""
+        return cls(Object(mesh) for mesh in meshes)
+
+    @classmethod
+    def wrap(cls, value):
+        """Returns a Scene for a Scene, an Object or a Mesh"""
+        if isinstance(value, Scene):
+            return value
+        if isinstance(value, Mesh):
+            return cls.from_meshes([value])
+        return cls([value])
+
+    def add(self, object):
+        self.objects.append(object)
+        return object
+
+    @property
+    def meshes(self):
+        """Returns every distinct Mesh in the Scene, in order of first use"""
+        meshes = []
+        seen = set()
+        for object in self.objects:
+            if id(object.mesh) not in seen:
+                seen.add(id(object.mesh))
+                meshes.append(object.mesh)
+        return meshes
+
+    def bounding_spheres(self, matrices=None):
+        """Returns the (n, 3) world centers and (n,) radii
+        of the bounding spheres of all Objects
+        """
+        if matrices is None:
+            matrices = self.matrices()
+        centers = transform_points(matrices, [object.mesh.center for object in self.objects])
+        radii = numpy.array([object.mesh.radius for object in self.objects])
+
+        #Grow by the largest scale of each object
+        scales = numpy.sqrt((matrices[:, :3, :3] ** 2).sum(axis=1)).max(axis=1)
+        return centers, radii * scales
+
+    def version(self):
+        """Returns a value that changes whenever any Object
+        is added, removed or moved
+        """
+        return tuple((id(object), object.version) for object in self.objects)
+
+    def matrices(self):
+        """Returns the (n, 4, 4) object to world matrices of all Objects"""
+        version = self.version()
+        if getattr(self, "_matrices_version", None) != version:
+            objects = self.objects
+            self._matrices = compose([list(object.position) for object in objects],
+                                     [list(object.rotation) for object in objects],
+                                     [list(object.scale) for object in objects])
+            self._matrices.setflags(write=False)
+            self._matrices_version = version
+        return self._matrices
+
+    def lods(self, camera, height, spheres=None):
+        """Returns the level of detail of every Object's Mesh to render
+        with "camera" into an image "height" pixels high.
+        "spheres" are the bounding spheres, if already known.
+        """
+        centers, radii = spheres if spheres is not None else self.bounding_spheres()
+        areas = camera.projected_areas(centers, radii, height)
+        return [object.mesh.lod(area) for object, area in zip(self.objects, areas)]
+
+def _array(value, width, dtype):
+    #Coerce any sequence (of sequences) to a contiguous array
+    array = numpy.ascontiguousarray(value, dtype=dtype)
+    if width:
+        return array.reshape(-1, width)
+    return array.reshape(-1)
+
+class Mesh(object):
+    """Holds sandard mesh info
+
+    Data is kept in contiguous arrays that can be
+    uploaded as they are:
+    positions (n, 3) float32, normals (n, 3) float32,
+    uv (n, 2) float32 and indices (m,) int32, where
+    every three indices make up a triangle.
+    """
     def __init__(self):
         self.static = False
-        self.vertices = ()
+        self.positions = ()
         self.normals = ()
         self.uv = ()
-        self.triangles = ()
+        self.indices = ()
+        #Simplified copies, most detailed first. None until generated
+        self.lods = None
+
+    @property
+    def positions(self):
+        return self._positions
+
+    @positions.setter
+    def positions(self, value):
+        self._positions = _array(value, 3, numpy.float32)
+        self.calculate_bounds()
+
+    @property
+    def normals(self):
+        return self._normals
+
+    @normals.setter
+    def normals(self, value):
+        self._normals = _array(value, 3, numpy.float32)
+
+    @property
+    def uv(self):
+        return self._uv
+
+    @uv.setter
+    def uv(self, value):
+        self._uv = _array(value, 2, numpy.float32)
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @indices.setter
+    def indices(self, value):
+        self._indices = _array(value, None, numpy.int32)
+
+    #Per element access, kept as views of the arrays
+    vertices = positions
+    triangles = indices
 
-    def recalculate_normals(self):
-        """Recalculates the normals
-        according to the surface normals
-        of each connected triangle.
+    def calculate_bounds(self):
+        """Recalculates the bounding box (lower, upper)
+        and bounding sphere (center, radius) of the positions
         """
-        normals = []
+        if len(self._positions) == 0:
+            self.lower = self.upper = self.center = numpy.zeros(3, dtype=numpy.float32)
+            self.radius = 0.0
+            return
+
+        self.lower = self._positions.min(axis=0)
+        self.upper = self._positions.max(axis=0)
+        self.center = (self.lower + self.upper) * 0.5
+        offsets = self._positions - self.center
+        self.radius = float(numpy.sqrt((offsets ** 2).sum(axis=1).max()))
+
+    @property
+    def levels(self):
+        """The Mesh itself followed by its simplified levels of detail"""
+        return [self] + (self.lods or [])
+
+    def generate_lods(self, levels=LOD_LEVELS, ratio=LOD_RATIO,
+                      minimum=LOD_MIN_TRIANGLES):
+        """Simplifies the Mesh into up to "levels" levels of detail,
+        each with "ratio" times the triangles of the one before.
+        Stops at "minimum" triangles.
+        """
+        self.lods = []
+        mesh = self
+        for level in range(levels):
+            target = int(len(mesh.indices) // 3 * ratio)
+            if target < minimum:
+                break
+            simplified = mesh.simplified(target)
+            #Nothing more to collapse
+            if len(simplified.indices) >= len(mesh.indices):
+                break
+            self.lods.append(simplified)
+            mesh = simplified
+        return self.lods
+
+    def simplified(self, target):
+        """Returns a copy of the Mesh simplified
+        to at most "target" triangles (see simplify.simplify)
+        """
+        vertices, positions, indices = simplify.simplify(self.positions, self.indices, target)
+
+        mesh = Mesh()
+        mesh.positions = positions
+        if len(self.normals):
+            mesh.normals = self.normals[vertices]
+        if len(self.uv):
+            mesh.uv = self.uv[vertices]
+        mesh.indices = indices
+        return mesh
+
+    def lod(self, pixels):
+        """Returns the most detailed level with at most
+        LOD_TRIANGLES_PER_PIXEL triangles per pixel of "pixels",
+        the area the Mesh covers on screen
+        """
+        levels = self.levels
+        budget = pixels * LOD_TRIANGLES_PER_PIXEL
+        for mesh in levels:
+            if len(mesh.indices) // 3 <= budget:
+                return mesh
+        return levels[-1]
+
+    def recalculate_normals(self, weighting="area", crease_angle=None):
+        """Recalculates the normals from the triangles around every
+        vertex, weighted by their "area" or by their "angle" at the
+        vertex. Vertices at the same position are smoothed together.
+
+        With "crease_angle" (in degrees) set, triangles meeting at a
+        larger angle don't smooth each other, which splits vertices
+        shared by both sides of a crease.
+        """
+        triangles = self._indices.reshape(-1, 3)
+        corners = self._positions[triangles]
+
+        #One pass of face normals, as long as twice the area
+        faces = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        units = _normalized(faces)
+        if weighting == "area":
+            weighted = numpy.repeat(faces, 3, axis=0)
+        elif weighting == "angle":
+            #Angle between the two edges leaving every corner
+            first = numpy.roll(corners, -1, axis=1) - corners
+            second = numpy.roll(corners, -2, axis=1) - corners
+            sine = numpy.sqrt((numpy.cross(first, second) ** 2).sum(axis=2))
+            angles = numpy.arctan2(sine, (first * second).sum(axis=2))
+            weighted = (units[:, None, :] * angles[:, :, None]).reshape(-1, 3)
+        else:
+            raise Exception("Unknown normal weighting: %s" % weighting)
+
+        #Scatter to the positions of all corners
+        group = _unique_rows(self._positions)[2]
+        corner_groups = group[triangles].reshape(-1)
+
+        if crease_angle is None:
+            sums = _scatter_add(corner_groups, weighted, len(self._positions))
+            normals = _normalized(sums[group])
+
+            #Vertices without triangles (or whose triangles cancel out)
+            #keep what they had
+            if len(self._normals) == len(normals):
+                unused = (normals == 0).all(axis=1)
+                normals[unused] = self._normals[unused]
+            self.normals = normals
+            return
 
-        for index in xrange(len(self.vertices)):
-            vertex = self.vertices[index]
-            norms = self._calculate_normals(index)
+        #Pair every corner with all corners at the same position
+        order = numpy.argsort(corner_groups, kind="mergesort")
+        counts = numpy.bincount(corner_groups, minlength=len(self._positions))
+        starts = numpy.cumsum(counts) - counts
+        sizes = counts[corner_groups[order]]
+        corner = numpy.repeat(numpy.arange(len(order)), sizes)
+        other = (starts[corner_groups[order]][corner] +
+                 numpy.arange(len(corner)) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes))
+        corner, other = order[corner], order[other]
 
-            average = Vector3.zero
-            for normal in norms:
-                average += normal
-            if average.magnitude > 0:
-                normals.append(average.normalized)
-            else:
-                normals.append(self.normals[index])
+        #Only triangles within the crease angle of each other smooth
+        corner_units = numpy.repeat(units, 3, axis=0)
+        #(with some tolerance, so 180 degrees smooths everything)
+        smooth = ((corner_units[corner] * corner_units[other]).sum(axis=1) >=
+                  math.cos(math.radians(crease_angle)) - 1e-6)
+        sums = _scatter_add(corner[smooth], weighted[other[smooth]], len(corner_units))
+        normals = _normalized(sums)
+        #Where the triangles cancel out use the corner's own
+        cancelled = (normals == 0).all(axis=1)
+        normals[cancelled] = corner_units[cancelled]
 
-        self.normals = tuple(normals)
+        #Split vertices whose corners ended up with different normals,
+        #numbered in order of first use like ObjImporter does
+        vertices = self._indices.astype(numpy.float64)[:, None]
+        keys, first, inverse = _unique_rows(numpy.hstack([vertices, normals]))
+        order = numpy.argsort(first)
+        rank = numpy.empty(len(order), dtype=numpy.int32)
+        rank[order] = numpy.arange(len(order), dtype=numpy.int32)
+        vertices = self._indices[first[order]]
 
-    def _calculate_normals(self, vertex):
-        triangles = self.triangles
-        vertices = self.vertices
-        out = []
+        self.positions = self._positions[vertices]
+        if len(self._uv):
+            self.uv = self._uv[vertices]
+        self.normals = normals[first[order]]
+        self.indices = rank[inverse.reshape(-1)]
 
-        for index in xrange(len(triangles)/3):
-            index *= 3
+def _unique_rows(array):
+    #numpy.unique(axis=0) with return_index and return_inverse,
+    #many times faster by comparing rows as raw bytes
+    #(adding 0 turns -0.0 into 0.0 so they compare equal)
+    array = numpy.ascontiguousarray(array + array.dtype.type(0))
+    rows = array.view(numpy.dtype((numpy.void, array.dtype.itemsize * array.shape[1])))
+    keys, first, inverse = numpy.unique(rows.reshape(-1), return_index=True,
+                                        return_inverse=True)
+    return keys, first, inverse.reshape(-1)
 
-            if vertex in triangles[index:index + 2]:
-                v1 = vertices[triangles[index]]
-                v2 = vertices[triangles[index + 1]]
-                v3 = vertices[triangles[index + 2]]
-                out.append(Vector3.cross(v2 - v1, v3 - v1))
+def _scatter_add(indices, values, count):
+    #Sums the (n, 3) "values" into "count" rows by "indices"
+    return numpy.stack([numpy.bincount(indices, values[:, axis], count)
+                        for axis in range(3)], axis=1)
 
-        return out
+def _normalized(vectors):
+    #Unit length vectors, zero vectors stay zero
+    lengths = numpy.sqrt((vectors ** 2).sum(axis=1))
+    return vectors / numpy.maximum(lengths, 1e-30)[:, None]
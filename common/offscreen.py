@@ -0,0 +1,132 @@
+"""
+Windowless OpenGL rendering for machines without a display.
+
+An EGL context is created without any surface and renderers
+draw into a framebuffer object instead of a window, so there
+is no vsync or compositor involved in a frame.
+
+PyOpenGL picks its window system when it is first imported,
+so enable() has to be called before anything imports OpenGL.
+"""
+
+import os
+import sys
+import ctypes
+
+def enable():
+    """
+    enable()
+
+    Makes PyOpenGL use EGL. Raises an Exception if
+    OpenGL was already imported for another window system.
+    """
+    if os.environ.get("PYOPENGL_PLATFORM") == "egl":
+        return
+    if "OpenGL.platform" in sys.modules:
+        raise Exception("Offscreen rendering has to be enabled before OpenGL is imported")
+    os.environ["PYOPENGL_PLATFORM"] = "egl"
+
+class Context:
+    """Surfaceless EGL context, made current on creation"""
+    def __init__(self, resolution):
+        enable()
+        #Only import OpenGL once the platform is set
+        from OpenGL import EGL
+        self.width, self.height = resolution
+
+        #Connect to the default GPU, no window system needed
+        self.display = display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise Exception("Could not initialise EGL")
+
+        #Desktop OpenGL (with the fixed function pipeline the renderers use)
+        attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                      EGL.EGL_RED_SIZE, 8,
+                      EGL.EGL_GREEN_SIZE, 8,
+                      EGL.EGL_BLUE_SIZE, 8,
+                      EGL.EGL_DEPTH_SIZE, 24,
+                      EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(display, (EGL.EGLint * len(attributes))(*attributes),
+                                   ctypes.pointer(config), 1, ctypes.pointer(count)) \
+           or count.value == 0:
+            raise Exception("No EGL config supports offscreen OpenGL rendering")
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        if not self.context:
+            raise Exception("Could not create an EGL context")
+
+        #Surfaceless where supported (EGL_KHR_surfaceless_context),
+        #otherwise a pbuffer the size of the image
+        self.surface = EGL.EGL_NO_SURFACE
+        if not EGL.eglMakeCurrent(display, self.surface, self.surface, self.context):
+            size = [EGL.EGL_WIDTH, self.width, EGL.EGL_HEIGHT, self.height, EGL.EGL_NONE]
+            self.surface = EGL.eglCreatePbufferSurface(display, config,
+                                                       (EGL.EGLint * len(size))(*size))
+            if not EGL.eglMakeCurrent(display, self.surface, self.surface, self.context):
+                raise Exception("Could not make the EGL context current")
+
+    def close(self):
+        from OpenGL import EGL
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE,
+                           EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        if self.surface != EGL.EGL_NO_SURFACE:
+            EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+
+class Framebuffer:
+    """Framebuffer object with a color and depth buffer"""
+    def __init__(self, resolution):
+        from OpenGL import GL
+        self.width, self.height = resolution
+
+        #Storage for color and depth
+        self.color, self.depth = GL.glGenRenderbuffers(2)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, self.color)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8,
+                                 self.width, self.height)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, self.depth)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_DEPTH_COMPONENT24,
+                                 self.width, self.height)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, 0)
+
+        #Attach them to a framebuffer
+        self.id = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.id)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0,
+                                     GL.GL_RENDERBUFFER, self.color)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT,
+                                     GL.GL_RENDERBUFFER, self.depth)
+        if GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER) != GL.GL_FRAMEBUFFER_COMPLETE:
+            raise Exception("Offscreen framebuffer is incomplete")
+
+        self.bind()
+
+    def bind(self):
+        from OpenGL import GL
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.id)
+        #A surfaceless context has no default viewport
+        GL.glViewport(0, 0, self.width, self.height)
+
+    def close(self):
+        from OpenGL import GL
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
+        GL.glDeleteFramebuffers(1, [self.id])
+        GL.glDeleteRenderbuffers(2, [self.color, self.depth])
+
+def read_pixels(width, height):
+    """
+    read_pixels(width:int, height:int) -> numpy.ndarray
+
+    Returns the (height, width, 4) float32 image in the bound
+    framebuffer, bottom row first like OpenGL stores it
+    """
+    import numpy
+    from OpenGL import GL
+    pixels = GL.glReadPixels(0, 0, width, height, GL.GL_RGBA, GL.GL_FLOAT)
+    return numpy.asarray(pixels, dtype=numpy.float32).reshape(height, width, 4)
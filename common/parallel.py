@@ -0,0 +1,188 @@
+"""
+Renders frames on every core with a persistent pool of
+worker processes, one tile of the frame at a time.
+
+Workers take the next tile from a shared counter whenever
+they finish one, so expensive parts of the frame (like the
+silhouette of a detailed mesh) are spread over all workers
+instead of holding up whichever one was given them.
+
+Arrays the workers read or write (meshes, framebuffers)
+are kept in shared memory: passing them to a worker
+attaches to the same memory instead of copying it.
+multiprocessing.shared_memory is used where available,
+otherwise sharedctypes.RawArray, which can only be passed
+to workers when they start (like TilePool does).
+"""
+
+import ctypes
+import multiprocessing
+import os
+import traceback
+import numpy
+from multiprocessing import sharedctypes
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+if shared_memory is not None:
+    class _SharedMemory(shared_memory.SharedMemory):
+        #Arrays still using the memory when the interpreter
+        #exits can't let go of it, which is fine then
+        def __del__(self):
+            try:
+                self.close()
+            except BufferError:
+                pass
+
+"""
+   SHARED ARRAYS
+"""
+
+class SharedArray(numpy.ndarray):
+    """NumPy array in shared memory. Pickles to a
+    reference to that memory instead of its contents.
+    Views of it are plain arrays and pickle as usual.
+    """
+    def __array_finalize__(self, obj):
+        self._memory = None
+
+    def __reduce__(self):
+        if self._memory is None:
+            return numpy.ndarray.__reduce__(self)
+        return _attach, (self._memory, self.shape, self.dtype.str)
+
+def empty(shape, dtype):
+    """
+    empty(shape:tuple, dtype) -> SharedArray
+
+    Returns an uninitialised array in shared memory
+    """
+    dtype = numpy.dtype(dtype)
+    size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+    if shared_memory is not None:
+        memory = _SharedMemory(create=True, size=size)
+    else:
+        memory = sharedctypes.RawArray(ctypes.c_char, size)
+    return _attach(memory, shape, dtype.str)
+
+def copy(array):
+    """
+    copy(array:numpy.ndarray) -> SharedArray
+
+    Returns a copy of "array" in shared memory
+    """
+    array = numpy.asarray(array)
+    out = empty(array.shape, array.dtype)
+    out[...] = array
+    return out
+
+def release(array):
+    """
+    release(array:SharedArray)
+
+    Frees the shared memory of "array" once every
+    process using it is done with it. Only call it
+    in the process that made the array.
+    """
+    memory = getattr(array, "_memory", None)
+    if shared_memory is not None and isinstance(memory, shared_memory.SharedMemory):
+        try:
+            memory.unlink()
+        except (IOError, OSError):
+            pass
+
+def _attach(memory, shape, dtype):
+    buffer = memory.buf if shared_memory is not None and \
+        isinstance(memory, shared_memory.SharedMemory) else memory
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    array = numpy.frombuffer(buffer, dtype, count=count).reshape(shape).view(SharedArray)
+    array._memory = memory
+    return array
+
+"""
+   WORKERS
+"""
+
+def cpu_count():
+    """
+    cpu_count() -> int
+
+    Returns the number of cores this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+class TilePool(object):
+    """Worker processes rendering the tiles of frames.
+
+    Every worker gets a copy of "renderer" once, when it starts
+    (SharedArrays in it are attached to, not copied). Then for
+    every run(tiles, state) the workers call
+    renderer.render_tile(tile, state) for every tile in "tiles",
+    each taking the next tile left whenever it is done with one.
+    """
+    def __init__(self, renderer, processes=None):
+        self.processes = int(processes or cpu_count())
+
+        #Index of the next tile nobody took yet
+        self.next_tile = multiprocessing.Value(ctypes.c_long, 0)
+        self.results = multiprocessing.Queue()
+        self.queues = []
+        self.workers = []
+        for index in range(self.processes):
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_work,
+                                             args=(renderer, queue, self.next_tile, self.results))
+            #Never outlive the renderer
+            worker.daemon = True
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    def run(self, tiles, state):
+        """
+        run(tiles:list, state)
+
+        Renders all "tiles" and returns once every one is done.
+        "state" is passed to every worker, it should be small.
+        """
+        #Workers are idle in between, nobody else uses the counter
+        self.next_tile.value = 0
+        for queue in self.queues:
+            queue.put((tiles, state))
+
+        errors = [self.results.get() for worker in self.workers]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise Exception("Rendering tiles failed in a worker:\n" + errors[0])
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def _work(renderer, queue, next_tile, results):
+    #Main loop of worker processes, one frame per message
+    while True:
+        job = queue.get()
+        if job is None:
+            return
+        tiles, state = job
+
+        try:
+            while True:
+                with next_tile.get_lock():
+                    index = next_tile.value
+                    next_tile.value += 1
+                if index >= len(tiles):
+                    break
+                renderer.render_tile(tiles[index], state)
+        except Exception:
+            results.put(traceback.format_exc())
+        else:
+            results.put(None)
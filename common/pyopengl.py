@@ -84,3 +84,31 @@ def QUAD():
     glEnd()
     glEndList()
     return id
+
+class TimerQuery():
+    """Measures the GPU time of the OpenGL commands issued
+    between entering and leaving it (GL_TIME_ELAPSED).
+    Queries can't be nested.
+    """
+    def __init__(self):
+        self.id = glGenQueries(1)
+
+    @classmethod
+    def supported(cls):
+        #Timer queries are core since OpenGL 3.3 (GL_ARB_timer_query)
+        return bool(glGetQueryObjectui64v)
+
+    def __enter__(self):
+        glBeginQuery(GL_TIME_ELAPSED, self.id)
+
+    def __exit__(self, type, value, traceback):
+        glEndQuery(GL_TIME_ELAPSED)
+        return False
+
+    def result(self, wait):
+        #Elapsed nanoseconds, None while the GPU isn't done yet
+        if not wait and not glGetQueryObjectiv(self.id, GL_QUERY_RESULT_AVAILABLE):
+            return None
+        elapsed = int(glGetQueryObjectui64v(self.id, GL_QUERY_RESULT))
+        glDeleteQueries(1, [self.id])
+        return elapsed
@@ -0,0 +1,223 @@
+"""
+Simplifies triangle meshes by quadric edge collapse
+(Garland and Heckbert, "Surface Simplification Using
+Quadric Error Metrics").
+
+Every vertex carries a quadric measuring the squared distance
+to the planes of the triangles around it. Collapsing an edge
+merges its quadrics and moves both ends to the point of least
+error. Collapses are made in passes: each pass picks the
+cheapest edges that share no vertex with each other and
+collapses all of them at once.
+"""
+
+import numpy
+
+#Error weight of the planes keeping open borders in place
+BORDER_WEIGHT = 100.0
+
+def simplify(positions, indices, target):
+    """
+    simplify(positions:numpy.ndarray, indices:numpy.ndarray, target:int)
+        -> (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+
+    Collapses edges of the triangles given by (n, 3) "positions"
+    and (m,) "indices" until at most "target" triangles are left,
+    or nothing can be collapsed without folding the surface over.
+
+    Vertices at the same position (like those along uv or
+    normal seams) move together, so seams stay closed.
+    New positions are always one of the edge's ends or its
+    middle, so the result never outgrows the original bounds.
+
+    Returns the original index of every vertex still in use,
+    their new positions and the new indices into them.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    triangles = numpy.asarray(indices, dtype=numpy.int64).reshape(-1, 3)
+
+    #Collapses work on points, which vertices are mapped to
+    points, group = numpy.unique(positions, axis=0, return_inverse=True)
+    points = points.copy()
+    group = group.reshape(-1)
+    quadrics = __quadrics(points, group[triangles])
+
+    while True:
+        #Triangles collapsed to lines or points are gone
+        corners = group[triangles]
+        alive = __non_degenerate(corners)
+        triangles, corners = triangles[alive], corners[alive]
+
+        excess = len(triangles) - int(target)
+        if excess <= 0:
+            break
+
+        edges = __edges(corners)[0]
+        costs, targets = __edge_costs(points, quadrics, edges)
+        #Every collapse removes about two triangles
+        collapse = __select(edges, costs, (excess + 1) // 2, len(points))
+        collapse = __reject_flips(points, corners, edges, targets, collapse)
+        if not collapse.any():
+            break
+
+        #Move the first end into the second
+        sources, sinks = edges[collapse, 0], edges[collapse, 1]
+        points[sinks] = targets[collapse]
+        quadrics[sinks] += quadrics[sources]
+        parent = numpy.arange(len(points))
+        parent[sources] = sinks
+        group = parent[group]
+
+    #Drop the vertices no triangle uses anymore
+    vertices, indices = numpy.unique(triangles, return_inverse=True)
+    return (vertices, points[group[vertices]].astype(numpy.float32),
+            indices.reshape(-1).astype(numpy.int32))
+
+"""
+   QUADRICS
+"""
+
+def __quadrics(points, corners):
+    #Sum of the area weighted plane quadrics of every point's triangles
+    quadrics = numpy.zeros((len(points), 4, 4))
+
+    planes, areas = __planes(points, corners)
+    face_quadrics = areas[:, None, None] * planes[:, :, None] * planes[:, None, :]
+    for corner in range(3):
+        numpy.add.at(quadrics, corners[:, corner], face_quadrics)
+
+    #Open borders get planes through them at a right angle
+    #to their triangle, so they don't shrink inwards
+    edges, faces, counts = __edges(corners)
+    border = counts == 1
+    edges, faces = edges[border], faces[border]
+    if len(edges):
+        direction = points[edges[:, 1]] - points[edges[:, 0]]
+        normal = numpy.cross(direction, planes[faces, :3])
+        length = numpy.sqrt((normal ** 2).sum(axis=1))
+        valid = length > 0
+        normal = normal[valid] / length[valid][:, None]
+        edges, direction = edges[valid], direction[valid]
+
+        border_planes = numpy.zeros((len(edges), 4))
+        border_planes[:, :3] = normal
+        border_planes[:, 3] = -(normal * points[edges[:, 0]]).sum(axis=1)
+        weights = BORDER_WEIGHT * (direction ** 2).sum(axis=1)
+        border_quadrics = (weights[:, None, None] *
+                           border_planes[:, :, None] * border_planes[:, None, :])
+        for end in range(2):
+            numpy.add.at(quadrics, edges[:, end], border_quadrics)
+
+    return quadrics
+
+def __planes(points, corners):
+    #Unit planes (a, b, c, d) of all triangles and their areas
+    a, b, c = points[corners[:, 0]], points[corners[:, 1]], points[corners[:, 2]]
+    normal = numpy.cross(b - a, c - a)
+    length = numpy.sqrt((normal ** 2).sum(axis=1))
+    normal /= numpy.maximum(length, 1e-30)[:, None]
+
+    planes = numpy.zeros((len(corners), 4))
+    planes[:, :3] = normal
+    planes[:, 3] = -(normal * a).sum(axis=1)
+    return planes, length * 0.5
+
+def __error(quadrics, points):
+    #v^T Q v for homogeneous points v
+    v = numpy.ones((len(points), 4))
+    v[:, :3] = points
+    return numpy.einsum("ki,kij,kj->k", v, quadrics, v)
+
+"""
+   EDGE COLLAPSES
+"""
+
+def __non_degenerate(corners):
+    return ((corners[:, 0] != corners[:, 1]) &
+            (corners[:, 1] != corners[:, 2]) &
+            (corners[:, 2] != corners[:, 0]))
+
+def __edges(corners):
+    #Every distinct edge as (low, high) point pairs,
+    #a triangle it belongs to and how many it belongs to
+    edges = numpy.concatenate([corners[:, [0, 1]], corners[:, [1, 2]], corners[:, [2, 0]]])
+    edges.sort(axis=1)
+    faces = numpy.tile(numpy.arange(len(corners)), 3)
+    edges, first, counts = numpy.unique(edges, axis=0, return_index=True,
+                                        return_counts=True)
+    return edges, faces[first], counts
+
+def __edge_costs(points, quadrics, edges):
+    #Error of collapsing every edge to the best of its two ends and middle
+    quadric = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    start, end = points[edges[:, 0]], points[edges[:, 1]]
+    candidates = numpy.stack([start, end, (start + end) * 0.5])
+
+    errors = numpy.stack([__error(quadric, candidate) for candidate in candidates])
+    best = errors.argmin(axis=0)
+    index = numpy.arange(len(edges))
+    return errors[best, index], candidates[best, index]
+
+def __select(edges, costs, limit, point_count):
+    #Edges cheaper than every other edge at both of their ends
+    #never share a point, so they can all be collapsed. Repeating
+    #that on the edges left over picks about what collapsing the
+    #cheapest edges one by one would.
+    order = numpy.argsort(costs, kind="mergesort")
+    rank = numpy.empty(len(order), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(order))
+
+    collapse = numpy.zeros(len(edges), dtype=bool)
+    taken = numpy.zeros(point_count, dtype=bool)
+    candidates = numpy.arange(len(edges))
+    while len(candidates) and collapse.sum() < limit:
+        start, end = edges[candidates, 0], edges[candidates, 1]
+        cheapest = numpy.full(point_count, len(order), dtype=numpy.int64)
+        numpy.minimum.at(cheapest, start, rank[candidates])
+        numpy.minimum.at(cheapest, end, rank[candidates])
+        selected = ((cheapest[start] == rank[candidates]) &
+                    (cheapest[end] == rank[candidates]))
+
+        #Only the cheapest of them while the target isn't reached
+        chosen = candidates[selected]
+        chosen = chosen[numpy.argsort(rank[chosen])[:limit - collapse.sum()]]
+        collapse[chosen] = True
+        taken[edges[chosen].reshape(-1)] = True
+        candidates = candidates[~(taken[start] | taken[end])]
+
+    return collapse
+
+def __reject_flips(points, corners, edges, targets, collapse):
+    #Drop collapses that turn a remaining triangle over,
+    #until none of them do
+    old_normals = __normals(points, corners)
+    while collapse.any():
+        chosen = numpy.nonzero(collapse)[0]
+        moved = points.copy()
+        moved[edges[chosen, 0]] = targets[chosen]
+        moved[edges[chosen, 1]] = targets[chosen]
+        parent = numpy.arange(len(points))
+        parent[edges[chosen, 0]] = edges[chosen, 1]
+
+        #Collapse of every point, -1 for points staying where they are
+        owner = numpy.full(len(points), -1, dtype=numpy.int64)
+        owner[edges[chosen, 0]] = chosen
+        owner[edges[chosen, 1]] = chosen
+
+        new_corners = parent[corners]
+        changed = (owner[corners] >= 0).any(axis=1) & __non_degenerate(new_corners)
+        #Triangles without an area have no side to flip to
+        changed &= (old_normals != 0).any(axis=1)
+        new_normals = __normals(moved, new_corners[changed])
+        flipped = (old_normals[changed] * new_normals).sum(axis=1) <= 0
+        if not flipped.any():
+            break
+
+        bad = owner[corners[changed][flipped]].reshape(-1)
+        collapse[bad[bad >= 0]] = False
+
+    return collapse
+
+def __normals(points, corners):
+    a, b, c = points[corners[:, 0]], points[corners[:, 1]], points[corners[:, 2]]
+    return numpy.cross(b - a, c - a)
@@ -0,0 +1,230 @@
+"""
+Timing helpers for benchmarking: a monotonic
+nanosecond clock, summary statistics over
+recorded frame times and per frame breakdowns
+of where the time of a frame goes (Profiler).
+"""
+
+import ctypes
+import ctypes.util
+import math
+import sys
+import time
+import timeit
+import numpy
+
+#z value of a two sided 95% confidence interval
+Z95 = 1.959963984540054
+#clock_gettime ids of CLOCK_MONOTONIC
+CLOCK_MONOTONIC = {"linux" : 1, "darwin" : 6}
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _clock_gettime_ns():
+    #Python 2 has no monotonic clock of its own, so
+    #CLOCK_MONOTONIC is read through ctypes where there is one
+    clock = CLOCK_MONOTONIC.get(sys.platform.rstrip("0123456789"))
+    if clock is None:
+        return None
+    for name in ("c", "rt"):
+        path = ctypes.util.find_library(name)
+        try:
+            clock_gettime = ctypes.CDLL(path).clock_gettime
+        except (OSError, AttributeError, TypeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        spec = _timespec()
+        if clock_gettime(clock, ctypes.byref(spec)) != 0:
+            return None
+
+        def clock_ns():
+            clock_gettime(clock, ctypes.byref(spec))
+            return spec.tv_sec * 1000000000 + spec.tv_nsec
+        return clock_ns
+    return None
+
+def _perf_counter_ns():
+    #time.clock (QueryPerformanceCounter) on Windows, but time.time
+    #elsewhere, which is wall time and jumps when the clock is set
+    return int(timeit.default_timer() * 1e9)
+
+#Highest resolution monotonic clock available, in nanoseconds.
+#Only falls back to a clock that isn't monotonic (_perf_counter_ns)
+#on Python 2 without clock_gettime outside of Windows
+clock_ns = (getattr(time, "perf_counter_ns", None) or
+            _clock_gettime_ns() or _perf_counter_ns)
+
+def summarize(frame_times_ns):
+    """
+    summarize(frame_times_ns:[int,]) -> dict
+
+    Returns statistics over frame times (in nanoseconds)
+    in milliseconds: mean, median, p95, p99, min, max,
+    standard deviation and 95% confidence intervals of the
+    mean and the median. "fps" is derived from the mean
+    frame time rather than averaging per frame rates.
+    """
+    times = numpy.asarray(frame_times_ns, dtype=numpy.float64) / 1e6
+    count = len(times)
+    if count == 0:
+        return {"frames" : 0}
+
+    mean = float(times.mean())
+    stdev = float(times.std(ddof=1)) if count > 1 else 0.0
+    margin = Z95 * stdev / math.sqrt(count)
+
+    #Distribution free interval of the median from order statistics
+    ordered = numpy.sort(times)
+    spread = Z95 * math.sqrt(count) / 2
+    low = max(int(math.floor(count / 2.0 - spread)), 0)
+    high = min(int(math.ceil(count / 2.0 + spread)), count - 1)
+
+    return {
+        "frames" : count,
+        "mean_ms" : mean,
+        "median_ms" : float(numpy.median(times)),
+        "p95_ms" : float(numpy.percentile(times, 95)),
+        "p99_ms" : float(numpy.percentile(times, 99)),
+        "min_ms" : float(ordered[0]),
+        "max_ms" : float(ordered[-1]),
+        "stdev_ms" : stdev,
+        "mean_ci95_ms" : [mean - margin, mean + margin],
+        "median_ci95_ms" : [float(ordered[low]), float(ordered[high])],
+        "fps" : 1000.0 / mean if mean > 0 else float("inf"),
+    }
+
+def summarize_phases(records):
+    """
+    summarize_phases(records:[dict,]) -> dict
+
+    Returns the mean milliseconds per frame of every host and
+    device phase in Profiler records. Phases missing from a
+    frame count as 0 for it.
+    """
+    count = len(records)
+    summary = {"host_ms" : {}, "device_ms" : {}}
+    for kind in ("host", "device"):
+        for record in records:
+            for name, ns in record[kind + "_ns"].items():
+                means = summary[kind + "_ms"]
+                means[name] = means.get(name, 0.0) + ns / 1e6 / count
+    return summary
+
+"""
+   PROFILING
+"""
+
+class Profiler(object):
+    """Records where the time of every frame goes.
+
+    Renderers wrap the phases of a frame in phase(name), timed
+    on the host. A phase can also be timed on the device by a
+    "timer" (a context manager with result(wait) -> ns or None
+    while the device isn't done, like pyopengl.TimerQuery), and
+    work queued on the device is added by device(name, resolve),
+    "resolve" being a function like result. Device times are
+    collected at the end of later frames, so profiling never
+    waits for the device in the middle of a frame.
+
+    Host times are measured with clock_ns, see there for the
+    clocks it can fall back to.
+
+    records() returns every frame since the last reset() as
+    {"frame" : int, "host_ns" : {phase : ns}, "device_ns" : {phase : ns}},
+    phases timed more than once in a frame are summed up.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.frame = 0
+        self.current = None
+        self.frames = []
+        #(record, name, resolve) of device times not known yet
+        self.pending = []
+
+    def begin_frame(self):
+        self.current = {"frame" : self.frame, "host_ns" : {}, "device_ns" : {}}
+        self.frames.append(self.current)
+        self.frame += 1
+
+    def end_frame(self):
+        self.current = None
+        self.collect(False)
+
+    def phase(self, name, timer=None):
+        """Returns a context manager timing "name" (see class)"""
+        if self.current is None:
+            return _NO_PHASE
+        return _Phase(self, name, timer() if timer is not None else None)
+
+    def host(self, name, ns):
+        self.__add(self.current, "host_ns", name, ns)
+
+    def device(self, name, resolve):
+        if self.current is not None:
+            self.pending.append((self.current, name, resolve))
+
+    def collect(self, wait=True):
+        """Adds the device times known by now, all of them if "wait" is set"""
+        pending = []
+        for record, name, resolve in self.pending:
+            ns = resolve(wait)
+            if ns is None:
+                pending.append((record, name, resolve))
+            else:
+                self.__add(record, "device_ns", name, ns)
+        self.pending = pending
+
+    def records(self):
+        """Returns the records of every frame, waiting for the device"""
+        self.collect(True)
+        return self.frames
+
+    def reset(self):
+        """Forgets every frame so far, like warmup frames"""
+        self.collect(True)
+        self.frames = []
+
+    def __add(self, record, kind, name, ns):
+        if record is not None:
+            times = record[kind]
+            times[name] = times.get(name, 0) + int(ns)
+
+class NullProfiler(Profiler):
+    """Profiler recording nothing, at next to no cost"""
+    enabled = False
+
+    def begin_frame(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+class _Phase(object):
+    #Times the host and optionally the device between enter and exit
+    def __init__(self, profiler, name, timer):
+        self.profiler = profiler
+        self.name = name
+        self.timer = timer
+
+    def __enter__(self):
+        if self.timer is not None:
+            self.timer.__enter__()
+        self.start = clock_ns()
+
+    def __exit__(self, type, value, traceback):
+        self.profiler.host(self.name, clock_ns() - self.start)
+        if self.timer is not None:
+            self.timer.__exit__(type, value, traceback)
+            self.profiler.device(self.name, self.timer.result)
+        return False
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+_NO_PHASE = _NoPhase()
@@ -1,6 +1,11 @@
 import pygame
 import OpenGL
+import ctypes
+import numpy
 import common.objects
+import common.math3d
+import common.offscreen
+from common import timing
 from OpenGL.GL import *
 from OpenGL.GL.ARB.framebuffer_object import *
 from OpenGL.GLU import *
@@ -9,7 +14,8 @@ from common.pyopengl import *
 """
    EXTENTION METHODS
 """
-#Set renderer specific object methods. Makes code cleaner
+#Renderer specific object methods, bound to the objects
+#the renderer uses (see common.objects.extend). Makes code cleaner
 
 #Extension method for Mesh objects
 #Generates a OpenGL List Object for the mesh
@@ -31,44 +37,127 @@ def _Mesh__generate_glList(self):
 
     #end defining a list object
     glEndList()
-#Apply extension method
-common.objects.Mesh.generate_glList = _Mesh__generate_glList
+
+#Extension method for Mesh objects
+#Uploads the mesh into buffer objects for indexed drawing
+def _Mesh__generate_glBuffers(self):
+    #Interleave positions and normals into one vertex buffer
+    vertices = numpy.zeros((len(self.positions), 6), dtype=numpy.float32)
+    vertices[:, :3] = self.positions
+    if len(self.normals) != 0:
+        vertices[:, 3:] = self.normals
+
+    #Upload vertex data
+    self.vertex_buffer = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+    glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+
+    #Upload index data
+    self.index_buffer = glGenBuffers(1)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
+    self.index_count = len(self.indices)
+
+    #Record the buffer layout in a vertex array object where supported
+    self.vertex_array = None
+    if bool(glGenVertexArrays):
+        self.vertex_array = glGenVertexArrays(1)
+        glBindVertexArray(self.vertex_array)
+        self.bind_glBuffers()
+        glBindVertexArray(0)
+
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+#Extension method for Mesh objects
+#Points the fixed function vertex attributes at the buffer objects
+def _Mesh__bind_glBuffers(self):
+    glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+
+    #Position and normal are interleaved, 24 bytes per vertex
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(3, GL_FLOAT, 24, ctypes.c_void_p(0))
+    glEnableClientState(GL_NORMAL_ARRAY)
+    glNormalPointer(GL_FLOAT, 24, ctypes.c_void_p(12))
+
+#Extension method for Mesh objects
+#Draws the mesh from its buffer objects
+def _Mesh__draw_glBuffers(self):
+    if self.vertex_array is not None:
+        glBindVertexArray(self.vertex_array)
+    else:
+        self.bind_glBuffers()
+
+    glDrawElements(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, ctypes.c_void_p(0))
+
+    if self.vertex_array is not None:
+        glBindVertexArray(0)
+    else:
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisableClientState(GL_NORMAL_ARRAY)
+
+#Extension method for Camera objects
+#Returns the row major projection * view matrix
+def _Camera__get_glMatrix(self, aspect):
+    #Shared with the software rasterizer
+    return self.view_projection(aspect)
 
 #Extension method for Camera objects
-#Sets projection matrix
-def _Camera__apply_glMatrix(self):
-    #calculate aspect ratio
-    width, height = pygame.display.get_surface().get_size()
-
-    glLoadIdentity()
-    #Set perspective matrix
-    gluPerspective(self.fov, float(width)/float(height), self.near, self.far)
-
-    #Apply rotation matrix
-    rt = self.rotation.matrix
-    matrix = [rt[0], rt[1], rt[2], 0,
-              rt[3], rt[4], rt[5], 0,
-              rt[6], rt[7], rt[8], 0,
-              0,     0,     0,     1]
-    glMultMatrixf(matrix)
-    glScalef(1, 1, -1)
-    #Apply translation
-    glTranslatef(*-self.position)
-#Apply extension method
-common.objects.Camera.apply_glMatrix = _Camera__apply_glMatrix
+#Sets projection matrix for an image of the given aspect ratio
+def _Camera__apply_glMatrix(self, aspect):
+    #OpenGL expects column major matrices
+    matrix = self.cached(("gl_matrix_columns", aspect), lambda self:
+        numpy.ascontiguousarray(self.get_glMatrix(aspect).T, dtype=numpy.float32))
+    glLoadMatrixf(matrix)
+
+#Extension methods of every Mesh (and level of detail) and Camera drawn
+MESH_METHODS = {"generate_glList" : _Mesh__generate_glList,
+                "generate_glBuffers" : _Mesh__generate_glBuffers,
+                "bind_glBuffers" : _Mesh__bind_glBuffers,
+                "draw_glBuffers" : _Mesh__draw_glBuffers}
+CAMERA_METHODS = {"get_glMatrix" : _Camera__get_glMatrix,
+                  "apply_glMatrix" : _Camera__apply_glMatrix}
 
 """
    MAIN CLASS
 """
 
+#Ways of submitting geometry
+#list:    compiled display lists (fixed function immediate mode)
+#buffers: vertex/element buffer objects drawn with glDrawElements
+DRAW_MODES = "list", "buffers"
+
 class Rasterizer:
-    """Deferred Rastorizor"""
+    """Deferred Rastorizor
+
+    With "offscreen" set, renders into a framebuffer object
+    of a surfaceless EGL context instead of a window.
+    common.offscreen.enable() has to be called before
+    this module is imported for that to work.
+
+    Meshes with levels of detail (see Mesh.generate_lods)
+    are drawn at the level fitting their size on screen.
+
+    With "profile" set, "profiler" records the host time of every
+    phase of a frame and the GPU time of drawing the objects
+    (GL_TIME_ELAPSED queries).
+    """
 
     """
        INITIALIZATION
     """
-    def __init__(self, resolution, object):
-        #Setup the pygame screen
+    def __init__(self, resolution, scene, draw_mode="list", frustum_culling=True,
+                 offscreen=False, profile=False):
+        if draw_mode not in DRAW_MODES:
+            raise Exception("Unknown draw mode: %s" % draw_mode)
+        self.draw_mode = draw_mode
+        self.frustum_culling = frustum_culling
+        self.width, self.height = resolution
+        self.offscreen = offscreen
+        self.profiler = timing.Profiler() if profile else timing.NullProfiler()
+
+        #Setup the pygame screen (or offscreen framebuffer)
         self.set_display(resolution)
 
         #set opengl global parameters
@@ -76,14 +165,20 @@ class Rasterizer:
         #load glsl shaders
         self.load_shaders()
 
-        #Add object
-        object.generate_glList()
-        self.object = object
+        #Add objects
+        self.scene = common.objects.Scene.wrap(scene)
+        self.load_scene()
 
         #Print OpenGL version
         print "Using OpenGL version: " + glGetString(GL_VERSION)
 
     def set_display(self, resolution):
+        if self.offscreen:
+            #Windowless context rendering into a framebuffer object
+            self.context = common.offscreen.Context(resolution)
+            self.framebuffer = common.offscreen.Framebuffer(resolution)
+            return
+
         #initialize pygame display and set the pygame display mode appropriately
         pygame.display.init()
         pygame.display.set_mode(resolution, pygame.OPENGL|pygame.DOUBLEBUF)
@@ -93,6 +188,9 @@ class Rasterizer:
         glEnable(GL_CULL_FACE) #face culling
         glClearColor(0.0, 0.0, 0.0, 0.0)
 
+        #GPU time of drawing, when profiling
+        self.gl_timer = TimerQuery if self.profiler.enabled and TimerQuery.supported() else None
+
     def load_shaders(self):
         #Load shader objects from Hardcoded shader paths
         vertex = Shader("rasterized/shader.vert")
@@ -102,28 +200,107 @@ class Rasterizer:
         self.shader = ShaderProgram(vertex.id, fragment.id)
         glUseProgram(self.shader.id)
 
+    def load_scene(self):
+        #Upload every distinct mesh (and its levels of detail) once
+        for mesh in self.scene.meshes:
+            for level in mesh.levels:
+                common.objects.extend(level, MESH_METHODS)
+                if self.draw_mode == "buffers":
+                    level.generate_glBuffers()
+                else:
+                    level.generate_glList()
+
+        self.load_instances()
+
+    def load_instances(self):
+        #Place every object in the world. Call again after moving objects
+        #OpenGL expects column major matrices
+        matrices = self.scene.matrices()
+        self.object_matrices = numpy.ascontiguousarray(matrices.transpose(0, 2, 1),
+                                                       dtype=numpy.float32)
+
+        #World bounding spheres for frustum culling
+        self.centers, self.radii = self.scene.bounding_spheres(matrices)
+        self.visible = numpy.ones(len(self.scene.objects), dtype=bool)
+        self.culled_version = None
+        self.lod_version = None
+
     """
        RUNTIME
     """
 
     #render with camera
     def render(self, camera):
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        profiler = self.profiler
+        profiler.begin_frame()
+
+        with profiler.phase("clear", self.gl_timer):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
         #Setup camera projection matrix
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
-        camera.apply_glMatrix()
+        common.objects.extend(camera, CAMERA_METHODS)
+        camera.apply_glMatrix(float(self.width)/float(self.height))
 
         #Set camera forward uniform
         pos = camera.position
         #glUniform3f(self.shader.camera_position, pos.z, pos.y, pos.x)
 
-        #Draw object
-        glCallList(self.object.listid)
+        #Only draw objects inside the view frustum
+        with profiler.phase("cull"):
+            if self.frustum_culling:
+                self.cull(camera)
+            self.select_lods(camera)
+
+        #Draw objects
+        with profiler.phase("draw", self.gl_timer):
+            glMatrixMode(GL_MODELVIEW)
+            for index in numpy.nonzero(self.visible)[0]:
+                glLoadMatrixf(self.object_matrices[index])
+                self.draw_mesh(self.object_meshes[index])
+
+        with profiler.phase("present"):
+            self.present()
+
+        profiler.end_frame()
+
+    def present(self):
+        if self.offscreen:
+            #Nothing to show, just wait for the frame to be done
+            glFinish()
+        else:
+            #Flip front and back buffers
+            pygame.display.flip()
+
+    def read_pixels(self):
+        #Returns the rendered (height, width, 4) image, bottom row first
+        return common.offscreen.read_pixels(self.width, self.height)
+
+    def cull(self, camera):
+        #Nothing to do while neither the camera nor the objects moved
+        if self.culled_version == camera.version:
+            return
+        self.culled_version = camera.version
+
+        #Test all bounding spheres against the frustum planes at once
+        aspect = float(self.width)/float(self.height)
+        planes = camera.frustum_planes(aspect)
+        self.visible = common.math3d.spheres_in_frustum(planes, self.centers, self.radii)
+
+    def select_lods(self, camera):
+        #Levels only change when the camera moves
+        if self.lod_version == camera.version:
+            return
+        self.lod_version = camera.version
+        self.object_meshes = self.scene.lods(camera, self.height,
+                                             (self.centers, self.radii))
 
-        #Flip front and back buffers
-        pygame.display.flip()
+    def draw_mesh(self, mesh):
+        if self.draw_mode == "buffers":
+            mesh.draw_glBuffers()
+        else:
+            glCallList(mesh.listid)
 
     """
        CLEANUP
@@ -131,5 +308,9 @@ class Rasterizer:
 
     def close(self):
         #cleanup after ourselves
-        pygame.quit()
+        if self.offscreen:
+            self.framebuffer.close()
+            self.context.close()
+        else:
+            pygame.quit()
         #Drivers should be smart enough to clean up the mess we left
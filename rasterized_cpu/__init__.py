@@ -0,0 +1,355 @@
+import numpy
+import common.objects
+from common import math3d
+
+"""
+   CONSTANTS
+"""
+
+#Colour of pixels nothing is drawn to, like glClearColor
+CLEAR = numpy.array([0, 0, 0, 0], dtype=numpy.float32)
+#Normal of vertices without one, like OpenGL's current normal
+DEFAULT_NORMAL = numpy.array([0, 0, 1], dtype=numpy.float32)
+
+#Pixels rasterized together (TILE_SIZE x TILE_SIZE)
+TILE_SIZE = 16
+#Upper limit of pixel/triangle pairs tested in one go
+BATCH_SIZE = 1 << 20
+
+"""
+   GEOMETRY
+"""
+
+def clip_near(vertices):
+    """
+    clip_near(vertices:numpy.ndarray) -> numpy.ndarray
+
+    Clips (n, 3, k) triangles, whose corners start with their
+    (x, y, z, w) clip space position, against the near plane
+    (z >= -w). The other attributes are interpolated along.
+    Triangles partly behind it become one or two triangles,
+    winding is kept. Other planes are left to the rasterizer.
+    """
+    distance = vertices[:, :, 2] + vertices[:, :, 3]
+    inside = distance >= 0
+    count = inside.sum(axis=1)
+
+    out = [vertices[count == 3]]
+    for corners_in in (1, 2):
+        triangles = vertices[count == corners_in]
+        if len(triangles) == 0:
+            continue
+        d = distance[count == corners_in]
+
+        #Rotate the odd corner out to the front, keeping the winding
+        odd = numpy.argmax(inside[count == corners_in] == (corners_in == 1), axis=1)
+        order = (odd[:, None] + numpy.arange(3)) % 3
+        rows = numpy.arange(len(triangles))[:, None]
+        a, b, c = numpy.rollaxis(triangles[rows, order], 1)
+        da, db, dc = numpy.rollaxis(d[rows, order], 1)
+
+        #Points where the edges leaving "a" cross the plane
+        ab = a + (b - a) * (da / (da - db))[:, None]
+        ac = a + (c - a) * (da / (da - dc))[:, None]
+        if corners_in == 1:
+            out.append(numpy.stack([a, ab, ac], axis=1))
+        else:
+            out.append(numpy.stack([ab, b, c], axis=1))
+            out.append(numpy.stack([ab, c, ac], axis=1))
+
+    return numpy.concatenate(out)
+
+def setup(vertices, width, height):
+    """
+    setup(vertices:numpy.ndarray, width:int, height:int) -> tuple
+
+    Projects clipped (n, 3, 4) clip space triangles to an image
+    of width x height pixels, bottom row first, and culls back faces
+    like GL_CULL_FACE (counter clockwise triangles are in front).
+
+    Returns the indices of the remaining triangles, their (n, 3)
+    inverse w, their (n, 3, 3) edge functions (rows giving the
+    barycentric coordinates as a * x + b * y + c), their
+    (n, 3) depth planes (depth as a * x + b * y + c) and
+    their (n, 2, 2) screen bounds ((left, bottom), (right, top)).
+    """
+    inverse_w = 1.0 / vertices[:, :, 3]
+    x = (vertices[:, :, 0] * inverse_w + 1) * (width * 0.5)
+    y = (vertices[:, :, 1] * inverse_w + 1) * (height * 0.5)
+    depth = vertices[:, :, 2] * inverse_w * 0.5 + 0.5
+
+    #Twice the signed area, positive for front faces
+    area = ((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) -
+            (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+    front = numpy.nonzero(area > 0)[0]
+    x, y, depth, area = x[front], y[front], depth[front], area[front]
+
+    #Edge function of the edge opposite every corner,
+    #scaled to be 1 at that corner and 0 along the edge
+    edges = numpy.empty((len(front), 3, 3))
+    for corner in range(3):
+        start, end = (corner + 1) % 3, (corner + 2) % 3
+        edges[:, corner, 0] = y[:, start] - y[:, end]
+        edges[:, corner, 1] = x[:, end] - x[:, start]
+        edges[:, corner, 2] = x[:, start] * y[:, end] - x[:, end] * y[:, start]
+    edges /= area[:, None, None]
+
+    planes = numpy.einsum("nij,ni->nj", edges, depth)
+    bounds = numpy.stack([numpy.stack([x.min(axis=1), y.min(axis=1)], axis=1),
+                          numpy.stack([x.max(axis=1), y.max(axis=1)], axis=1)], axis=1)
+    return front, inverse_w[front], edges, planes, bounds
+
+def bin_triangles(bounds, width, height, tile_size):
+    """
+    bin_triangles(bounds:numpy.ndarray, width:int, height:int,
+                  tile_size:int) -> (numpy.ndarray, numpy.ndarray)
+
+    Sorts triangles into the screen tiles their bounding box
+    overlaps. Returns the triangles ordered by tile and the
+    offset of every tile's triangles in that order (with one
+    extra offset at the end). Tiles are numbered row by row.
+    """
+    columns = (width + tile_size - 1) // tile_size
+    rows = (height + tile_size - 1) // tile_size
+
+    #Tiles overlapped by the (on screen part of the) bounding box
+    lower = numpy.floor(bounds[:, 0] / tile_size)
+    upper = numpy.floor(bounds[:, 1] / tile_size)
+    left = numpy.clip(lower[:, 0], 0, columns).astype(numpy.int64)
+    right = numpy.clip(upper[:, 0], -1, columns - 1).astype(numpy.int64)
+    bottom = numpy.clip(lower[:, 1], 0, rows).astype(numpy.int64)
+    top = numpy.clip(upper[:, 1], -1, rows - 1).astype(numpy.int64)
+    spans = numpy.maximum(right - left + 1, 0)
+    counts = spans * numpy.maximum(top - bottom + 1, 0)
+
+    #One (tile, triangle) pair per tile of every triangle
+    triangles = numpy.repeat(numpy.arange(len(counts)), counts)
+    index = numpy.arange(len(triangles)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    spans = spans[triangles]
+    tiles = ((bottom[triangles] + index // numpy.maximum(spans, 1)) * columns +
+             left[triangles] + index % numpy.maximum(spans, 1))
+
+    #Stable, so triangles stay in drawing order within tiles
+    order = numpy.argsort(tiles, kind="mergesort")
+    offsets = numpy.searchsorted(tiles[order], numpy.arange(columns * rows + 1))
+    return triangles[order], offsets
+
+"""
+   MAIN CLASS
+"""
+
+class CpuRasterizer:
+    """Deferred Rasterizer running on the CPU with NumPy.
+    Draws the same image as rasterized.Rasterizer (normals
+    as colours, see shader.frag) from the same projection,
+    without needing OpenGL or a window.
+
+    Triangles are binned into screen tiles and every tile
+    is rasterized with edge functions against its part of
+    the depth buffer. Only the closest triangle of every
+    pixel is shaded, once all of them are drawn.
+    """
+
+    """
+       INITIALISATION
+    """
+    def __init__(self, resolution, scene, tile_size=TILE_SIZE, frustum_culling=True,
+                 face_culling=True):
+        self.width, self.height = resolution
+        self.tile_size = int(tile_size)
+        self.frustum_culling = frustum_culling
+        self.face_culling = face_culling
+
+        #create the framebuffer we render to
+        self.create_framebuffer()
+
+        self.scene = common.objects.Scene.wrap(scene)
+        self.load_scene()
+
+    def create_framebuffer(self):
+        #Rows are stored bottom up, like OpenGL does
+        self.framebuffer = numpy.zeros((self.height, self.width, 4),
+                                       dtype=numpy.float32)
+
+        #Depth and closest triangle of every pixel
+        self.depth = numpy.empty((self.height, self.width))
+        self.triangle = numpy.empty((self.height, self.width), dtype=numpy.int64)
+
+        #Pixel centers of every column and row
+        self.screen_x = numpy.arange(self.width) + 0.5
+        self.screen_y = numpy.arange(self.height) + 0.5
+
+    def load_scene(self):
+        #Homogeneous positions and normals of every mesh (and level of detail)
+        self.vertices = {}
+        for mesh in self.scene.meshes:
+            for level in mesh.levels:
+                positions = numpy.ones((len(level.positions), 4))
+                positions[:, :3] = level.positions
+                normals = level.normals
+                if len(normals) != len(positions):
+                    normals = numpy.tile(DEFAULT_NORMAL, (len(positions), 1))
+                self.vertices[id(level)] = positions, normals, level.indices
+
+        self.load_instances()
+
+    def load_instances(self):
+        #Place every object in the world. Call again after moving objects
+        self.matrices = self.scene.matrices()
+        #Normals transform like gl_NormalMatrix. The modelview matrix of
+        #the OpenGL rasterizer is the object matrix alone (the camera is
+        #in the projection matrix), so that takes them to world space
+        self.normal_matrices = numpy.linalg.inv(self.matrices[:, :3, :3]).transpose(0, 2, 1)
+
+        #World bounding spheres for frustum culling
+        self.centers, self.radii = self.scene.bounding_spheres(self.matrices)
+        self.visible = numpy.ones(len(self.scene.objects), dtype=bool)
+        self.culled_version = None
+        self.lod_version = None
+
+    """
+       RUNTIME
+    """
+
+    def render(self, camera):
+        aspect = float(self.width) / float(self.height)
+        if self.frustum_culling:
+            self.cull(camera, aspect)
+        self.select_lods(camera)
+
+        vertices = self.transform(camera.view_projection(aspect))
+        self.depth.fill(numpy.inf)
+        self.triangle.fill(-1)
+        if len(vertices):
+            self.rasterize(vertices)
+        return self.framebuffer
+
+    def cull(self, camera, aspect):
+        #Nothing to do while neither the camera nor the objects moved
+        if self.culled_version == camera.version:
+            return
+        self.culled_version = camera.version
+
+        planes = camera.frustum_planes(aspect)
+        self.visible = math3d.spheres_in_frustum(planes, self.centers, self.radii)
+
+    def select_lods(self, camera):
+        #Levels only change when the camera moves
+        if self.lod_version == camera.version:
+            return
+        self.lod_version = camera.version
+        self.object_meshes = self.scene.lods(camera, self.height,
+                                             (self.centers, self.radii))
+
+    def transform(self, view_projection):
+        #Clip space corners of every visible object's triangles
+        #with their world space normals, in drawing order
+        triangles = []
+        for index in numpy.nonzero(self.visible)[0]:
+            positions, normals, indices = self.vertices[id(self.object_meshes[index])]
+            clip = numpy.dot(positions, numpy.dot(view_projection, self.matrices[index]).T)
+            normals = numpy.dot(normals, self.normal_matrices[index].T)
+            triangles.append(numpy.concatenate([clip, normals], axis=1)[indices].reshape(-1, 3, 7))
+
+        if not triangles:
+            return numpy.zeros((0, 3, 7))
+        return clip_near(numpy.concatenate(triangles))
+
+    def rasterize(self, vertices):
+        clip = vertices[:, :, :4]
+        if not self.face_culling:
+            #Draw back faces too, as front faces wound the other way
+            area = self.signed_areas(clip)
+            clip = numpy.where((area < 0)[:, None, None], clip[:, ::-1], clip)
+            vertices = numpy.where((area < 0)[:, None, None], vertices[:, ::-1], vertices)
+
+        front, inverse_w, edges, planes, bounds = setup(clip, self.width, self.height)
+        normals = vertices[front, :, 4:]
+
+        triangles, offsets = bin_triangles(bounds, self.width, self.height, self.tile_size)
+        columns = (self.width + self.tile_size - 1) // self.tile_size
+        for tile in range(len(offsets) - 1):
+            start, end = offsets[tile], offsets[tile + 1]
+            if start == end:
+                continue
+            y = tile // columns * self.tile_size
+            x = tile % columns * self.tile_size
+            self.rasterize_tile(x, y, triangles[start:end], edges, planes)
+
+        self.shade(inverse_w, edges, normals)
+
+    def signed_areas(self, clip):
+        #Twice the screen space area, the sign gives the winding
+        x = clip[:, :, 0] / clip[:, :, 3]
+        y = clip[:, :, 1] / clip[:, :, 3]
+        return ((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) -
+                (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+
+    def rasterize_tile(self, x, y, triangles, edges, planes):
+        size = self.tile_size
+        tile_depth = self.depth[y:y + size, x:x + size]
+        tile_triangle = self.triangle[y:y + size, x:x + size]
+        height, width = tile_depth.shape
+
+        #Every pixel center of the tile as (x, y, 1)
+        pixels = numpy.ones((3, height * width))
+        pixels[0] = numpy.tile(self.screen_x[x:x + size], height)
+        pixels[1] = numpy.repeat(self.screen_y[y:y + size], width)
+        depth, closest = tile_depth.reshape(-1), tile_triangle.reshape(-1)
+
+        batch = max(1, BATCH_SIZE // depth.size)
+        for start in range(0, len(triangles), batch):
+            indices = triangles[start:start + batch]
+
+            #Inside where no edge function is negative
+            inside = numpy.ones((len(indices), depth.size), dtype=bool)
+            for corner in range(3):
+                inside &= numpy.dot(edges[indices, corner], pixels) >= 0
+
+            #Depth test (GL_LESS) within the depth range
+            z = numpy.dot(planes[indices], pixels)
+            inside &= (z >= 0) & (z <= 1)
+            z = numpy.where(inside, z, numpy.inf)
+
+            #The first triangle drawn wins ties, like in OpenGL
+            nearest = z.argmin(axis=0)
+            nearest_z = z[nearest, numpy.arange(depth.size)]
+            closer = nearest_z < depth
+            depth[closer] = nearest_z[closer]
+            closest[closer] = indices[nearest[closer]]
+
+        #Tiles are views, but not contiguous ones
+        tile_depth[...] = depth.reshape(height, width)
+        tile_triangle[...] = closest.reshape(height, width)
+
+    def shade(self, inverse_w, edges, normals):
+        self.framebuffer[...] = CLEAR
+        drawn = self.triangle >= 0
+        triangles = self.triangle[drawn]
+
+        #Barycentric coordinates of every drawn pixel
+        rows, columns = numpy.nonzero(drawn)
+        pixels = numpy.stack([self.screen_x[columns], self.screen_y[rows],
+                              numpy.ones(len(rows))], axis=1)
+        weights = numpy.einsum("nij,nj->ni", edges[triangles], pixels)
+
+        #Perspective correct interpolation of the normals
+        weights *= inverse_w[triangles]
+        weights /= weights.sum(axis=1)[:, None]
+        normal = numpy.einsum("ni,nij->nj", weights, normals[triangles])
+
+        #Colour is the normal, clamped like a fixed point framebuffer
+        self.framebuffer[drawn, :3] = numpy.clip(normal, 0, 1)
+        self.framebuffer[drawn, 3] = 1
+
+    def read_pixels(self):
+        #Returns the rendered (height, width, 4) image, bottom row first
+        return self.framebuffer
+
+    """
+       CLEANUP
+    """
+
+    def close(self):
+        #Nothing to release, the framebuffer is garbage collected
+        pass
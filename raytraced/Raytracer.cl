@@ -1,10 +1,40 @@
 #include <Math.cl>
 
-//A vertex is made up of a position, a normal and a UV coordinate
+//Triangles are stored as a structure of arrays in BVH leaf order, with
+//everything the intersection test needs precomputed: the first corner A,
+//edge1 = B - A, edge2 = C - A and normal = cross(edge2, edge1).
+//Rays only hit the side the normal points away from.
 typedef struct {
-    float4 position;
-    float4 normal;
-} Vertex;
+    __global const float4 *a;
+    __global const float4 *edge1;
+    __global const float4 *edge2;
+    __global const float4 *normal;
+} Triangles;
+
+//A BVH node is an axis aligned bounding box and either two children
+//(count == 0, first is the left child, the right child follows it)
+//or a range of triangles (count > 0, first is the first triangle).
+//skip is the node to continue with once this one is done, -1 to stop.
+typedef struct {
+    float4 min;
+    float4 max;
+    int first;
+    int count;
+    int skip;
+    int pad;
+} BVHNode;
+
+//An instance places a mesh in the world. row0 - row2 are the rows of
+//its world to object matrix, root is the first BVH node of its mesh.
+typedef struct {
+    float4 row0;
+    float4 row1;
+    float4 row2;
+    int root;
+    int pad0;
+    int pad1;
+    int pad2;
+} Instance;
 
 //A camera is made up of it's position and it's orientation
 typedef struct {
@@ -28,32 +58,95 @@ typedef struct {
     float4 direction;
 } Ray;
 
-void distance_from_ray_to_plane(Ray* ray, float4 A, float4 B, float4 C, Hit *hit);
-bool ray_triangle_check(Ray* ray, float4 A, float4 B, float4 C, Hit* hit);
+//A ray waiting in a queue to be traced by a later kernel,
+//along with the pixel it belongs to
+typedef struct {
+    float4 origin;
+    float4 direction;
+    int pixel;
+    int pad0;
+    int pad1;
+    int pad2;
+} QueuedRay;
+
+//Ray queues, one per type of secondary ray
+#define SHADOW_RAYS 0
+
+//Distance shadow rays start away from surfaces, to not hit them again
+#define SHADOW_BIAS 1e-4f
+
+bool ray_triangle_check(Ray* ray, Triangles *triangles, int index, Hit* hit);
+bool ray_triangle_occludes(Ray* ray, Triangles *triangles, int index, float max_dist);
+bool ray_box_check(Ray* ray, float4 inv_direction, float4 box_min, float4 box_max, float max_dist);
+bool raycast_mesh(Ray* ray, Triangles *triangles, __global const BVHNode *nodes,
+                  __local const BVHNode *cached_nodes, int cached_count, int root, Hit *hit);
+bool occluded_mesh(Ray* ray, float max_dist, Triangles *triangles, __global const BVHNode *nodes,
+                   __local const BVHNode *cached_nodes, int cached_count, int root);
 
-bool raycast(Ray* ray, __constant Vertex *vertices, int vertices_len, Hit *hit) {
+float4 inverse_direction(float4 direction) {
+    //Avoid dividing by zero for axis aligned rays
+    direction = copysign(fmax(fabs(direction), (float4)(1e-8f)), direction);
+    return 1.0f / direction;
+}
+
+//Transformations between world and object space of an instance
+float4 to_object_point(__global const Instance *instance, float4 point) {
+    point.w = 1;
+    return (float4)(dot(instance->row0, point), dot(instance->row1, point), dot(instance->row2, point), 0);
+}
+
+float4 to_object_direction(__global const Instance *instance, float4 direction) {
+    direction.w = 0;
+    return (float4)(dot(instance->row0, direction), dot(instance->row1, direction), dot(instance->row2, direction), 0);
+}
+
+float4 to_world_normal(__global const Instance *instance, float4 normal) {
+    //Normals transform by the transposed inverse
+    float4 out = normal.x*instance->row0 + normal.y*instance->row1 + normal.z*instance->row2;
+    out.w = 0;
+    return out;
+}
+
+bool raycast(Ray* ray, Triangles *triangles, __global const BVHNode *nodes,
+             __local const BVHNode *cached_nodes, int cached_count,
+             __global const BVHNode *instance_nodes, __global const Instance *instances, Hit *hit) {
     hit->dist = INFINITY;
 
-    //Iterate through triangles
-    for (int index = 0; index < vertices_len; index += 3) {
-        //Get vertex coordiates of every triangle
-        float4 A = vertices[index + 0].position; //mult_matrix(&object->matrix, (float4)(*mesh->vertices[tris*3], 0)).xyz;
-        float4 B = vertices[index + 1].position; //mult_matrix(&object->matrix, (float4)(*mesh->vertices[tris*3 + 1], 0)).xyz;
-        float4 C = vertices[index + 2].position; //mult_matrix(&object->matrix, (float4)(*mesh->vertices[tris*3 + 2], 0)).xyz;
+    float4 inv_direction = inverse_direction(ray->direction);
 
-        //Get the hitdistace from the plane A, B, C
-        Hit plane_hit;
-        distance_from_ray_to_plane(ray, A, B, C, &plane_hit);
+    //Stackless traversal of the top level BVH over instances
+    int node_index = 0;
+    while (node_index != -1) {
+        __global const BVHNode *node = &instance_nodes[node_index];
 
-        if (plane_hit.dist == INFINITY) {
-          continue;
+        //Skip the whole subtree if the ray misses it
+        if (!ray_box_check(ray, inv_direction, node->min, node->max, hit->dist)) {
+            node_index = node->skip;
+            continue;
         }
 
-        if(0 < plane_hit.dist && plane_hit.dist < hit->dist) {
-            if (ray_triangle_check(ray, A, B, C, &plane_hit)) {
-                *hit = plane_hit;
+        //Descend into the left child of inner nodes
+        if (node->count == 0) {
+            node_index = node->first;
+            continue;
+        }
+
+        //Trace every instance of the leaf in its object space.
+        //Directions aren't normalised so distances stay the same.
+        for (int index = node->first; index < node->first + node->count; index++) {
+            __global const Instance *instance = &instances[index];
+
+            Ray object_ray;
+            object_ray.origin = to_object_point(instance, ray->origin);
+            object_ray.direction = to_object_direction(instance, ray->direction);
+
+            if (raycast_mesh(&object_ray, triangles, nodes, cached_nodes, cached_count,
+                             instance->root, hit)) {
+                hit->normal = to_world_normal(instance, hit->normal);
             }
         }
+
+        node_index = node->skip;
     }
 
     //Return whether or not the ray hit anything
@@ -61,76 +154,491 @@ bool raycast(Ray* ray, __constant Vertex *vertices, int vertices_len, Hit *hit)
         return false;
     }
 
+    hit->point = ray->origin + ray->direction * hit->dist;
     return true;
 }
 
-void distance_from_ray_to_plane(Ray* ray, float4 A, float4 B, float4 C, Hit *hit) {
-    hit->normal = cross(C - A, B - A);
-    float dotDirection = dot(hit->normal, ray->direction);
+//Find the closest hit with one mesh, starting at its BVH node "root".
+//Only replaces "hit" (and returns true) if the new hit is closer.
+//The first "cached_count" nodes are read from local memory.
+bool raycast_mesh(Ray* ray, Triangles *triangles, __global const BVHNode *nodes,
+                  __local const BVHNode *cached_nodes, int cached_count, int root, Hit *hit) {
+    bool found = false;
 
-    if (dotDirection <= 0) {
-        hit->dist = INFINITY;
-        return;
+    float4 inv_direction = inverse_direction(ray->direction);
+
+    //Stackless traversal of the BVH
+    int node_index = root;
+    while (node_index != -1) {
+        BVHNode node;
+        if (node_index < cached_count) {
+            node = cached_nodes[node_index];
+        } else {
+            node = nodes[node_index];
+        }
+
+        //Skip the whole subtree if the ray misses it
+        if (!ray_box_check(ray, inv_direction, node.min, node.max, hit->dist)) {
+            node_index = node.skip;
+            continue;
+        }
+
+        //Descend into the left child of inner nodes
+        if (node.count == 0) {
+            node_index = node.first;
+            continue;
+        }
+
+        //Iterate through the triangles of leaves
+        int end = node.first + node.count;
+        for (int index = node.first; index < end; index++) {
+            found |= ray_triangle_check(ray, triangles, index, hit);
+        }
+
+        node_index = node.skip;
     }
 
-    hit->dist = dot(A - ray->origin, hit->normal) / dotDirection;
+    return found;
 }
 
-//Check whether an intersection point is inside the triangle A, B, C
-//Intersection point is dist along the ray.
-bool ray_triangle_check(Ray* ray, float4 A, float4 B, float4 C, Hit* hit) {
-    hit->point = ray->origin + ray->direction * hit->dist;
+//Slab test between a ray and an axis aligned box.
+//Only counts hits closer than max_dist.
+bool ray_box_check(Ray* ray, float4 inv_direction, float4 box_min, float4 box_max, float max_dist) {
+    float4 t0 = (box_min - ray->origin) * inv_direction;
+    float4 t1 = (box_max - ray->origin) * inv_direction;
+    float4 t_near = fmin(t0, t1);
+    float4 t_far = fmax(t0, t1);
 
-    float area = length(hit->normal);
+    float t_enter = fmax(fmax(t_near.x, t_near.y), fmax(t_near.z, 0.0f));
+    float t_exit = fmin(fmin(t_far.x, t_far.y), fmin(t_far.z, max_dist));
+    return t_enter <= t_exit;
+}
 
-    //Optimisation
-    float4 QA = A - hit->point;
-    float4 QB = B - hit->point;
-    float4 QC = C - hit->point;
+//Moller-Trumbore intersection of a ray and a triangle, with the
+//determinant taken from the precomputed normal. Only replaces "hit"
+//(and returns true) if the triangle is hit closer than it.
+bool ray_triangle_check(Ray* ray, Triangles *triangles, int index, Hit* hit) {
+    float4 normal = triangles->normal[index];
 
-    //Barycentric intersection test
-    hit->bary.x = length(cross(QB, QC))/area;
-    hit->bary.y = length(cross(QA, QC))/area;
-    hit->bary.z = length(cross(QA, QB))/area;
+    //Only front faces count
+    float det = dot(normal, ray->direction);
+    if (det <= 0) {
+        return false;
+    }
 
-    hit->bary.w = hit->bary.x + hit->bary.y + hit->bary.z;
+    float4 offset = ray->origin - triangles->a[index];
+    float4 edge1 = triangles->edge1[index];
+    float4 edge2 = triangles->edge2[index];
 
-    //Check for bary intersection
-    float diff = fabs(1.0 - hit->bary.w);
-    if (diff < 0.000001) {
-        return true;
+    //Barycentric coordinates, scaled by det
+    float u = dot(ray->direction, cross(edge2, offset));
+    if (u < 0 || u > det) {
+        return false;
+    }
+
+    float4 v_factor = cross(offset, edge1);
+    float v = dot(ray->direction, v_factor);
+    if (v < 0 || u + v > det) {
+        return false;
+    }
+
+    //Distance along the ray, scaled by det
+    float t = dot(v_factor, edge2);
+    if (t <= 0 || t >= hit->dist * det) {
+        return false;
+    }
+
+    float inv_det = 1.0f / det;
+    hit->dist = t * inv_det;
+    hit->normal = normal;
+    hit->bary = (float4)(det - u - v, u, v, det) * inv_det;
+    return true;
+}
+
+//Any-hit version of raycast: returns whether anything is hit closer
+//than max_dist (in lengths of the ray direction), stopping at the
+//first hit found instead of looking for the closest one
+bool occluded(Ray* ray, float max_dist, Triangles *triangles, __global const BVHNode *nodes,
+              __local const BVHNode *cached_nodes, int cached_count,
+              __global const BVHNode *instance_nodes, __global const Instance *instances) {
+    float4 inv_direction = inverse_direction(ray->direction);
+
+    int node_index = 0;
+    while (node_index != -1) {
+        __global const BVHNode *node = &instance_nodes[node_index];
+
+        if (!ray_box_check(ray, inv_direction, node->min, node->max, max_dist)) {
+            node_index = node->skip;
+            continue;
+        }
+
+        if (node->count == 0) {
+            node_index = node->first;
+            continue;
+        }
+
+        for (int index = node->first; index < node->first + node->count; index++) {
+            __global const Instance *instance = &instances[index];
+
+            Ray object_ray;
+            object_ray.origin = to_object_point(instance, ray->origin);
+            object_ray.direction = to_object_direction(instance, ray->direction);
+
+            if (occluded_mesh(&object_ray, max_dist, triangles, nodes,
+                              cached_nodes, cached_count, instance->root)) {
+                return true;
+            }
+        }
+
+        node_index = node->skip;
     }
 
     return false;
 }
 
-__kernel void raytrace(__write_only image2d_t renderTexture, Camera camera, __constant Vertex *vertices, int vertices_len) {
+//Any-hit version of raycast_mesh
+bool occluded_mesh(Ray* ray, float max_dist, Triangles *triangles, __global const BVHNode *nodes,
+                   __local const BVHNode *cached_nodes, int cached_count, int root) {
+    float4 inv_direction = inverse_direction(ray->direction);
 
-    int x = get_global_id(0);
-    int y = get_global_id(1);
-    int2 position = (int2)(x, y);
+    int node_index = root;
+    while (node_index != -1) {
+        BVHNode node;
+        if (node_index < cached_count) {
+            node = cached_nodes[node_index];
+        } else {
+            node = nodes[node_index];
+        }
 
-    float width  = get_global_size(0);
-    float height = get_global_size(1);
-    //uv coordinates
+        if (!ray_box_check(ray, inv_direction, node.min, node.max, max_dist)) {
+            node_index = node.skip;
+            continue;
+        }
+
+        if (node.count == 0) {
+            node_index = node.first;
+            continue;
+        }
+
+        int end = node.first + node.count;
+        for (int index = node.first; index < end; index++) {
+            if (ray_triangle_occludes(ray, triangles, index, max_dist)) {
+                return true;
+            }
+        }
+
+        node_index = node.skip;
+    }
+
+    return false;
+}
+
+//Moller-Trumbore test of whether a ray hits a triangle closer than
+//max_dist. Unlike ray_triangle_check both sides of triangles count.
+bool ray_triangle_occludes(Ray* ray, Triangles *triangles, int index, float max_dist) {
+    float det = dot(triangles->normal[index], ray->direction);
+
+    //Flip the sign of back faces so they are tested like front faces
+    float side = det < 0 ? -1.0f : 1.0f;
+    det *= side;
+    if (det == 0) {
+        return false;
+    }
+
+    float4 offset = ray->origin - triangles->a[index];
+    float4 edge1 = triangles->edge1[index];
+    float4 edge2 = triangles->edge2[index];
+
+    float u = side * dot(ray->direction, cross(edge2, offset));
+    if (u < 0 || u > det) {
+        return false;
+    }
+
+    float4 v_factor = cross(offset, edge1);
+    float v = side * dot(ray->direction, v_factor);
+    if (v < 0 || u + v > det) {
+        return false;
+    }
 
+    float t = side * dot(v_factor, edge2);
+    return t > 0 && t < max_dist * det;
+}
+
+//Colour of the pixel at x, y of an image of size width, height
+float4 trace_pixel(int x, int y, float width, float height, Camera *camera,
+                   Triangles *triangles, __global const BVHNode *nodes,
+                   __local const BVHNode *cached_nodes, int cached_count,
+                   __global const BVHNode *instance_nodes, __global const Instance *instances) {
+    //uv coordinates
     float normalised_x = x/width - 0.5;
     float normalised_y = y/height - 0.5;
 
-    float2 normalised_pos = (float2)(normalised_x, normalised_y);
-
     Ray ray;
-    ray.origin = camera.position;
-    ray.direction = camera.forward + normalised_y*camera.up + normalised_x*camera.right;
+    ray.origin = camera->position;
+    ray.direction = camera->forward + normalised_y*camera->up + normalised_x*camera->right;
 
     Hit hit;
     float4 color = BLACK;
 
     //Do raytracing
-    if (raycast(&ray, vertices, vertices_len, &hit)) {
+    if (raycast(&ray, triangles, nodes, cached_nodes, cached_count,
+                instance_nodes, instances, &hit)) {
         float4 normal = normalize(hit.normal);
         color = dot(normal, ray.direction) * WHITE + WHITE * 0.4;
     }
 
-    write_imagef(renderTexture, position, color);
+    return color;
+}
+
+//Copies the first "cached_count" BVH nodes into local memory,
+//every work-item of the work-group copies a part
+void cache_nodes(__global const BVHNode *nodes, __local BVHNode *cached_nodes, int cached_count) {
+    int local_id = get_local_id(1) * get_local_size(0) + get_local_id(0);
+    int local_size = get_local_size(0) * get_local_size(1);
+    for (int index = local_id; index < cached_count; index += local_size) {
+        cached_nodes[index] = nodes[index];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+//Rendered in tiles of one work-group each. The global size is rounded
+//up to whole tiles, work-items outside the image do nothing.
+//The top "cached_count" BVH nodes (stored breadth first) are shared
+//by the work-group in local memory, as every ray passes through them.
+__kernel void raytrace(__write_only image2d_t renderTexture, Camera camera,
+                       __global const float4 *triangle_a, __global const float4 *triangle_edge1,
+                       __global const float4 *triangle_edge2, __global const float4 *triangle_normal,
+                       __global const BVHNode *nodes,
+                       __global const BVHNode *instance_nodes, __global const Instance *instances,
+                       __local BVHNode *cached_nodes, int cached_count) {
+
+    cache_nodes(nodes, cached_nodes, cached_count);
+
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int width = get_image_width(renderTexture);
+    int height = get_image_height(renderTexture);
+
+    if (x >= width || y >= height) {
+        return;
+    }
+
+    Triangles triangles;
+    triangles.a = triangle_a;
+    triangles.edge1 = triangle_edge1;
+    triangles.edge2 = triangle_edge2;
+    triangles.normal = triangle_normal;
+
+    float4 color = trace_pixel(x, y, width, height, &camera, &triangles, nodes,
+                               cached_nodes, cached_count, instance_nodes, instances);
+
+    write_imagef(renderTexture, (int2)(x, y), color);
+}
+
+//One pass of progressive rendering. Every work-item handles a pixel on
+//the grid of every "step"th pixel and fills the step x step block it
+//starts with its colour, which later passes with smaller steps refine.
+//Pixels already on the grid of the previous pass (step * 2) are skipped.
+//
+//Pixels are only traced if the samples at the corners of their block in
+//the previous pass differ by more than "threshold", otherwise the corners
+//are interpolated. A negative threshold traces every pixel.
+//"samples" holds the colour of every pixel on a grid so far.
+__kernel void raytrace_progressive(__write_only image2d_t renderTexture, Camera camera,
+                                   __global const float4 *triangle_a, __global const float4 *triangle_edge1,
+                                   __global const float4 *triangle_edge2, __global const float4 *triangle_normal,
+                                   __global const BVHNode *nodes,
+                                   __global const BVHNode *instance_nodes, __global const Instance *instances,
+                                   __local BVHNode *cached_nodes, int cached_count,
+                                   __global float4 *samples, int step, int first_step, float threshold) {
+
+    cache_nodes(nodes, cached_nodes, cached_count);
+
+    int x = get_global_id(0) * step;
+    int y = get_global_id(1) * step;
+    int width = get_image_width(renderTexture);
+    int height = get_image_height(renderTexture);
+
+    if (x >= width || y >= height) {
+        return;
+    }
+
+    int block = step * 2;
+    bool first = step == first_step;
+    if (!first && x % block == 0 && y % block == 0) {
+        return;
+    }
+
+    float4 color;
+    bool trace = first || threshold < 0;
+    if (!trace) {
+        //Corners of the enclosing block of the previous pass,
+        //clamped to the last samples inside the image
+        int left = x - x % block;
+        int bottom = y - y % block;
+        int right = min(left + block, (width - 1) - (width - 1) % block);
+        int top = min(bottom + block, (height - 1) - (height - 1) % block);
+
+        float4 a = samples[bottom * width + left];
+        float4 b = samples[bottom * width + right];
+        float4 c = samples[top * width + left];
+        float4 d = samples[top * width + right];
+
+        //Trace near edges, where neighbouring samples differ
+        float4 low = fmin(fmin(a, b), fmin(c, d));
+        float4 high = fmax(fmax(a, b), fmax(c, d));
+        float4 difference = high - low;
+        trace = fmax(fmax(difference.x, difference.y), difference.z) > threshold;
+
+        if (!trace) {
+            float u = right > left ? (float)(x - left) / (right - left) : 0;
+            float v = top > bottom ? (float)(y - bottom) / (top - bottom) : 0;
+            color = mix(mix(a, b, u), mix(c, d, u), v);
+        }
+    }
+
+    if (trace) {
+        Triangles triangles;
+        triangles.a = triangle_a;
+        triangles.edge1 = triangle_edge1;
+        triangles.edge2 = triangle_edge2;
+        triangles.normal = triangle_normal;
+
+        color = trace_pixel(x, y, width, height, &camera, &triangles, nodes,
+                            cached_nodes, cached_count, instance_nodes, instances);
+    }
+
+    samples[y * width + x] = color;
+
+    //Cover the whole block until later passes refine it
+    int end_x = min(x + step, width);
+    int end_y = min(y + step, height);
+    for (int block_y = y; block_y < end_y; block_y++) {
+        for (int block_x = x; block_x < end_x; block_x++) {
+            write_imagef(renderTexture, (int2)(block_x, block_y), color);
+        }
+    }
+}
+
+//Wavefront rendering with shadows, in three kernels so every kernel
+//traces only one kind of ray. raytrace_primary traces the camera rays
+//and queues a shadow ray towards the light for every lit surface,
+//trace_shadows traces the queued shadow rays together and shade puts
+//the results together. "direct" is the part of a pixel's colour the
+//light is responsible for (w is 1 for pixels that hit anything) and
+//"shadowed" marks the pixels whose shadow ray hit something.
+__kernel void raytrace_primary(Camera camera,
+                               __global const float4 *triangle_a, __global const float4 *triangle_edge1,
+                               __global const float4 *triangle_edge2, __global const float4 *triangle_normal,
+                               __global const BVHNode *nodes,
+                               __global const BVHNode *instance_nodes, __global const Instance *instances,
+                               __local BVHNode *cached_nodes, int cached_count,
+                               int width, int height, float4 light,
+                               __global float4 *direct, __global int *shadowed,
+                               __global QueuedRay *shadow_rays, __global int *ray_counts) {
+
+    cache_nodes(nodes, cached_nodes, cached_count);
+
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+
+    if (x >= width || y >= height) {
+        return;
+    }
+
+    int pixel = y * width + x;
+    shadowed[pixel] = 0;
+    direct[pixel] = (float4)(0, 0, 0, 0);
+
+    Triangles triangles;
+    triangles.a = triangle_a;
+    triangles.edge1 = triangle_edge1;
+    triangles.edge2 = triangle_edge2;
+    triangles.normal = triangle_normal;
+
+    Ray ray;
+    ray.origin = camera.position;
+    ray.direction = camera.forward + (y/(float)height - 0.5f)*camera.up + (x/(float)width - 0.5f)*camera.right;
+
+    Hit hit;
+    if (!raycast(&ray, &triangles, nodes, cached_nodes, cached_count,
+                 instance_nodes, instances, &hit)) {
+        return;
+    }
+
+    float4 normal = normalize(hit.normal);
+    direct[pixel] = dot(normal, ray.direction) * WHITE;
+    direct[pixel].w = 1;
+
+    //Normals point into the surface, faces turned away from the light
+    //are in their own shadow and need no ray
+    float4 to_light = light - hit.point;
+    to_light.w = 0;
+    if (dot(normal, to_light) >= 0) {
+        shadowed[pixel] = 1;
+        return;
+    }
+
+    QueuedRay shadow_ray;
+    shadow_ray.origin = hit.point - normal * SHADOW_BIAS;
+    shadow_ray.direction = light - shadow_ray.origin;
+    shadow_ray.direction.w = 0;
+    shadow_ray.pixel = pixel;
+    shadow_rays[atomic_inc(&ray_counts[SHADOW_RAYS])] = shadow_ray;
+}
+
+//One work-item per queued shadow ray, work-items past the end of
+//the queue do nothing. Shadow rays end at the light (max_dist 1).
+__kernel void trace_shadows(__global const float4 *triangle_a, __global const float4 *triangle_edge1,
+                            __global const float4 *triangle_edge2, __global const float4 *triangle_normal,
+                            __global const BVHNode *nodes,
+                            __global const BVHNode *instance_nodes, __global const Instance *instances,
+                            __local BVHNode *cached_nodes, int cached_count,
+                            __global const QueuedRay *shadow_rays, __global const int *ray_counts,
+                            __global int *shadowed) {
+
+    cache_nodes(nodes, cached_nodes, cached_count);
+
+    int index = get_global_id(0);
+    if (index >= ray_counts[SHADOW_RAYS]) {
+        return;
+    }
+
+    Triangles triangles;
+    triangles.a = triangle_a;
+    triangles.edge1 = triangle_edge1;
+    triangles.edge2 = triangle_edge2;
+    triangles.normal = triangle_normal;
+
+    Ray ray;
+    ray.origin = shadow_rays[index].origin;
+    ray.direction = shadow_rays[index].direction;
+
+    if (occluded(&ray, 1.0f, &triangles, nodes, cached_nodes, cached_count,
+                 instance_nodes, instances)) {
+        shadowed[shadow_rays[index].pixel] = 1;
+    }
+}
+
+__kernel void shade(__write_only image2d_t renderTexture,
+                    __global const float4 *direct, __global const int *shadowed) {
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int width = get_image_width(renderTexture);
+
+    if (x >= width || y >= get_image_height(renderTexture)) {
+        return;
+    }
+
+    int pixel = y * width + x;
+    float4 color = BLACK;
+    if (direct[pixel].w > 0) {
+        color = WHITE * 0.4;
+        if (!shadowed[pixel]) {
+            color += direct[pixel];
+        }
+        color.w = 1;
+    }
+
+    write_imagef(renderTexture, (int2)(x, y), color);
 }
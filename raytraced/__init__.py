@@ -1,8 +1,16 @@
 import pygame
 import os
 import common
+import common.objects
+import common.offscreen
+from common import bvh
 from OpenGL.GL import *
 from OpenGL.GLU import *
+try:
+    #Lets OpenGL wait for OpenCL events on the GPU
+    from OpenGL.GL.ARB.cl_event import *
+except ImportError:
+    glCreateSyncFromCLeventARB = None
 try:
     from OpenGL import GLX
     print "Using X (Unix) window system"
@@ -11,11 +19,16 @@ except:
     print "Using Wiggle (windows) window system"
 import numpy
 import ctypes
+import json
+import hashlib
+import glob
 from ctypes import *
+from common import timing
 #import PyOpenCL Objects
-from pyopencl import Buffer, Program, Context, CommandQueue, GLTexture
+from pyopencl import Buffer, Program, Context, CommandQueue, GLTexture, LocalMemory
 #import PyOpenCL enumberations
-from pyopencl import mem_flags, context_properties, platform_info
+from pyopencl import mem_flags, context_properties, platform_info, kernel_work_group_info, program_info
+from pyopencl import command_queue_properties, command_execution_status
 #import dtypes
 from pyopencl.array import vec as cltypes
 from pyopencl import tools as cltools
@@ -24,67 +37,171 @@ import pyopencl.array as cl_array
 from common.pyopengl import *
 import itertools
 
+"""
+Constants
+"""
+
+#Work-group sizes (screen tiles) the autotuner picks from
+LOCAL_SIZES = (8, 8), (16, 8), (16, 16), (32, 4), (32, 8), (64, 4)
+#Kernel runs timed for every candidate
+TUNING_RUNS = 5
+#Tuning results of every device and resolution
+TUNING_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tuning.json")
+#Compiled program binaries of every device, source and build options
+PROGRAM_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "program_cache")
+#Share of local memory used for caching the top of the BVH
+LOCAL_CACHE_SHARE = 0.5
+#Every how many pixels the first progressive pass traces
+PROGRESSIVE_STEP = 8
+#Largest colour difference between samples still interpolated
+#instead of traced by progressive rendering
+ADAPTIVE_THRESHOLD = 0.02
+#Position of the point light casting shadows
+LIGHT = (4.0, 6.0, -8.0)
+#Kinds of secondary rays queued, and the queue of each
+#(see SHADOW_RAYS in Raytracer.cl)
+RAY_TYPES = 1
+SHADOW_RAYS = 0
+
 """
 Structures
 """
 
-cltypes.Vertex = numpy.dtype([("position", cltypes.float4),
-                              ("normal", cltypes.float4)])
+cltypes.BVHNode = numpy.dtype([("min", cltypes.float4),
+                               ("max", cltypes.float4),
+                               ("first", numpy.int32),
+                               ("count", numpy.int32),
+                               ("skip", numpy.int32),
+                               ("pad", numpy.int32)])
+cltypes.Instance = numpy.dtype([("row0", cltypes.float4),
+                                ("row1", cltypes.float4),
+                                ("row2", cltypes.float4),
+                                ("root", numpy.int32),
+                                ("pad0", numpy.int32),
+                                ("pad1", numpy.int32),
+                                ("pad2", numpy.int32)])
+cltypes.QueuedRay = numpy.dtype([("origin", cltypes.float4),
+                                 ("direction", cltypes.float4),
+                                 ("pixel", numpy.int32),
+                                 ("pad0", numpy.int32),
+                                 ("pad1", numpy.int32),
+                                 ("pad2", numpy.int32)])
 
 """
 EXTENSION METHODS
 """
-#Set renderer specific object methods. Makes code cleaner
+#Renderer specific object methods, bound to the objects
+#the renderer uses (see common.objects.extend). Makes code cleaner
 
-#Extension method of Device class
 #Returns wether device meets renderer requirements
-def _pyopencl_Device__meets_requirements(self):
+#(pyopencl Devices can't be extended)
+def meets_requirements(device):
     #TODO: Maybe
-    return "cl_khr_gl_sharing" in self.extensions
-#Apply extension method
-OpenCL.Device.meets_requirements = _pyopencl_Device__meets_requirements
+    return "cl_khr_gl_sharing" in device.extensions
 
 #Extension method for Camera objects
 #Sets projection matrix
 def _Camera__getCl_info(self):
-    mat = self.rotation.matrix
-    pos = self.position
-    forward = mat*common.math3d.Vector(0, 0, 1)
-    up = mat*common.math3d.Vector(0, 1, 0)
-    right = mat*common.math3d.Vector(1, 0, 0)
-    out = numpy.array(list(pos) + [0] +
-                      list(forward) + [0] +
-                      list(up) + [0] +
-                      list(right) + [0],
-                      dtype=numpy.float32)
-    return numpy.ndarray((4, 4), numpy.float32, out)
-#Apply extension method
-common.objects.Camera.getCl_info = _Camera__getCl_info
+    #Only rebuilt after the camera changed
+    return self.cached("cl_info", _Camera__build_Cl_info)
+def _Camera__build_Cl_info(self):
+    #The columns of the rotation matrix are the right, up and forward axes
+    mat = self.rotation_matrix()
+    out = numpy.zeros((4, 4), dtype=numpy.float32)
+    out[0, :3] = list(self.position)
+    out[1, :3] = mat[:, 2]
+    out[2, :3] = mat[:, 1]
+    out[3, :3] = mat[:, 0]
+    return out
 
 #Extension method for Object objects
 #Sets transformation matrix
 def _Object__get_matrix(self):
     #calculate matrix from rotation, scale and translation
-    rt = self.rotation.matrix
-    return [rt[0], rt[1], rt[2], self.position[0],
-            rt[3], rt[4], rt[5], self.position[1],
-            rt[6], rt[7], rt[8], self.position[2],
-            0,     0,     0,     1]
-#Apply extension method
-common.objects.Object.get_matrix = _Object__get_matrix
+    return self.matrix().astype(numpy.float32).reshape(-1)
+
+#Returns resolve(wait) -> nanoseconds the command of "event"
+#ran on the device for, None while it isn't done (see timing.Profiler)
+def event_time(event):
+    def resolve(wait):
+        if not wait and event.command_execution_status != command_execution_status.COMPLETE:
+            return None
+        event.wait()
+        return event.profile.end - event.profile.start
+    return resolve
+
+#Extension methods of every Camera and Object rendered
+CAMERA_METHODS = {"getCl_info" : _Camera__getCl_info}
+OBJECT_METHODS = {"get_matrix" : _Object__get_matrix}
 
 """
    MAIN CLASS
 """
 
 class Raytracer:
-    """Raytraced Renderer"""
+    """Raytraced Renderer
+
+    With "offscreen" set, renders into a framebuffer object
+    of a surfaceless EGL context instead of a window.
+    common.offscreen.enable() has to be called before
+    this module is imported for that to work.
+
+    With "pipelined" set, frames are raytraced into two textures
+    in turn and drawn one frame later, so the raytracing of a frame
+    overlaps drawing the previous one instead of waiting for it.
+
+    With "autotune" set, the work-group size and whether to cache
+    the top of the BVH in local memory are measured once per device
+    and resolution and kept in TUNING_CACHE.
+
+    Compiled programs are kept in PROGRAM_CACHE and reused for as
+    long as the source, build options, device and driver stay the same.
+
+    With "progressive" set, every frame refines the image of the last
+    one for as long as the camera and objects stay the same: first
+    every PROGRESSIVE_STEP-th pixel is traced, then the step halves
+    every frame until each pixel is done, after which frames only
+    draw the finished image. With "adaptive" set as well, pixels
+    between samples of the previous step that differ by less than
+    ADAPTIVE_THRESHOLD are interpolated instead of traced.
+
+    With "shadows" set, surfaces facing away from "light" or hidden
+    from it by other geometry only get the ambient term. Camera rays
+    queue a shadow ray per lit pixel, and the queued rays are traced
+    together by a kernel of their own that stops at the first hit.
+    That kernel is launched for the queued rays only, which needs
+    the queue length on the host, so every frame waits for its
+    camera rays (also when pipelined).
+
+    Meshes with levels of detail (see Mesh.generate_lods) have
+    every level in the triangle buffers, instances are pointed
+    at the level fitting their size on screen.
+
+    With "profile" set, "profiler" records the host time of every
+    phase of a frame, the device time of every OpenCL command
+    (the command queue is created with PROFILING_ENABLE) and
+    the GPU time of drawing (GL_TIME_ELAPSED queries).
+    """
 
     """
        INITIALISATION
     """
-    def __init__(self, resolution, object):
+    def __init__(self, resolution, scene, offscreen=False, pipelined=False,
+                 autotune=True, progressive=False, adaptive=True, shadows=False,
+                 light=LIGHT, profile=False):
+        if pipelined and progressive:
+            raise Exception("Progressive rendering can't be pipelined")
+        if shadows and progressive:
+            raise Exception("Progressive rendering has no shadows")
+
         #initialize display
+        self.offscreen = offscreen
+        self.pipelined = pipelined
+        self.progressive = progressive
+        self.adaptive = adaptive
+        self.shadows = shadows
+        self.light = numpy.array(list(light) + [1], dtype=numpy.float32)
+        self.profiler = timing.Profiler() if profile else timing.NullProfiler()
         self.set_display(resolution)
         self.width, self.height = resolution
 
@@ -97,19 +214,31 @@ class Raytracer:
         #build program
         self.load_program()
 
-        #create the texture we render to
-        self.create_texture()
+        #create the textures we render to
+        self.create_textures()
 
         #Create global OpenCL buffers
         self.create_buffers()
 
-        self.object = object
-        self.load_object()
+        self.scene = common.objects.Scene.wrap(scene)
+        self.load_scene()
+
+        #Pick the dispatch settings
+        if autotune:
+            self.tune()
+        else:
+            self.set_dispatch(self.local_sizes()[0], True)
 
         #print OpenGL Version
         print "Using OpenGL version: " + glGetString(GL_VERSION)
 
     def set_display(self, resolution):
+        if self.offscreen:
+            #Windowless context rendering into a framebuffer object
+            self.egl = common.offscreen.Context(resolution)
+            self.framebuffer = common.offscreen.Framebuffer(resolution)
+            return
+
         #Create a pygame window
         pygame.display.init()
         pygame.display.set_mode(resolution,
@@ -124,6 +253,12 @@ class Raytracer:
         #create render quad
         self.render_quad = QUAD()
 
+        #Whether OpenGL can wait on OpenCL events (GL_ARB_cl_event)
+        self.gl_cl_events = bool(glCreateSyncFromCLeventARB)
+
+        #GPU time of drawing, when profiling
+        self.gl_timer = TimerQuery if self.profiler.enabled and TimerQuery.supported() else None
+
     def set_opencl(self):
         #Get all devices that fit requirements
         #from one platform
@@ -131,7 +266,7 @@ class Raytracer:
         good_platform = None
         for platform in OpenCL.get_platforms():
             for device in platform.get_devices():
-                if device.meets_requirements():
+                if meets_requirements(device):
                     good_devices.append(device)
             if len(good_devices) > 0:
                 good_platform = platform
@@ -145,8 +280,14 @@ class Raytracer:
         properties = self.get_context_properties(good_platform)
         self.context = Context(good_devices, properties=properties)
 
-        #Create the context queue
-        self.queue = CommandQueue(self.context)
+        #Create the context queue, recording when commands
+        #ran on the device when profiling
+        properties = command_queue_properties.PROFILING_ENABLE if self.profiler.enabled else 0
+        self.queue = CommandQueue(self.context, properties=properties)
+
+        #Whether acquiring GL objects waits for OpenGL by itself
+        self.cl_gl_events = all("cl_khr_gl_event" in device.extensions
+                                for device in good_devices)
 
         #print OpenCL version
         print "Using OpenCL version: " + str(good_platform.get_info(platform_info.VERSION))
@@ -160,9 +301,11 @@ class Raytracer:
         #link OpenGL context
         out.append((context_properties.GL_CONTEXT_KHR, platform.GetCurrentContext()))
         #link platform specific window contexts
-        if "GLX" in globals():
+        if self.offscreen:
+            out.append((context_properties.EGL_DISPLAY_KHR, cast(self.egl.display, c_void_p).value))
+        elif "GLX" in globals():
             out.append((context_properties.GLX_DISPLAY_KHR, GLX.glXGetCurrentDisplay()))
-        if "WGL" in globals():
+        elif "WGL" in globals():
             out.append((context_properties.WGL_HDC_KHR, WGL.wglGetCurrentDC()))
 
         #return context properties
@@ -173,27 +316,111 @@ class Raytracer:
         with open("raytraced/Raytracer.cl", "r") as file:
             source = ''.join(file.readlines())
 
-        #Create the opencl program
-        program = Program(self.context, source)
-
         #make program options
         options = "-cl-mad-enable -cl-fast-relaxed-math -Werror -I %s" % os.path.dirname(os.path.abspath(__file__))
 
-        #build program
-        program.build(options=options)
+        #build program, from the cached binaries if there are any
+        program = self.build_program(source, options)
         self.kernel = program.raytrace
-        self.kernel.set_scalar_arg_dtypes([None, None, None,
-                                           numpy.int32])
+        self.kernel.set_scalar_arg_dtypes([None, None, None, None, None, None,
+                                           None, None, None, None, numpy.int32])
+        self.progressive_kernel = program.raytrace_progressive
+        self.progressive_kernel.set_scalar_arg_dtypes([None, None, None, None, None, None,
+                                                       None, None, None, None, numpy.int32,
+                                                       None, numpy.int32, numpy.int32,
+                                                       numpy.float32])
+        self.primary_kernel = program.raytrace_primary
+        self.primary_kernel.set_scalar_arg_dtypes([None, None, None, None, None, None,
+                                                   None, None, None, numpy.int32,
+                                                   numpy.int32, numpy.int32, None,
+                                                   None, None, None, None])
+        self.shadow_kernel = program.trace_shadows
+        self.shadow_kernel.set_scalar_arg_dtypes([None, None, None, None, None, None,
+                                                  None, None, numpy.int32,
+                                                  None, None, None])
+        self.shade_kernel = program.shade
 
         #Match OpenCL Dtype. May not work everywhere
-        cltypes.Vertex, c_decl = OpenCL.tools.match_dtype_to_c_struct(self.context.devices[0], 'Vertex', cltypes.Vertex)
+        cltypes.BVHNode, c_decl = OpenCL.tools.match_dtype_to_c_struct(self.context.devices[0], 'BVHNode', cltypes.BVHNode)
+        cltypes.Instance, c_decl = OpenCL.tools.match_dtype_to_c_struct(self.context.devices[0], 'Instance', cltypes.Instance)
+        cltypes.QueuedRay, c_decl = OpenCL.tools.match_dtype_to_c_struct(self.context.devices[0], 'QueuedRay', cltypes.QueuedRay)
+
+    def build_program(self, source, options):
+        devices = self.context.devices
+        paths = [self.program_cache_path(device, source, options) for device in devices]
+
+        binaries = []
+        for path in paths:
+            try:
+                with open(path, "rb") as file:
+                    binaries.append(file.read())
+            except (IOError, OSError):
+                break
+
+        if len(binaries) == len(devices):
+            #Drivers may still refuse binaries, then they are rebuilt
+            try:
+                program = Program(self.context, devices, binaries)
+                program.build(options=options)
+                return program
+            except OpenCL.Error:
+                pass
+
+        program = Program(self.context, source)
+        program.build(options=options)
+
+        #A missing cache is not an error, just slower
+        binaries = program.get_info(program_info.BINARIES)
+        try:
+            if not os.path.isdir(PROGRAM_CACHE):
+                os.makedirs(PROGRAM_CACHE)
+            for path, binary in zip(paths, binaries):
+                #Written under another name first, so nobody reads half a binary
+                temporary = "%s.%d.tmp" % (path, os.getpid())
+                with open(temporary, "wb") as file:
+                    file.write(binary)
+                os.rename(temporary, path)
+        except (IOError, OSError):
+            pass
+        return program
+
+    def program_cache_path(self, device, source, options):
+        #Anything changing the binary changes its name: the source
+        #and every file it can include, the options, device and driver
+        key = hashlib.sha1()
+        key.update(source)
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(directory, "*.cl"))):
+            with open(path, "rb") as file:
+                key.update(os.path.basename(path))
+                key.update(file.read())
+        for info in (options, device.platform.name, device.platform.version,
+                     device.name, device.version, device.driver_version):
+            key.update("\0" + info)
+        return os.path.join(PROGRAM_CACHE, key.hexdigest() + ".bin")
+
+    def create_textures(self):
+        #Pipelined rendering alternates between two textures,
+        #one being raytraced while the other is drawn
+        count = 2 if self.pipelined else 1
+        self.gl_textures = []
+        self.render_textures = []
+        for index in range(count):
+            gl_texture, render_texture = self.create_texture()
+            self.gl_textures.append(gl_texture)
+            self.render_textures.append(render_texture)
+
+        #Synchronisation of every texture between frames
+        self.release_events = [None] * count
+        self.draw_fences = [None] * count
+        self.frame = 0
 
     def create_texture(self):
         #Grab the screen size
         width, height = self.width, self.height
 
         #Create a GL texture objects
-        self.gl_texture = texture = glGenTextures(1)
+        texture = glGenTextures(1)
 
         #Bind the texture so we can change things
         glBindTexture(GL_TEXTURE_2D, texture)
@@ -212,65 +439,517 @@ class Raytracer:
         glFinish()
 
         #Link the opengl texture to opencl
-        self.render_texture = GLTexture(self.context,
-                                        mem_flags.READ_WRITE,
-                                        GL_TEXTURE_2D, 0,
-                                        texture, 2)
+        render_texture = GLTexture(self.context,
+                                   mem_flags.READ_WRITE,
+                                   GL_TEXTURE_2D, 0,
+                                   texture, 2)
+        return texture, render_texture
 
     def create_buffers(self):
-        self.meshes_buffer = None
-
-    def load_object(self):
-        vertices = []
-        for tri in self.object.triangles:
-            #Built vertex object
-            position = tuple(list(self.object.vertices[tri]) + [0.0])
-            normal = tuple(list(self.object.normals[tri]) + [0.0])
-            vertex = (position, normal)
-            vertices.append(vertex)
-
-        self.meshes_array = numpy.array(vertices, dtype=cltypes.Vertex)
+        self.triangle_buffers = None
+        self.bvh_buffer = None
+        self.instance_bvh_buffer = None
+        self.instances_buffer = None
+
+        #Colour of every pixel traced (or interpolated) so far
+        self.samples_buffer = Buffer(self.context, mem_flags.READ_WRITE,
+                                     size=self.width * self.height * 16)
+        #View the progressive image belongs to, None to start over
+        self.progressive_camera = None
+        self.progressive_step = PROGRESSIVE_STEP
+
+        #Wavefront buffers for shadows: the lit colour of every pixel,
+        #whether it is in shadow, the queued shadow rays (at most one
+        #per pixel) and the number of rays queued of every type
+        if self.shadows:
+            pixels = self.width * self.height
+            self.direct_buffer = Buffer(self.context, mem_flags.READ_WRITE, size=pixels * 16)
+            self.shadowed_buffer = Buffer(self.context, mem_flags.READ_WRITE, size=pixels * 4)
+            self.shadow_rays_buffer = Buffer(self.context, mem_flags.READ_WRITE,
+                                             size=pixels * cltypes.QueuedRay.itemsize)
+            self.ray_counts = numpy.zeros(RAY_TYPES, dtype=numpy.int32)
+            self.ray_counts_buffer = Buffer(self.context, mem_flags.READ_WRITE | mem_flags.COPY_HOST_PTR,
+                                            hostbuf=self.ray_counts)
+            #Counts read back to size the dispatches by, apart from
+            #the zeros above that may still be being copied from
+            self.queued_counts = numpy.zeros(RAY_TYPES, dtype=numpy.int32)
+
+    def load_scene(self):
+        #Pack every distinct mesh (and level of detail)
+        #and its BVH into shared buffers
+        triangles = []
+        nodes = []
+        self.mesh_roots = {}
+        self.mesh_bounds = {}
+        node_count = triangle_count = 0
+        for level in [level for mesh in self.scene.meshes for level in mesh.levels]:
+            mesh_triangles, mesh_nodes = self.build_mesh(level)
+
+            self.mesh_roots[id(level)] = node_count
+            self.mesh_bounds[id(level)] = (mesh_nodes["min"][0, :3],
+                                           mesh_nodes["max"][0, :3])
+            triangles.append(mesh_triangles)
+            nodes.append(bvh.offset(mesh_nodes, node_count, triangle_count))
+
+            node_count += len(mesh_nodes)
+            triangle_count += mesh_triangles.shape[1]
+
+        self.triangles_array = numpy.concatenate(triangles, axis=1)
+        self.bvh_array = numpy.concatenate(nodes)
+
+        #Make buffers, one per triangle attribute
+        self.triangle_buffers = [Buffer(self.context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR, hostbuf=array)
+                                 for array in self.triangles_array]
+        self.bvh_buffer = Buffer(self.context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR, hostbuf=self.bvh_array)
+
+        self.load_instances()
+
+    def build_mesh(self, mesh):
+        #Build a BVH over the triangles and store them in leaf order
+        positions = mesh.positions[mesh.indices].reshape(-1, 3, 3)
+        nodes, order = bvh.build(positions)
+        positions = positions[order]
+
+        #Precompute the corner, edges and normal of every triangle
+        #as separate arrays of float4 (see Triangles in Raytracer.cl)
+        triangles = numpy.zeros((4, len(positions), 4), dtype=numpy.float32)
+        triangles[0, :, :3] = positions[:, 0]
+        triangles[1, :, :3] = positions[:, 1] - positions[:, 0]
+        triangles[2, :, :3] = positions[:, 2] - positions[:, 0]
+        triangles[3, :, :3] = numpy.cross(triangles[2, :, :3], triangles[1, :, :3])
+        return triangles, nodes
+
+    def load_instances(self):
+        #Place every object in the world. Call again after moving objects
+        objects = self.scene.objects
+        matrices = self.scene.matrices()
+        for object in objects:
+            common.objects.extend(object, OBJECT_METHODS)
+
+        #Build the top level BVH over the world bounds of the objects.
+        #Levels of detail never outgrow the mesh they were made from
+        lower = [self.mesh_bounds[id(object.mesh)][0] for object in objects]
+        upper = [self.mesh_bounds[id(object.mesh)][1] for object in objects]
+        lower, upper = bvh.transform_bounds(lower, upper, matrices)
+        self.instance_bvh_array, order = bvh.build_bounds(lower, upper)
+        self.instance_order = order
+
+        #Store instances in leaf order
+        inverses = numpy.linalg.inv(matrices[order])
+        self.instances_array = numpy.zeros(len(objects), dtype=cltypes.Instance)
+        rows = self.instances_array.view(numpy.float32).reshape(len(objects), -1)
+        rows[:, :12] = inverses[:, :3, :].reshape(len(objects), 12)
+        self.instances_array["root"] = [self.mesh_roots[id(objects[index].mesh)]
+                                        for index in order]
 
         #Make buffers
-        self.meshes_buffer = Buffer(self.context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR, hostbuf=self.meshes_array)
+        self.instance_bvh_buffer = Buffer(self.context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR, hostbuf=self.instance_bvh_array)
+        self.instances_buffer = Buffer(self.context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR, hostbuf=self.instances_array)
+
+        #Moved objects invalidate progressive images
+        self.progressive_camera = None
+        #and the levels of detail picked
+        self.lod_version = None
+        #and the kernel arguments
+        self.kernel_args = None
 
     def render(self, camera):
-        camera_info = camera.getCl_info()
+        profiler = self.profiler
+        profiler.begin_frame()
 
-        #Grab the screen size
-        width, height = self.width, self.height
+        with profiler.phase("select_lods"):
+            common.objects.extend(camera, CAMERA_METHODS)
+            camera_info = camera.getCl_info()
+            self.select_lods(camera)
+
+        if self.pipelined:
+            self.render_pipelined(camera_info)
+        elif self.progressive:
+            self.render_progressive(camera_info)
+        else:
+            self.render_frame(camera_info)
+
+        profiler.end_frame()
+
+    def render_frame(self, camera_info):
+        profiler = self.profiler
 
         #wait for OpenGL to finish all functions
-        glFinish()
+        with profiler.phase("gl_finish"):
+            glFinish()
         #Bind OpenGL texture for OpenCL
-        OpenCL.enqueue_acquire_gl_objects(self.queue, [self.render_texture])
+        with profiler.phase("acquire"):
+            self.acquire(self.render_textures[0])
 
         #Queue Raytrace
-        self.raytrace(camera_info)
+        with profiler.phase("enqueue"):
+            self.raytrace(camera_info, self.render_textures[0])
 
         #Unbind OpenGL texture from OpenCL
-        OpenCL.enqueue_release_gl_objects(self.queue, [self.render_texture])
+        with profiler.phase("release"):
+            self.release(self.render_textures[0])
+
+        #Wait for OpenCL to finish rendering
+        with profiler.phase("cl_finish"):
+            self.queue.finish()
 
         #Render rendered texture to back-buffer
-        self.render_render_texture()
+        with profiler.phase("draw", self.gl_timer):
+            self.render_render_texture(self.gl_textures[0])
+
+        with profiler.phase("present"):
+            self.present()
+
+    def acquire(self, texture):
+        #Hands "texture" from OpenGL to OpenCL
+        event = OpenCL.enqueue_acquire_gl_objects(self.queue, [texture])
+        return self.profile_event("acquire", event)
+
+    def release(self, texture):
+        #Hands "texture" back to OpenGL
+        event = OpenCL.enqueue_release_gl_objects(self.queue, [texture])
+        return self.profile_event("release", event)
+
+    def profile_event(self, name, event):
+        #Adds the device time of "event" to the frame, when profiling
+        self.profiler.device(name, event_time(event))
+        return event
+
+    def select_lods(self, camera):
+        #Levels only change when the camera moves
+        if self.lod_version == camera.version:
+            return
+        self.lod_version = camera.version
+
+        #Point instances at their level, uploaded only if any changed
+        meshes = self.scene.lods(camera, self.height)
+        roots = numpy.array([self.mesh_roots[id(meshes[index])] for index in self.instance_order],
+                            dtype=numpy.int32)
+        if not numpy.array_equal(roots, self.instances_array["root"]):
+            self.instances_array["root"] = roots
+            #In order with the kernels still using the buffer
+            OpenCL.enqueue_copy(self.queue, self.instances_buffer, self.instances_array)
+
+    def render_pipelined(self, camera_info):
+        #Raytrace this frame into one texture while the
+        #previous frame is drawn from the other one
+        profiler = self.profiler
+        current = self.frame % 2
+        previous = 1 - current
+        self.frame += 1
+
+        #OpenGL must be done drawing the texture two frames ago.
+        #With cl_khr_gl_event acquiring does that implicitly
+        if not self.cl_gl_events and self.draw_fences[current] is not None:
+            with profiler.phase("wait_draw"):
+                glClientWaitSync(self.draw_fences[current], GL_SYNC_FLUSH_COMMANDS_BIT,
+                                 GL_TIMEOUT_IGNORED)
+                glDeleteSync(self.draw_fences[current])
+                self.draw_fences[current] = None
+
+        texture = self.render_textures[current]
+        with profiler.phase("acquire"):
+            self.acquire(texture)
+        with profiler.phase("enqueue"):
+            self.raytrace(camera_info, texture)
+        with profiler.phase("release"):
+            self.release_events[current] = self.release(texture)
+        #Start the work without waiting for it
+        with profiler.phase("cl_flush"):
+            self.queue.flush()
+
+        #The first frame has nothing to show yet
+        event = self.release_events[previous]
+        if event is None:
+            return
+        self.release_events[previous] = None
+
+        #Make OpenGL wait for OpenCL to release the texture,
+        #on the GPU if GL_ARB_cl_event allows it
+        with profiler.phase("wait_cl"):
+            if self.gl_cl_events:
+                sync = glCreateSyncFromCLeventARB(c_void_p(self.context.int_ptr),
+                                                  c_void_p(event.int_ptr), 0)
+                glWaitSync(sync, 0, GL_TIMEOUT_IGNORED)
+                glDeleteSync(sync)
+            else:
+                event.wait()
+
+        with profiler.phase("draw", self.gl_timer):
+            self.render_render_texture(self.gl_textures[previous])
+        if not self.cl_gl_events:
+            self.draw_fences[previous] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+        with profiler.phase("present"):
+            self.present()
+
+    def render_progressive(self, camera_info):
+        #Start over whenever the view changes
+        if (self.progressive_camera is None or
+            not numpy.array_equal(camera_info, self.progressive_camera)):
+            self.progressive_camera = camera_info
+            self.progressive_step = PROGRESSIVE_STEP
+
+        #Refine the image until every pixel is done,
+        #then keep drawing the finished image
+        profiler = self.profiler
+        if self.progressive_step > 0:
+            with profiler.phase("gl_finish"):
+                glFinish()
+            with profiler.phase("acquire"):
+                self.acquire(self.render_textures[0])
+            with profiler.phase("enqueue"):
+                self.refine(camera_info, self.render_textures[0], self.progressive_step)
+            with profiler.phase("release"):
+                self.release(self.render_textures[0])
+            with profiler.phase("cl_finish"):
+                self.queue.finish()
+            self.progressive_step //= 2
+
+        with profiler.phase("draw", self.gl_timer):
+            self.render_render_texture(self.gl_textures[0])
+        with profiler.phase("present"):
+            self.present()
+
+    def finish(self):
+        #Wait for every frame in flight
+        self.queue.finish()
+        glFinish()
+
+    def present(self):
+        if self.offscreen:
+            #Nothing to show, just wait for the frame to be done
+            glFinish()
+        else:
+            #Swap back and front buffers
+            pygame.display.flip()
+
+    def read_pixels(self):
+        #Returns the rendered (height, width, 4) image, bottom row first
+        return common.offscreen.read_pixels(self.width, self.height)
+
+    def raytrace(self, camera_info, texture):
+        if self.shadows:
+            return self.raytrace_shadowed(camera_info, texture)
+
+        #Kernel arguments stay set between frames,
+        #only pass the ones that changed
+        if self.kernel_args is None:
+            self.kernel.set_args(texture, camera_info,
+                                 self.triangle_buffers[0],
+                                 self.triangle_buffers[1],
+                                 self.triangle_buffers[2],
+                                 self.triangle_buffers[3],
+                                 self.bvh_buffer,
+                                 self.instance_bvh_buffer,
+                                 self.instances_buffer,
+                                 self.local_cache,
+                                 self.cached_count)
+            self.kernel_args = [texture, camera_info]
+        else:
+            #Cached camera info is the same object while the camera is unchanged
+            for index, value in enumerate((texture, camera_info)):
+                if value is not self.kernel_args[index]:
+                    self.kernel.set_arg(index, value)
+                    self.kernel_args[index] = value
+
+        #Execute OpenCL kernel
+        event = OpenCL.enqueue_nd_range_kernel(self.queue, self.kernel,
+                                               self.global_size, self.local_size)
+        return self.profile_event("raytrace", event)
+
+    def raytrace_shadowed(self, camera_info, texture):
+        #Empty the ray queues, in order with the kernels
+        OpenCL.enqueue_copy(self.queue, self.ray_counts_buffer, self.ray_counts,
+                            is_blocking=False)
+
+        #Camera rays, queueing shadow rays
+        event = self.primary_kernel(self.queue, self.global_size, self.local_size,
+                                    camera_info,
+                                    self.triangle_buffers[0],
+                                    self.triangle_buffers[1],
+                                    self.triangle_buffers[2],
+                                    self.triangle_buffers[3],
+                                    self.bvh_buffer,
+                                    self.instance_bvh_buffer,
+                                    self.instances_buffer,
+                                    self.local_cache,
+                                    self.cached_count,
+                                    self.width, self.height, self.light,
+                                    self.direct_buffer,
+                                    self.shadowed_buffer,
+                                    self.shadow_rays_buffer,
+                                    self.ray_counts_buffer)
+        self.profile_event("raytrace", event)
+
+        #Shadow rays, a work-item for every ray queued. Reading the queue
+        #length back waits for the camera rays, but keeps work-items of
+        #pixels without a shadow ray from taking up the dispatch
+        OpenCL.enqueue_copy(self.queue, self.queued_counts, self.ray_counts_buffer)
+        count = int(self.queued_counts[SHADOW_RAYS])
+        if count > 0:
+            self.trace_shadows(count)
+
+        event = self.shade_kernel(self.queue, self.global_size, self.local_size,
+                                  texture, self.direct_buffer, self.shadowed_buffer)
+        return self.profile_event("shade", event)
+
+    def trace_shadows(self, count):
+        #Every shadow ray queued, in work-groups as large as the 2D ones
+        local_size = self.local_size[0] * self.local_size[1]
+        global_size = (count + local_size - 1) // local_size * local_size
+        event = self.shadow_kernel(self.queue, (global_size,), (local_size,),
+                                   self.triangle_buffers[0],
+                                   self.triangle_buffers[1],
+                                   self.triangle_buffers[2],
+                                   self.triangle_buffers[3],
+                                   self.bvh_buffer,
+                                   self.instance_bvh_buffer,
+                                   self.instances_buffer,
+                                   self.local_cache,
+                                   self.cached_count,
+                                   self.shadow_rays_buffer,
+                                   self.ray_counts_buffer,
+                                   self.shadowed_buffer)
+        return self.profile_event("trace_shadows", event)
+
+    def refine(self, camera_info, texture, step):
+        #One work-item per pixel on the grid of every "step"th pixel
+        width = (self.width + step - 1) // step
+        height = (self.height + step - 1) // step
+        global_size = tuple((size + local - 1) // local * local
+                            for size, local in zip((width, height), self.local_size))
+        threshold = ADAPTIVE_THRESHOLD if self.adaptive else -1
+
+        event = self.progressive_kernel(self.queue, global_size, self.local_size,
+                                        texture, camera_info,
+                                        self.triangle_buffers[0],
+                                        self.triangle_buffers[1],
+                                        self.triangle_buffers[2],
+                                        self.triangle_buffers[3],
+                                        self.bvh_buffer,
+                                        self.instance_bvh_buffer,
+                                        self.instances_buffer,
+                                        self.local_cache,
+                                        self.cached_count,
+                                        self.samples_buffer,
+                                        step, PROGRESSIVE_STEP, threshold)
+        return self.profile_event("refine", event)
 
-        #Swap back and front buffers
-        pygame.display.flip()
+    """
+       DISPATCH TUNING
+    """
+
+    def set_dispatch(self, local_size, cache_nodes):
+        #Round the screen up to whole tiles of "local_size"
+        self.local_size = tuple(local_size)
+        self.global_size = tuple((size + local - 1) // local * local
+                                 for size, local in zip((self.width, self.height),
+                                                        self.local_size))
+
+        #Cache as many nodes as fit into the local memory share
+        count = 0
+        if cache_nodes:
+            budget = min(device.local_mem_size for device in self.context.devices)
+            count = min(len(self.bvh_array),
+                        int(budget * LOCAL_CACHE_SHARE) // cltypes.BVHNode.itemsize)
+        self.cached_count = numpy.int32(count)
+        #Local memory can't be empty
+        self.local_cache = LocalMemory(max(count, 1) * cltypes.BVHNode.itemsize)
+        self.kernel_args = None
+
+    def local_sizes(self):
+        #Work-group sizes every kernel launched with "local_size"
+        #can run with on every device
+        kernels = (self.kernel, self.progressive_kernel, self.primary_kernel,
+                   self.shadow_kernel, self.shade_kernel)
+        sizes = []
+        for local_size in LOCAL_SIZES:
+            threads = local_size[0] * local_size[1]
+            fits = True
+            for device in self.context.devices:
+                limit = min(kernel.get_work_group_info(
+                                kernel_work_group_info.WORK_GROUP_SIZE, device)
+                            for kernel in kernels)
+                fits &= (threads <= limit and
+                         local_size[0] <= device.max_work_item_sizes[0] and
+                         local_size[1] <= device.max_work_item_sizes[1])
+                #Shadow rays are launched in one dimension
+                fits &= threads <= device.max_work_item_sizes[0]
+            if fits:
+                sizes.append(local_size)
+
+        #Tiny work-groups work everywhere
+        return sizes or [(1, 1)]
+
+    def tuning_key(self):
+        device = self.context.devices[0]
+        key = "%s:%s:%s:%dx%d" % (device.platform.name, device.name,
+                                  device.driver_version, self.width, self.height)
+        #Shadows are dispatched with different kernels
+        return key + ":shadows" if self.shadows else key
+
+    def tune(self):
+        #Reuse earlier measurements of this device and resolution
+        cache = {}
+        try:
+            with open(TUNING_CACHE, "r") as file:
+                cache = json.load(file)
+        except (IOError, OSError, ValueError):
+            pass
+
+        key = self.tuning_key()
+        if key in cache:
+            self.set_dispatch(cache[key]["local_size"], cache[key]["cache_nodes"])
+            return
+
+        #Look at the middle of the scene from a distance
+        root = self.instance_bvh_array[0]
+        center = (root["min"][:3] + root["max"][:3]) * 0.5
+        radius = numpy.linalg.norm(root["max"][:3] - root["min"][:3]) * 0.5
+        camera = common.objects.Camera()
+        for axis in range(3):
+            camera.position[axis] = float(center[axis])
+        camera.position[2] -= float(radius) * 3
+        common.objects.extend(camera, CAMERA_METHODS)
+        camera_info = camera.getCl_info()
 
-    def raytrace(self, camera_info):
-        #Grab the global memory size (screen size)
-        global_size = (self.width, self.height)
+        texture = self.render_textures[0]
+        glFinish()
+        OpenCL.enqueue_acquire_gl_objects(self.queue, [texture])
 
-        #Execute OpenCL kernel with arguments
-        self.kernel(self.queue, global_size, None,
-                    self.render_texture, camera_info,
-                    self.meshes_buffer,
-                    len(self.meshes_array))
+        best, best_time = None, None
+        for local_size in self.local_sizes():
+            for cache_nodes in (True, False):
+                self.set_dispatch(local_size, cache_nodes)
 
-        #Wait for OpenCL to finish rendering
+                #The first run includes one-off costs
+                self.raytrace(camera_info, texture)
+                self.queue.finish()
+
+                start = timing.clock_ns()
+                for run in range(TUNING_RUNS):
+                    self.raytrace(camera_info, texture)
+                self.queue.finish()
+                time = timing.clock_ns() - start
+
+                if best_time is None or time < best_time:
+                    best, best_time = (local_size, cache_nodes), time
+
+        OpenCL.enqueue_release_gl_objects(self.queue, [texture])
         self.queue.finish()
 
-    def render_render_texture(self):
+        self.set_dispatch(*best)
+        cache[key] = {"local_size" : list(best[0]), "cache_nodes" : best[1]}
+
+        #A missing cache is not an error, just slower
+        try:
+            with open(TUNING_CACHE, "w") as file:
+                json.dump(cache, file, indent=2, sort_keys=True)
+        except (IOError, OSError):
+            pass
+
+    def render_render_texture(self, texture):
         #Reset projection matrix
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -279,15 +958,20 @@ class Raytracer:
         glUseProgram(self.draw_program.id)
 
         #Bind render-texture for reading
-        glActiveTexture(GL_TEXTURE0 + self.gl_texture)
-        glBindTexture(GL_TEXTURE_2D, self.gl_texture)
+        glActiveTexture(GL_TEXTURE0 + texture)
+        glBindTexture(GL_TEXTURE_2D, texture)
         #Set argument in shader program
-        glUniform1i(self.draw_program.renderTexture, self.gl_texture)
+        glUniform1i(self.draw_program.renderTexture, texture)
 
         #Render render-quad with texture to back-buffer
         glCallList(self.render_quad)
 
     def close(self):
-        #close the pygame window
-        pygame.quit()
+        self.finish()
+        if self.offscreen:
+            self.framebuffer.close()
+            self.egl.close()
+        else:
+            #close the pygame window
+            pygame.quit()
         #The rest should be handled by the OS and the hardware driver
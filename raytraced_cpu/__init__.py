@@ -0,0 +1,378 @@
+import numpy
+import common.objects
+from common import bvh
+from common import math3d
+from common import parallel
+
+"""
+   CONSTANTS
+"""
+
+BLACK = numpy.array([0, 0, 0, 1], dtype=numpy.float32)
+WHITE = numpy.array([1, 1, 1, 1], dtype=numpy.float32)
+
+#Rays traced together (TILE_SIZE x TILE_SIZE)
+TILE_SIZE = 64
+#Upper limit of ray/triangle pairs tested in one go
+BATCH_SIZE = 1 << 20
+
+"""
+   GEOMETRY
+"""
+
+class Geometry:
+    """Triangle data of a Mesh, precomputed for intersection tests.
+    Arrays are passed through "store" (like parallel.copy) if given.
+    """
+    def __init__(self, mesh, store=None):
+        store = store or numpy.ascontiguousarray
+        triangles = mesh.positions[mesh.indices].reshape(-1, 3, 3)
+
+        self.triangle_a = store(triangles[:, 0])
+        self.edge1 = store(triangles[:, 1] - triangles[:, 0])
+        self.edge2 = store(triangles[:, 2] - triangles[:, 0])
+
+        #Same layout as Triangles in Raytracer.cl
+        self.normals = store(numpy.cross(self.edge2, self.edge1))
+
+        self.lower = mesh.positions.min(axis=0)
+        self.upper = mesh.positions.max(axis=0)
+
+    def begin(self, origin):
+        """Returns the GeometryView of rays starting at "origin" """
+        return GeometryView(self, origin)
+
+class GeometryView:
+    """The part of Moller-Trumbore depending on the ray origin.
+    All rays traced against a geometry share their origin
+    so the triangle side of it is done once.
+    """
+    def __init__(self, geometry, origin):
+        self.geometry = geometry
+        offset = origin - geometry.triangle_a
+        self.u_factor = numpy.cross(geometry.edge2, offset)
+        self.v_factor = numpy.cross(offset, geometry.edge1)
+        self.t_numerator = (self.v_factor * geometry.edge2).sum(axis=1)
+
+        #Corners relative to the origin, for culling against tiles
+        self.relative = numpy.stack([-offset,
+                                     geometry.edge1 - offset,
+                                     geometry.edge2 - offset], axis=1)
+
+    def raycast(self, directions, triangles):
+        #Moller-Trumbore over batches of triangles, keeping the closest hit
+        count = len(directions)
+        dist = numpy.full(count, numpy.inf, dtype=numpy.float32)
+        triangle = numpy.zeros(count, dtype=numpy.int32)
+
+        batch = max(1, BATCH_SIZE // max(count, 1))
+        for start in range(0, len(triangles), batch):
+            indices = triangles[start:start + batch]
+            det = numpy.dot(directions, self.geometry.normals[indices].T)
+            u = numpy.dot(directions, self.u_factor[indices].T)
+            v = numpy.dot(directions, self.v_factor[indices].T)
+            t = self.t_numerator[indices]
+
+            #Only front faces (det > 0) inside the triangle count
+            valid = (det > 0) & (u >= 0) & (v >= 0) & (u + v <= det) & (t > 0)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                candidates = numpy.where(valid, t / det, numpy.inf)
+
+            closest = candidates.argmin(axis=1)
+            closest_dist = candidates[numpy.arange(count), closest]
+            better = closest_dist < dist
+            dist[better] = closest_dist[better]
+            triangle[better] = indices[closest[better]]
+
+        return dist, triangle
+
+def tile_planes(directions):
+    """
+    tile_planes(directions:numpy.ndarray) -> numpy.ndarray
+
+    Returns the (4, 3) inward normals of the side planes
+    of the frustum spanned by a (h, w, 3) tile of rays
+    """
+    #Corner rays of the tile, counter clockwise
+    corners = (directions[0, 0], directions[0, -1],
+               directions[-1, -1], directions[-1, 0])
+    center = sum(corners)
+
+    planes = numpy.empty((4, 3))
+    for index in range(4):
+        normal = numpy.cross(corners[index], corners[index - 1])
+        if numpy.dot(normal, center) < 0:
+            normal = -normal
+        planes[index] = normal
+    return planes
+
+def inside_planes(points, planes):
+    """
+    inside_planes(points:numpy.ndarray, planes:numpy.ndarray) -> numpy.ndarray
+
+    Returns which of the (n, k, 3) groups of points (relative
+    to the planes' origin) aren't all outside the same plane
+    """
+    visible = numpy.ones(len(points), dtype=bool)
+    for normal in planes:
+        visible &= (numpy.dot(points, normal) >= 0).any(axis=1)
+    return visible
+
+def box_corners(lower, upper):
+    """Returns the (8, 3) corners of an axis aligned box"""
+    return numpy.array([[upper[axis] if corner & (1 << axis) else lower[axis]
+                         for axis in range(3)]
+                        for corner in range(8)])
+
+"""
+   MAIN CLASS
+"""
+
+class CpuRaytracer:
+    """Raytraced Renderer running on the CPU with NumPy.
+    Produces the same image as raytraced.Raytracer
+    without needing OpenCL, OpenGL or a window.
+
+    Frames are rendered in tiles of TILE_SIZE x TILE_SIZE pixels
+    by "processes" worker processes (see parallel.TilePool),
+    every available core if None. With a single process tiles
+    are rendered in this process instead.
+    """
+
+    """
+       INITIALISATION
+    """
+    def __init__(self, resolution, scene, tile_size=TILE_SIZE, processes=None):
+        self.width, self.height = resolution
+        self.tile_size = int(tile_size)
+        self.processes = int(processes or parallel.cpu_count())
+        self.pool = None
+        #Shared memory made by this renderer
+        self.shared = []
+
+        #create the framebuffer we render to
+        self.create_framebuffer()
+
+        self.scene = common.objects.Scene.wrap(scene)
+        self.load_scene()
+
+    def allocate(self, shape, dtype):
+        #Arrays workers write to are shared with them
+        if self.processes == 1:
+            return numpy.empty(shape, dtype=dtype)
+        array = parallel.empty(shape, dtype)
+        self.shared.append(array)
+        return array
+
+    def share(self, array):
+        #Arrays workers read are shared with them
+        if self.processes == 1:
+            return numpy.ascontiguousarray(array)
+        array = parallel.copy(array)
+        self.shared.append(array)
+        return array
+
+    def create_framebuffer(self):
+        #Rows are stored bottom up, like the OpenGL render texture
+        self.framebuffer = self.allocate((self.height, self.width, 4), numpy.float32)
+        self.framebuffer[...] = 0
+
+        #Closest hit of every pixel
+        self.depth = self.allocate((self.height, self.width), numpy.float32)
+        self.normals = self.allocate((self.height, self.width, 3), numpy.float32)
+
+        #Normalised screen coordinates of every column and row
+        self.screen_x = (numpy.arange(self.width, dtype=numpy.float32) /
+                         self.width - 0.5)
+        self.screen_y = (numpy.arange(self.height, dtype=numpy.float32) /
+                         self.height - 0.5)
+
+        #Rays of the last camera rendered
+        self.directions = self.allocate((self.height, self.width, 3), numpy.float32)
+        self.camera_version = None
+
+        #Every tile of the frame, as the (x, y) of its first pixel
+        self.tiles = [(x, y) for y in range(0, self.height, self.tile_size)
+                             for x in range(0, self.width, self.tile_size)]
+        self.frame = 0
+        self.views_frame = None
+
+    def load_scene(self):
+        #Meshes are only prepared once, however often they are used
+        self.geometries = []
+        self.geometry_index = {}
+        for mesh in self.scene.meshes:
+            for level in mesh.levels:
+                self.geometry_index[id(level)] = len(self.geometries)
+                self.geometries.append(Geometry(level, self.share))
+
+        self.load_instances()
+
+        #Workers get a copy of the renderer with the geometry in it
+        if self.processes > 1:
+            if self.pool is not None:
+                self.pool.close()
+            self.pool = parallel.TilePool(self, self.processes)
+
+    def load_instances(self):
+        #Place every object in the world. Call again after moving objects
+        objects = self.scene.objects
+        self.matrices = self.scene.matrices()
+        self.inverses = numpy.linalg.inv(self.matrices)
+
+        #World space bounds, for skipping whole objects
+        geometries = [self.geometries[self.geometry_index[id(object.mesh)]]
+                      for object in objects]
+        self.lower, self.upper = bvh.transform_bounds(
+            [geometry.lower for geometry in geometries],
+            [geometry.upper for geometry in geometries],
+            self.matrices)
+
+        #Levels of detail of the last camera rendered
+        self.lod_version = None
+
+    def __getstate__(self):
+        #Workers only need the shared arrays, not the scene
+        state = self.__dict__.copy()
+        for name in ("scene", "pool", "shared"):
+            state.pop(name, None)
+        return state
+
+    """
+       RUNTIME
+    """
+
+    def render(self, camera):
+        origin = self.camera_rays(camera)[0]
+        self.select_lods(camera)
+
+        #Everything workers need to know about this frame,
+        #small enough to send them every frame
+        self.frame += 1
+        state = (self.frame, origin,
+                 [self.geometry_index[id(mesh)] for mesh in self.object_meshes],
+                 self.matrices, self.inverses, self.lower, self.upper)
+
+        if self.pool is not None:
+            self.pool.run(self.tiles, state)
+        else:
+            for tile in self.tiles:
+                self.render_tile(tile, state)
+        return self.framebuffer
+
+    def camera_rays(self, camera):
+        #Only rebuilt after the camera changed
+        if self.camera_version != camera.version:
+            self.camera_version = camera.version
+
+            #The columns of the rotation matrix are the right, up and forward axes
+            rotation = camera.rotation_matrix().astype(numpy.float32)
+            self.origin = numpy.array(list(camera.position), dtype=numpy.float32)
+
+            #Build the ray directions of every pixel, in place
+            #as workers share them
+            self.directions[...] = (rotation[:, 2] +
+                                    self.screen_y[:, None, None] * rotation[:, 1] +
+                                    self.screen_x[None, :, None] * rotation[:, 0])
+
+        return self.origin, self.directions
+
+    def select_lods(self, camera):
+        #Levels only change when the camera moves
+        if self.lod_version != camera.version:
+            self.lod_version = camera.version
+            self.object_meshes = self.scene.lods(camera, self.height)
+
+    def render_tile(self, tile, state):
+        #Raytraces and shades one tile of the frame
+        frame, origin, geometries, matrices, inverses, lower, upper = state
+        x, y = tile
+        region = slice(y, y + self.tile_size), slice(x, x + self.tile_size)
+
+        self.depth[region] = numpy.inf
+        for index in range(len(geometries)):
+            self.raytrace_instance(region, index, state)
+
+        self.shade(region)
+
+    def view(self, frame, index, geometry, origin):
+        #Origin dependent part of every instance, once per frame and process
+        if self.views_frame != frame:
+            self.views_frame = frame
+            self.views = {}
+        if index not in self.views:
+            self.views[index] = geometry.begin(origin)
+        return self.views[index]
+
+    def raytrace_instance(self, region, index, state):
+        frame, origin, geometries, matrices, inverses, lower, upper = state
+        geometry = self.geometries[geometries[index]]
+        matrix = matrices[index]
+        inverse = inverses[index]
+
+        tile_directions = self.directions[region]
+        planes = tile_planes(tile_directions)
+
+        #Skip tiles the object isn't in, by its bounding
+        #box corners relative to the eye
+        corners = box_corners(lower[index], upper[index]) - origin
+        if not inside_planes(corners[None], planes)[0]:
+            return
+
+        #Trace in object space. Directions aren't normalised
+        #so distances are the same in both spaces
+        object_origin = math3d.transform_points(inverse, origin[None])[0]
+        view = self.view(frame, index, geometry, object_origin.astype(numpy.float32))
+
+        #Only test triangles overlapping the tile's frustum
+        object_planes = numpy.dot(planes, matrix[:3, :3])
+        triangles = numpy.nonzero(inside_planes(view.relative, object_planes))[0]
+        if len(triangles) == 0:
+            return
+
+        object_directions = math3d.transform_directions(
+            inverse, tile_directions.reshape(-1, 3)).astype(numpy.float32)
+        dist, triangle = view.raycast(object_directions, triangles)
+
+        #Keep hits closer than those of other objects
+        depth = self.depth[region]
+        dist = dist.reshape(depth.shape)
+        closer = dist < depth
+        depth[closer] = dist[closer]
+
+        #Normals transform by the transposed inverse
+        triangle = triangle.reshape(depth.shape)[closer]
+        normals = numpy.dot(geometry.normals[triangle], inverse[:3, :3])
+        self.normals[region][closer] = normals
+
+    def shade(self, region):
+        depth = self.depth[region]
+        framebuffer = self.framebuffer[region]
+        hit = numpy.isfinite(depth)
+
+        normals = self.normals[region][hit]
+        lengths = numpy.sqrt((normals ** 2).sum(axis=1))
+        normals /= numpy.maximum(lengths, 1e-30)[:, None]
+
+        #Shade like the raytrace kernel
+        framebuffer[...] = BLACK
+        shading = (normals * self.directions[region][hit]).sum(axis=1)
+        framebuffer[hit] = shading[:, None] * WHITE + WHITE * 0.4
+
+    def read_pixels(self):
+        #Returns the rendered (height, width, 4) image, bottom row first
+        return self.framebuffer
+
+    """
+       CLEANUP
+    """
+
+    def close(self):
+        #Stop the workers and free the shared memory,
+        #the rest is garbage collected
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        for array in self.shared:
+            parallel.release(array)
+        self.shared = []
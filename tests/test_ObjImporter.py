@@ -0,0 +1,61 @@
+"""
+Regression tests of common.ObjImporter, run from the
+repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from common import ObjImporter
+
+class ParseFacesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, text):
+        path = os.path.join(self.directory, "mesh.obj")
+        with open(path, "w") as file:
+            file.write(text)
+        return ObjImporter.load(path, cache=False)[0]
+
+    def test_mixed_corner_layouts(self):
+        #Same number of values as three "v/vt" corners,
+        #but every corner has a layout of its own
+        mesh = self.load("v 0 0 0\n"
+                         "v 1 0 0\n"
+                         "v 0 1 0\n"
+                         "v 1 1 0\n"
+                         "vt 0.25 0.5\n"
+                         "vt 0.5 0.25\n"
+                         "vt 0.75 1\n"
+                         "vn 0 0 1\n"
+                         "f 1/1 4 3/3/1\n")
+
+        corners = mesh.indices
+        numpy.testing.assert_array_equal(
+            mesh.positions[corners], [[0, 0, 0], [1, 1, 0], [0, 1, 0]])
+        numpy.testing.assert_array_equal(
+            mesh.uv[corners], [[0.25, 0.5], [0, 0], [0.75, 1]])
+        numpy.testing.assert_array_equal(
+            mesh.normals[corners], [[0, 0, 0], [0, 0, 0], [0, 0, 1]])
+
+    def test_missing_attributes_only_zero_their_corners(self):
+        mesh = self.load("v 0 0 0\n"
+                         "v 1 0 0\n"
+                         "v 0 1 0\n"
+                         "v 1 1 0\n"
+                         "vn 0 0 1\n"
+                         "f 1//1 2//1 3//1\n"
+                         "f 2 4 3\n")
+
+        normals = mesh.normals[mesh.indices]
+        numpy.testing.assert_array_equal(normals[:3], [[0, 0, 1]] * 3)
+        numpy.testing.assert_array_equal(normals[3:], [[0, 0, 0]] * 3)
+
+if __name__ == "__main__":
+    unittest.main()